@@ -0,0 +1,374 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Benchmark suite for the SFS, fitting and simulation paths
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Repeatable timings of the hot paths of the pipeline on synthetic fixtures
+with the shapes of our data, across input sizes and numbers of processes:
+
+    vcf_sfs   VCF -> folded SFS as in dadi_data_prep.py (dadi_sfs_stream),
+              79 diploids (ns = 158); size = number of SNPs
+    func_ex   extrapolated model spectra of two_changes at ns = 158, one
+              evaluation per parameter vector on a pool; size = smallest
+              grid of pts_l (pts_l = [g, g+10, g+20])
+    optimize  the multi-start fits of dadi_demography.py (dadi_parallel)
+              on a synthetic ns = 158 spectrum; size = starts per model
+    obs       parsing and loading (memory-mapped cache) of the pairwise
+              .obs files, and composite likelihood scoring of them
+              (msprime/pubrhe_score.py); size = 3-deme or 5-deme, with the
+              sample sizes of fastsimcoal2/<k>-deme/sfs-files
+    simulate  sim_ancestry + sim_mutations of the fsc2-3 model (as
+              SIM_SEGMENTS segments on a pool, whatever the number of
+              processes, see msprime/pubrhe_segments.py) and write_vcf of
+              the result; size = sequence length (bp)
+
+The obs and simulate stages use the msprime helpers, installed with
+`pip install -e .` from the top of the repository.
+
+Usage:
+    python dadi_benchmark.py [--stages vcf_sfs,func_ex,...] [--processes 1,4]
+                             [--sizes stage=a,b ...] [--repeats 3]
+                             [--fixtures DIR] [--out FILE] [--quick]
+    python dadi_benchmark.py --compare OLD.json NEW.json
+
+The fixtures are generated once with fixed seeds and reused from the
+fixtures folder. Every (stage, size, processes) cell is run --repeats times
+after an untimed setup; the results file (JSON) records the commit, the
+library versions and the machine, and the times of every repeat (with their
+median and minimum, and sub-step times where a stage has several). --compare
+prints the ratio of the median times of two results files, cell by cell.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import dadi
+import numpy as np
+import dadi_cache
+import dadi_fsc_obs
+import dadi_models
+import dadi_parallel
+import dadi_sfs_stream
+
+# default sizes of every stage
+SIZES = {
+    'vcf_sfs': [20000, 100000],
+    'func_ex': [40, 60],
+    'optimize': [2, 4],
+    'obs': ['3-deme', '5-deme'],
+    'simulate': [1000000, 10000000],
+}
+UNITS = {'vcf_sfs': 'SNPs', 'func_ex': 'smallest grid', 'optimize': 'starts per model',
+         'obs': 'deme set', 'simulate': 'bp'}
+
+# gene copies of every deme of the pairwise .obs files (fastsimcoal2 deme order)
+OBS_SAMPLES = {'3-deme': [10, 10, 138], '5-deme': [10, 56, 10, 62, 20]}
+
+N_DIPLOIDS = 79
+TRUE_PARAMS = [0.4, 1.3, 0.33, 0.054] # two_changes, close to the fit of our data
+SIM_SEGMENTS = 8 # segments of the simulate stage, the same work for every number of processes
+
+##### fixtures
+
+def vcf_fixture(fixtures, n_snps, seed=1):
+    """
+    Synthetic GT-only VCF (msprime-like) of N_DIPLOIDS samples and n_snps
+    biallelic sites with derived counts drawn from the neutral 1/i spectrum,
+    and its population file; returns (vcf path, popinfo path).
+    """
+    vcf = os.path.join(fixtures, f"synthetic_{n_snps}.vcf")
+    popinfo = os.path.join(fixtures, "synthetic_popinfo.txt")
+    samples = [f"tsk_{i}" for i in range(N_DIPLOIDS)]
+    if not os.path.isfile(popinfo):
+        with open(popinfo, 'w') as f:
+            f.write("".join(f"{s}\tpop1\n" for s in samples))
+    if os.path.isfile(vcf):
+        return vcf, popinfo
+    rng = np.random.default_rng(seed)
+    n = 2 * N_DIPLOIDS
+    weights = 1.0 / np.arange(1, n)
+    counts = rng.choice(np.arange(1, n), size=n_snps, p=weights / weights.sum())
+    positions = np.sort(rng.choice(np.arange(1, 100 * n_snps), size=n_snps, replace=False))
+    calls = np.array(['0|0', '0|1', '1|0', '1|1'])
+    tmp = vcf + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write("##fileformat=VCFv4.2\n##source=dadi_benchmark\n##contig=<ID=1>\n")
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples) + "\n")
+        for start in range(0, n_snps, 10000):
+            block = counts[start:start+10000]
+            haps = np.zeros((len(block), n), dtype=np.int8)
+            for i, k in enumerate(block):
+                haps[i, rng.choice(n, size=k, replace=False)] = 1
+            gts = calls[2 * haps[:, 0::2] + haps[:, 1::2]]
+            for pos, row in zip(positions[start:start+10000], gts):
+                f.write(f"1\t{pos}\t.\tA\tT\t.\tPASS\t.\tGT\t" + "\t".join(row) + "\n")
+    os.replace(tmp, vcf)
+    return vcf, popinfo
+
+def fs_fixture(fixtures, seed=1):
+    """
+    Folded ns = 158 spectrum drawn (Poisson) from two_changes at TRUE_PARAMS,
+    theta = 10000; returns its path.
+    """
+    path = os.path.join(fixtures, "synthetic_two_changes.fs")
+    if not os.path.isfile(path):
+        model = dadi.Numerics.make_extrap_log_func(dadi_models.SizeChangeModel(2))
+        expected = 10000 * model(TRUE_PARAMS, [2 * N_DIPLOIDS], [40, 50, 60])
+        np.random.seed(seed)
+        expected.sample().fold().to_file(path)
+    return path
+
+def obs_fixture(fixtures, demes, seed=1):
+    """
+    Folder of synthetic <demes>_jointMAFpopX_Y.obs files, one per pair of
+    demes, with the shapes of the fastsimcoal2 files: Poisson counts around
+    1/(i+j), folded as the .obs files are; returns the folder.
+    """
+    folder = os.path.join(fixtures, f"obs_{demes}")
+    if os.path.isdir(folder):
+        return folder
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder + '.tmp', exist_ok=True)
+    sizes = OBS_SAMPLES[demes]
+    for x in range(len(sizes)):
+        for y in range(x):
+            i, j = np.meshgrid(np.arange(sizes[x] + 1), np.arange(sizes[y] + 1), indexing='ij')
+            expected = 1e5 / np.maximum(i + j, 1)
+            fs = dadi.Spectrum(rng.poisson(expected).astype(float), pop_ids=[f"pop{x}", f"pop{y}"])
+            obs = dadi_fsc_obs.from_spectrum(fs, n_monomorphic=int(1e7))
+            obs.to_file(os.path.join(folder + '.tmp', f"{demes}_jointMAFpop{x}_{y}.obs"))
+    os.replace(folder + '.tmp', folder)
+    return folder
+
+##### stages: each returns (sub-step times, information about the run)
+
+def bench_vcf_sfs(fixtures, size, processes):
+    vcf, popinfo = vcf_fixture(fixtures, size)
+    t0 = time.perf_counter()
+    fs = dadi_sfs_stream.sfs_from_vcf(vcf, popinfo, ['pop1'], [2 * N_DIPLOIDS], polarized=False,
+                                      processes=processes)
+    return {'total': time.perf_counter() - t0}, {'segregating_sites': float(fs.S())}
+
+def _func_ex(task):
+    params, pts_l = task
+    func_ex = dadi.Numerics.make_extrap_log_func(dadi_models.SizeChangeModel(2))
+    return func_ex(params, [2 * N_DIPLOIDS], pts_l)
+
+def bench_func_ex(fixtures, size, processes, n_evals=8):
+    pts_l = [size, size + 10, size + 20]
+    rng = np.random.default_rng(size)
+    tasks = [([p * f for p, f in zip(TRUE_PARAMS, rng.uniform(0.8, 1.2, 4))], pts_l)
+             for i in range(n_evals)]
+    t0 = time.perf_counter()
+    if processes == 1:
+        list(map(_func_ex, tasks))
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            pool.map(_func_ex, tasks, chunksize=1)
+    total = time.perf_counter() - t0
+    return {'total': total}, {'evaluations': n_evals, 'pts_l': pts_l,
+                              'seconds_per_evaluation': total / n_evals * processes}
+
+def bench_optimize(fixtures, size, processes):
+    models = [{'name': m.__name__, 'func': m, 'param_names': m.param_names,
+               'lower_bound': [0.01] * len(m.param_names), 'upper_bound': [100] * len(m.param_names),
+               'initial_values': [1.0] * m.n_changes + [0.5] * m.n_changes}
+              for m in (dadi_models.SizeChangeModel(1), dadi_models.SizeChangeModel(2))]
+    data_fs = fs_fixture(fixtures)
+    # the in-process model spectrum cache would serve later repeats
+    dadi_cache._caches.clear()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fits = dadi_parallel.fit_models(models, data_fs, [40, 50, 60], size, seed=1,
+                                        processes=processes, maxiter=100)
+    total = time.perf_counter() - t0
+    starts = [r for fit in fits for r in fit['starts']]
+    return {'total': total}, {'integrations': sum(r['cache']['misses'] for r in starts),
+                              'best_ll': [float(fit['best']['ll']) for fit in fits]}
+
+def bench_obs(fixtures, size, processes, n_scores=100):
+    import pubrhe_score
+    folder = obs_fixture(fixtures, size)
+    cache_dir = os.path.join(fixtures, f"obs_{size}_cache")
+    files = sorted(os.listdir(folder))
+    t0 = time.perf_counter()
+    for name in files:
+        dadi_fsc_obs.parse_obs(os.path.join(folder, name))
+    parse = time.perf_counter() - t0
+    # first load builds the binary copies, the timed one maps them
+    dadi_fsc_obs.load_obs_dir(folder, cache_dir)
+    t0 = time.perf_counter()
+    observed = {pops: obs.data for pops, obs in dadi_fsc_obs.load_obs_dir(folder, cache_dir).items()}
+    load = time.perf_counter() - t0
+    scorer = pubrhe_score.PairwiseScorer(observed)
+    expected = {p: np.asarray(observed[p], dtype=float) + 1 for p in scorer.pairs}
+    t0 = time.perf_counter()
+    for i in range(n_scores):
+        scorer.score(expected)
+    score = (time.perf_counter() - t0) / n_scores
+    return ({'total': parse + load + score, 'parse': parse, 'load_cached': load, 'score': score},
+            {'files': len(files), 'cells': int(sum(np.size(o) for o in observed.values()))})
+
+def bench_simulate(fixtures, size, processes):
+    import pubrhe_demes
+    import pubrhe_segments
+    import pubrhe_trace
+    _, compiled = pubrhe_demes.load_model('fsc2-3', cache_dir=os.path.join(pubrhe_demes.DEMES_DIR, '.compiled'))
+    trace = pubrhe_trace.Trace()
+    t0 = time.perf_counter()
+    ts = pubrhe_segments.simulate_segments(compiled['demography'], compiled['samples'], size, 1e-8,
+                                           1.08e-8, [1, size], n_segments=SIM_SEGMENTS,
+                                           processes=processes, trace=trace)
+    simulate = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    with open(os.devnull, 'w') as out:
+        ts.write_vcf(out)
+    write = time.perf_counter() - t0
+    steps = trace.totals()['steps']
+    return ({'total': simulate + write, 'simulate': simulate, 'write_vcf': write,
+             'sim_ancestry': steps['sim_ancestry']['wall_time'],
+             'sim_mutations': steps['sim_mutations']['wall_time']},
+            {'num_trees': ts.num_trees, 'num_sites': ts.num_sites})
+
+STAGES = {'vcf_sfs': bench_vcf_sfs, 'func_ex': bench_func_ex, 'optimize': bench_optimize,
+          'obs': bench_obs, 'simulate': bench_simulate}
+
+##### runner
+
+def machine_info():
+    """
+    Commit, library versions and machine of a run.
+    """
+    def version(name):
+        try:
+            module = __import__(name)
+        except ImportError:
+            return None
+        return getattr(module, '__version__', None)
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() != ''
+    except OSError:
+        commit, dirty = None, None
+    return {'commit': commit, 'dirty': dirty, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': version('scipy'), 'msprime': version('msprime'), 'tskit': version('tskit'),
+            'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+def setup(stage, fixtures, size):
+    """
+    Build the fixtures of a cell (and the compiled model) before the timings.
+    """
+    if stage == 'vcf_sfs':
+        vcf_fixture(fixtures, size)
+    elif stage == 'optimize':
+        fs_fixture(fixtures)
+    elif stage == 'obs':
+        obs_fixture(fixtures, size)
+    elif stage == 'simulate':
+        import pubrhe_demes
+        pubrhe_demes.load_model('fsc2-3', cache_dir=os.path.join(pubrhe_demes.DEMES_DIR, '.compiled'))
+
+def run_cell(stage, fixtures, size, processes, repeats):
+    """
+    Timings of one (stage, size, processes) cell over the repeats.
+    """
+    func = STAGES[stage]
+    setup(stage, fixtures, size)
+    times = []
+    for r in range(repeats):
+        steps, info = func(fixtures, size, processes)
+        times.append(steps)
+    totals = [t['total'] for t in times]
+    return {'stage': stage, 'size': size, 'unit': UNITS[stage], 'processes': processes,
+            'repeats': times, 'median': float(np.median(totals)), 'min': float(np.min(totals)),
+            'info': info}
+
+def run(stages, sizes, processes, repeats, fixtures, out=None):
+    """
+    Run every cell and write the results file; returns the results.
+    """
+    os.makedirs(fixtures, exist_ok=True)
+    results = {'machine': machine_info(), 'repeats': repeats, 'results': []}
+    for stage in stages:
+        for size in sizes[stage]:
+            for p in processes:
+                cell = run_cell(stage, fixtures, size, p, repeats)
+                results['results'].append(cell)
+                print(f"{stage:9s} {str(size):>9s} {UNITS[stage]:17s} {p:3d} proc  "
+                      f"median {cell['median']:.4f} s  min {cell['min']:.4f} s", flush=True)
+                if out is not None:
+                    # rewritten after every cell, so an interrupted run keeps what it measured
+                    with open(out, 'w') as f:
+                        json.dump(results, f, indent=1)
+    return results
+
+def compare(old_path, new_path):
+    """
+    Print new / old median time of every cell present in both files.
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    key = lambda c: (c['stage'], str(c['size']), c['processes'])
+    old_cells = {key(c): c for c in old['results']}
+    print(f"old: {old['machine']['commit']} ({old['machine']['date']}), "
+          f"new: {new['machine']['commit']} ({new['machine']['date']})")
+    for c in new['results']:
+        o = old_cells.get(key(c))
+        if o is None:
+            continue
+        print(f"{c['stage']:9s} {str(c['size']):>9s} {c['processes']:3d} proc  "
+              f"{o['median']:.4f} -> {c['median']:.4f} s  x{c['median'] / o['median']:.2f}")
+
+def _int_list(text):
+    return [int(x) for x in text.split(',')]
+
+def _parse_sizes(items):
+    sizes = dict(SIZES)
+    for item in items or []:
+        stage, values = item.split('=')
+        sizes[stage] = values.split(',') if stage == 'obs' else _int_list(values)
+    return sizes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the SFS, fitting and simulation paths.")
+    parser.add_argument('--stages', default=','.join(STAGES), help="comma-separated stages")
+    parser.add_argument('--processes', type=_int_list, default=sorted({1, os.cpu_count()}),
+                        help="comma-separated numbers of processes")
+    parser.add_argument('--sizes', nargs='*', help="stage=size1,size2 overrides of the default sizes")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help="smallest size of every stage, 1 repeat")
+    parser.add_argument('--fixtures', default='benchmark_fixtures', help="folder of the synthetic inputs")
+    parser.add_argument('--out', default=None, help="results file (default benchmark_<commit>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two results files")
+    args = parser.parse_args()
+    if args.compare is not None:
+        compare(*args.compare)
+        sys.exit()
+    stages = args.stages.split(',')
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        sys.exit(f"Unknown stages: {unknown}; choose from {list(STAGES)}")
+    sizes = _parse_sizes(args.sizes)
+    repeats = args.repeats
+    if args.quick:
+        sizes = {s: v[:1] for s, v in sizes.items()}
+        repeats = 1
+    out = args.out
+    if out is None:
+        commit = machine_info()['commit']
+        out = f"benchmark_{commit[:10] if commit else 'nogit'}.json"
+    run(stages, sizes, args.processes, repeats, args.fixtures, out)
+    print(out)
@@ -0,0 +1,265 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi parametric bootstrap
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Parametric bootstrap of the 1-deme fits: simulate replicate spectra from a
+fitted model, refit every replicate with the models of dadi_demography.py
+and report the distribution of the fitted parameters.
+
+Replicates are simulated either from a dadi fit (Poisson draws around
+theta * the model spectrum of the parameters in <output_dir>/<model>_results.txt)
+or, for 'fsc2-3'/'fsc2-4' and the other Demes models, with msprime (the
+folded site spectrum of a whole-genome simulation, see msprime/pubrhe_sfs.py;
+the msprime helpers are installed with `pip install -e .`).
+
+Simulations and refits run on one process pool as a pipeline: a replicate's
+refits are queued as soon as it is simulated, and at most max_in_flight
+tasks are submitted at any time, so memory stays bounded however many
+replicates are requested. Every replicate and refit start has its own seed
+derived from the run seed, so results do not depend on the number of
+processes.
+"""
+import collections
+import multiprocessing
+import os
+import queue
+import re
+import time
+import dadi
+import numpy as np
+import dadi_parallel
+import dadi_demography
+
+output_dir = dadi_demography.output_dir # where the dadi_demography.py results are
+data_fs = dadi_demography.data_fs
+pts_l = dadi_demography.pts_l
+bootstrap_dir = f"{output_dir}/bootstrap"
+n_boot = 100 # bootstrap replicates per source model
+n_starts = 3 # refit starts per replicate and model (start 0 is the original fit)
+n_processes = os.cpu_count() # worker processes; 1 runs everything serially
+max_in_flight = None # tasks submitted at once; None is 2 * n_processes
+seed = None # run seed; None picks (and prints) one
+# source model -> models refit to its replicates
+sources = {
+    'three_changes': ['three_changes'],
+    'four_changes': ['four_changes'],
+    'fsc2-3': ['three_changes'],
+    'fsc2-4': ['four_changes'],
+}
+# msprime simulation of the Demes sources (as in pubrhe_msprimeSimulations_v0.03.py)
+sim_length = 223000000
+sim_recomb_rate = 1e-8
+sim_mut_rate = 1.08e-8
+sim_segments = 1
+
+def read_fitted_params(output_dir, name):
+    """
+    Best parameters of a model from <output_dir>/<name>_results.txt, or None
+    if the model has not been fit.
+    """
+    path = f"{output_dir}/{name}_results.txt"
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        for line in f:
+            if line.startswith('Parameters:'):
+                # values may be written as 1.5 or np.float64(1.5)
+                return [float(v) for v in re.findall(
+                    r":\s*(?:np\.float64\()?([-+0-9.eE]+|nan|inf)", line)]
+    return None
+
+class DadiSimulator:
+    """
+    Poisson replicates around theta * model spectrum of a fitted dadi model.
+    """
+    def __init__(self, model, params, theta, ns, pts_l):
+        self.name = model['name']
+        func_ex = dadi.Numerics.make_extrap_log_func(model['func'])
+        self.expected = theta * func_ex(params, ns, pts_l)
+
+    def __call__(self, seed):
+        rng = np.random.default_rng(seed)
+        counts = rng.poisson(np.asarray(self.expected.filled(0)))
+        return dadi.Spectrum(counts, mask=self.expected.mask).fold()
+
+class MsprimeSimulator:
+    """
+    Folded site spectrum of an msprime simulation of a Demes model
+    (fsc2-3, fsc2-4 or a demes/*.yaml file), as written by the msprime script.
+    """
+    def __init__(self, name, sequence_length=sim_length, recomb_rate=sim_recomb_rate,
+                 mut_rate=sim_mut_rate, n_segments=sim_segments):
+        self.name = name
+        self.sequence_length = sequence_length
+        self.recomb_rate = recomb_rate
+        self.mut_rate = mut_rate
+        self.n_segments = n_segments
+
+    def __call__(self, seed):
+        # msprime helpers (pip install -e . from the top of the repository),
+        # only needed for these sources
+        import pubrhe_demes
+        import pubrhe_segments
+        import pubrhe_sfs
+        _, compiled = pubrhe_demes.load_model(self.name, cache_dir=os.path.join(pubrhe_demes.DEMES_DIR, '.compiled'))
+        segments = pubrhe_segments.simulate_segments(
+            compiled['demography'], compiled['samples'], self.sequence_length, self.recomb_rate,
+            self.mut_rate, seed, n_segments=self.n_segments,
+            write_segment=pubrhe_sfs.SegmentSfs())
+        sfs = pubrhe_sfs.add_sfs(segments)['site']
+        return dadi.Spectrum(sfs).fold()
+
+def replicate_seeds(seed, n_sources, n_boot, n_fits):
+    """
+    (simulation seed, [refit seeds]) of every replicate, derived from one run
+    seed. Returns an (n_sources, n_boot) nested list.
+    """
+    seeds = []
+    for source_ss in np.random.SeedSequence(seed).spawn(n_sources):
+        reps = []
+        for rep_ss in source_ss.spawn(n_boot):
+            fit_seeds = [int(c.generate_state(1)[0]) for c in rep_ss.spawn(n_fits)]
+            reps.append((int(rep_ss.generate_state(1)[0]), fit_seeds))
+        seeds.append(reps)
+    return seeds
+
+def _simulate(task):
+    source, rep, simulator, sim_seed, fits = task
+    t0 = time.time()
+    return 'sim', (source, rep, simulator(sim_seed), fits, time.time() - t0)
+
+def _refit(task):
+    source, rep, fs, model, start, fit_seed, pts_l, maxiter = task
+    rec = dadi_parallel.fit_start(fs, model, pts_l, fit_seed, start,
+                                  dadi_parallel.perturb_uniform, maxiter)
+    del rec['model_fs']
+    rec['source'] = source
+    rec['rep'] = rep
+    return 'fit', rec
+
+def run_pipeline(sim_tasks, processes, max_in_flight=None, on_record=None):
+    """
+    Run simulation tasks (source, rep, simulator, seed, fits) and the refit
+    tasks they produce on one pool, fits first, with at most max_in_flight
+    tasks submitted at a time. fits = [(model, start, fit seed, pts_l, maxiter)].
+    Returns the refit records in completion order.
+    """
+    sims = collections.deque(sim_tasks)
+    fits = collections.deque()
+    records = []
+    def handle(kind, result):
+        if kind == 'sim':
+            source, rep, fs, fit_list, wall = result
+            print(f"  {source} replicate {rep+1}: simulated ({wall:.1f} s, S = {fs.S():.0f})", flush=True)
+            for model, start, fit_seed, pts, maxiter in fit_list:
+                fits.append((source, rep, fs, model, start, fit_seed, pts, maxiter))
+        else:
+            records.append(result)
+            if on_record is not None:
+                on_record(result)
+    if processes <= 1:
+        while sims or fits:
+            if fits:
+                handle(*_refit(fits.popleft()))
+            else:
+                handle(*_simulate(sims.popleft()))
+        return records
+    if max_in_flight is None:
+        max_in_flight = 2 * processes
+    done = queue.Queue()
+    in_flight = 0
+    with multiprocessing.Pool(processes) as pool:
+        while sims or fits or in_flight:
+            # refits free their replicate's spectrum, so they go before new simulations
+            while in_flight < max_in_flight and (fits or sims):
+                func, task = (_refit, fits.popleft()) if fits else (_simulate, sims.popleft())
+                pool.apply_async(func, (task,), callback=done.put,
+                                 error_callback=lambda e: done.put(('error', e)))
+                in_flight += 1
+            kind, result = done.get()
+            in_flight -= 1
+            if kind == 'error':
+                raise result
+            handle(kind, result)
+    return records
+
+def summarize(records, models):
+    """
+    Best start of every (source, replicate, model), and per (source, model)
+    the mean, standard deviation and 2.5/50/97.5 percentiles of every
+    parameter and theta.
+    """
+    best = {}
+    for r in records:
+        key = (r['source'], r['rep'], r['model'])
+        if key not in best or r['ll'] > best[key]['ll'] or (r['ll'] == best[key]['ll'] and r['start'] < best[key]['start']):
+            best[key] = r
+    summary = {}
+    for (source, rep, name), r in sorted(best.items()):
+        summary.setdefault((source, name), []).append(list(r['popt']) + [r['theta']])
+    table = {}
+    for (source, name), values in summary.items():
+        values = np.array(values)
+        cols = models[name]['param_names'] + ['theta']
+        table[(source, name)] = {
+            col: {'mean': np.mean(values[:, i]), 'sd': np.std(values[:, i], ddof=1) if len(values) > 1 else np.nan,
+                  'q2.5': np.percentile(values[:, i], 2.5), 'median': np.median(values[:, i]),
+                  'q97.5': np.percentile(values[:, i], 97.5)}
+            for i, col in enumerate(cols)}
+    return best, table
+
+if __name__ == '__main__':
+    os.makedirs(bootstrap_dir, exist_ok=True)
+    models = {m['name']: m for m in dadi_demography.models}
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    print(f"Run seed: {seed}")
+    data = dadi_parallel.load_folded(data_fs)
+
+    # refit models start from their original fit when there is one
+    refit_models = {}
+    for name in set(n for names in sources.values() for n in names):
+        model = dict(models[name])
+        popt = read_fitted_params(output_dir, name)
+        if popt is not None:
+            model['initial_values'] = popt
+        refit_models[name] = model
+
+    seeds = replicate_seeds(seed, len(sources), n_boot, max(len(v) for v in sources.values()) * n_starts)
+    sim_tasks = []
+    for si, (source, names) in enumerate(sources.items()):
+        if source in models:
+            popt = read_fitted_params(output_dir, source)
+            if popt is None:
+                print(f"No fit of {source} in {output_dir}, skipped")
+                continue
+            func_ex = dadi.Numerics.make_extrap_log_func(models[source]['func'])
+            theta = dadi.Inference.optimal_sfs_scaling(func_ex(popt, data.sample_sizes, pts_l), data)
+            simulator = DadiSimulator(models[source], popt, theta, data.sample_sizes, pts_l)
+        else:
+            simulator = MsprimeSimulator(source)
+        for rep in range(n_boot):
+            sim_seed, fit_seeds = seeds[si][rep]
+            fits = [(refit_models[name], start, fit_seeds[mi * n_starts + start], pts_l, 100)
+                    for mi, name in enumerate(names) for start in range(n_starts)]
+            sim_tasks.append((source, rep, simulator, sim_seed, fits))
+
+    with open(f"{bootstrap_dir}/bootstrap_starts.txt", 'w') as out:
+        out.write("source\trep\tmodel\tstart\tlog_likelihood\ttheta\tparameters\n")
+        def write_record(r):
+            out.write(f"{r['source']}\t{r['rep']}\t{r['model']}\t{r['start']}\t{r['ll']}\t{r['theta']}\t"
+                      f"{','.join(repr(float(p)) for p in r['popt'])}\n")
+            out.flush()
+        records = run_pipeline(sim_tasks, n_processes, max_in_flight, on_record=write_record)
+
+    best, table = summarize(records, models)
+    with open(f"{bootstrap_dir}/bootstrap_summary.txt", 'w') as f:
+        for (source, name), cols in table.items():
+            n = sum(1 for key in best if key[0] == source and key[2] == name)
+            f.write(f"Source: {source}, refit model: {name}, replicates: {n}\n")
+            f.write("parameter\tmean\tsd\t2.5%\tmedian\t97.5%\n")
+            for col, s in cols.items():
+                f.write(f"{col}\t{s['mean']:.6g}\t{s['sd']:.6g}\t{s['q2.5']:.6g}\t{s['median']:.6g}\t{s['q97.5']:.6g}\n")
+            f.write("\n")
+    print(open(f"{bootstrap_dir}/bootstrap_summary.txt").read())
@@ -0,0 +1,153 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi model spectrum cache
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Memoization layer for extrapolated model functions (func_ex).
+
+Model spectra are keyed on (model name, model function, rounded params, ns, pts_l).
+The most recent spectra are kept in an in-memory LRU, and optionally every
+spectrum is also written to a directory so that later runs (re-fits, AIC
+comparison passes, plotting) reuse integrations that were already done.
+The integrations themselves are timed per grid size (timings(), used by
+dadi_trace.py).
+"""
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+import dadi
+
+def round_params(params, digits=12):
+    """
+    Parameters rounded to <digits> significant digits, as a tuple.
+    """
+    return tuple(float(f"{float(p):.{digits}g}") for p in params)
+
+def make_key(name, func, params, ns, pts_l, digits=12):
+    """
+    Cache key for one model evaluation. Parameters are rounded to <digits>
+    significant digits so that starts converging to the same optimum share
+    entries.
+    """
+    func_id = f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+    return (name, func_id, round_params(params, digits), tuple(int(n) for n in ns),
+            tuple(int(p) for p in pts_l))
+
+class CachedExtrapFunc:
+    """
+    Drop-in replacement for dadi.Numerics.make_extrap_log_func(func).
+    name = model name used in the cache key
+    func = model function (params, ns, pts)
+    maxsize = number of spectra kept in memory
+    cache_dir = optional directory for the on-disk store (shared between processes;
+                one file per spectrum, never pruned)
+    digits = significant digits kept when rounding params for the key
+    """
+    def __init__(self, name, func, maxsize=1024, cache_dir=None, digits=12):
+        self.name = name
+        self.func = func
+        self.func_ex = dadi.Numerics.make_extrap_log_func(self._integrate)
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.digits = digits
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.grid_time = {}
+        if cache_dir is not None:
+            os.makedirs(os.path.join(cache_dir, name), exist_ok=True)
+
+    def __call__(self, params, ns, *args, **kwargs):
+        # same calling convention as func_ex: the grid sizes are either the
+        # last positional argument or the 'pts' keyword (used by optimize_log)
+        if 'pts' in kwargs:
+            pts_l = kwargs['pts']
+            extra_args = args
+            extra_kwargs = {k: v for k, v in kwargs.items() if k != 'pts'}
+        else:
+            pts_l = args[-1]
+            extra_args = args[:-1]
+            extra_kwargs = kwargs
+        key = make_key(self.name, self.func, params, ns, pts_l, self.digits)
+        if extra_args or extra_kwargs:
+            key = key + (repr(extra_args), repr(sorted(extra_kwargs.items())))
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key].copy()
+        fs = self._load(key)
+        if fs is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            fs = self.func_ex(params, ns, *args, **kwargs)
+            self._store(key, fs)
+        self.memory[key] = fs
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+        return fs.copy()
+
+    def _integrate(self, *args, **kwargs):
+        # model function on one grid size (the last argument), timed per grid size
+        t0 = time.perf_counter()
+        fs = self.func(*args, **kwargs)
+        entry = self.grid_time.setdefault(int(args[-1]), [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.perf_counter() - t0
+        return fs
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, self.name, digest + '.pkl')
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                stored_key, fs = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # guard against hash collisions
+        return fs if stored_key == key else None
+
+    def _store(self, key, fs):
+        if self.cache_dir is None:
+            return
+        # write to a temporary file and rename, so concurrent workers never
+        # read a partial entry
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((key, fs), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def stats(self):
+        """
+        Hit/miss counters since this cache was created.
+        """
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+    def timings(self):
+        """
+        {grid size: (integrations, seconds)} since this cache was created.
+        """
+        return {pts: tuple(entry) for pts, entry in self.grid_time.items()}
+
+# one cache per model in each process, so the LRU survives across starts
+_caches = {}
+
+def cached_extrap_func(model, cache_dir=None, maxsize=1024):
+    """
+    Cached func_ex for a model dictionary, shared by all starts of that model
+    run in this process.
+    """
+    key = (model['name'], cache_dir)
+    if key not in _caches:
+        _caches[key] = CachedExtrapFunc(model['name'], model['func'],
+                                        maxsize=maxsize, cache_dir=cache_dir)
+    return _caches[key]
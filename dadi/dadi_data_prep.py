@@ -7,20 +7,28 @@ Script to prepare the inputs (data dictionary) needed for analyses in dadi, and
 """
 import dadi
 import matplotlib.pyplot as plt
+import os
 import sys
+import dadi_sfs_stream
 
-datafile = '[/path/to/sequencing/data.]vcf' # chromosome data
+datafile = '[/path/to/sequencing/data.]vcf' # chromosome data (.vcf or (b)gzipped .vcf.gz), or a list of per-contig VCFs
 popfile = '[/path/to/population/file].txt' # text file that assigns individuals with their population id 
-dd = dadi.Misc.make_data_dict_vcf(datafile, popfile)
+n_processes = os.cpu_count() # worker processes for parsing the VCF(s)
 
 pop_ids = ["pop1"]
 ns_full = [158]  
-fs = dadi.Spectrum.from_data_dict(dd, pop_ids, ns_full, polarized=False)
-fs.to_file('[SFS-file-name].fs')
 
-# plot SFS
-fig = plt.figure(figsize=(10, 6))
-dadi.Plotting.plot_1d_fs(fs)
-plt.title('SFS (folded)')
-plt.savefig('[folded_sfs_plot_name].png')
-plt.close()
+if __name__ == '__main__':
+    # streams the VCF in chunks instead of building dadi.Misc.make_data_dict_vcf's
+    # per-SNP dictionary; the spectrum matches from_data_dict's. The guard
+    # keeps the parsing workers (spawned on macOS/Windows) from re-running the script
+    fs = dadi_sfs_stream.sfs_from_vcf(datafile, popfile, pop_ids, ns_full, polarized=False,
+                                      processes=n_processes)
+    fs.to_file('[SFS-file-name].fs')
+
+    # plot SFS
+    fig = plt.figure(figsize=(10, 6))
+    dadi.Plotting.plot_1d_fs(fs)
+    plt.title('SFS (folded)')
+    plt.savefig('[folded_sfs_plot_name].png')
+    plt.close()
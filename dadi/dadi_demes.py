@@ -0,0 +1,701 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Demes graphs compiled into dadi multi-population models
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Compiler from the Demes graphs of the 3-deme and 5-deme models (demes/) to
+dadi model functions for their 2D and 3D joint spectra, so that these models
+can be re-fitted with dadi_parallel.py on the pairwise .obs spectra without
+the fastsimcoal2 binary.
+
+The free parameters of a graph are marked in a sidecar file next to its .est
+priors, fastsimcoal2/<k>-deme/tpl-and-est/<est name>.demes.json, so that the
+Demes files stay as they are; it holds (paths relative to the sidecar):
+    graph      the Demes YAML file it marks
+    est        the .est priors file
+    demes      deme names in the order of the .tpl and .obs files
+    parameters graph field -> .est parameter, e.g.
+               'Ancestral_2.end_time': '$T1'; fields are <deme>.start_size,
+               <deme>.end_size, <deme>.start_time, <deme>.end_time,
+               <deme>.epochs.<i>.<start_size|end_size|end_time> and
+               migrations.<i>.<rate|start_time|end_time>
+The sidecar of a YAML file is found by its 'graph' entry.
+Complex .est parameters (%min%, %max%, + - * /), paramInRange bounds and
+[RULES] are evaluated as fastsimcoal2 does; a parameter vector that breaks a
+range or rule, or gives a deme a negative duration, gets a NaN spectrum,
+which dadi's optimizers treat as out of bounds.
+
+compile_model(graph, samples) prunes the graph to the sampled demes (at most
+3) and their ancestors and returns a DemesModel, whose free parameters are
+the .est parameters of the pruned graph, in dadi units: with S the size of
+the root deme in gene copies (the .est and graph sizes are haploid, as in
+fastsimcoal2), nu = size/S, T = generations/S and M = S*rate. The root size
+itself is absorbed by theta (theta = 2*S*mu*L); model_dict() gives the
+bounds and initial values (the graph's values) for dadi_parallel.fit_models,
+and DemesModel.est_values() converts fitted parameters back to .est units.
+Pulses, demes with several ancestors and migrations with a pruned deme are
+not supported.
+
+fit_obs() fits every pairwise (or 3-deme) spectrum separately: each gives its
+own estimates of the parameters of its pruned graph, as fastsimcoal2 would
+for that spectrum alone. There is no joint (composite likelihood) fit over
+the spectra of a model; compare or combine the per-spectrum fits downstream.
+
+Compiled models are cached by the topology of the pruned graph (with its
+constants and priors) and the samples, and phi is cached at every split
+event: parameter vectors that share the history up to a split (e.g. the
+optimizer's gradient steps on the recent parameters) integrate it once.
+
+    python dadi_demes.py ../demes/3-deme_brvFirst.yaml OBS [OBS ...]
+        [--output-dir DIR] [--starts N] [--processes P] [--pts ...]
+"""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+import glob
+import dadi
+import demes
+import numpy as np
+import dadi_fsc_obs
+import dadi_parallel
+
+MAX_DIMS = 3
+# sidecar files of the marked graphs
+MARKING_GLOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fastsimcoal2',
+                            '*', 'tpl-and-est', '*.demes.json')
+# bytes of phi kept per process at split events
+PHI_CACHE_BYTES = 256 * 2**20
+
+##### .est priors
+
+_ops = {'%min%': min, '%max%': max, '+': lambda a, b: a + b, '-': lambda a, b: a - b,
+        '*': lambda a, b: a * b, '/': lambda a, b: a / b}
+_rule_ops = {'<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+             '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+
+def _bound(token):
+    return token if token.startswith('$') else float(token)
+
+def parse_est(path):
+    """
+    Read a fastsimcoal2 .est file. Returns a dictionary with
+    'params' = {name: {'dist', 'min', 'max'}}, the bounds being numbers or
+               the names of other parameters (paramInRange)
+    'complex' = {name: [operand, op, operand, ...]}, in file order
+    'rules' = [(a, op, b)]
+    """
+    est = {'params': {}, 'complex': {}, 'rules': []}
+    section = None
+    with open(path) as f:
+        for line in f:
+            line = line.split('//')[0].strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                section = line.strip('[]').upper()
+                continue
+            tokens = line.split()
+            if section == 'PARAMETERS':
+                est['params'][tokens[1]] = {'dist': tokens[2], 'min': _bound(tokens[3]),
+                                            'max': _bound(tokens[4])}
+            elif section == 'COMPLEX PARAMETERS':
+                expr = [t for t in tokens[3:] if t not in ('output', 'hide') and not t.startswith('output')]
+                if len(expr) % 2 == 0 or any(op not in _ops for op in expr[1::2]):
+                    raise ValueError(f"Unsupported complex parameter in {path}: {line}")
+                est['complex'][tokens[1]] = [t if i % 2 else _bound(t) if t[0] in '$0123456789.' else t
+                                             for i, t in enumerate(expr)]
+            elif section == 'RULES':
+                if len(tokens) != 3 or tokens[1] not in _rule_ops:
+                    raise ValueError(f"Unsupported rule in {path}: {line}")
+                est['rules'].append(tuple(tokens))
+    return est
+
+def eval_complex(expr, values):
+    """
+    Value of a complex parameter, evaluated left to right as fastsimcoal2 does.
+    """
+    def get(x):
+        return values[x] if isinstance(x, str) else x
+    result = get(expr[0])
+    for op, x in zip(expr[1::2], expr[2::2]):
+        result = _ops[op](result, get(x))
+    return result
+
+##### graph fields
+
+def _field_key(graph, field):
+    """
+    Canonical (deme or 'migrations', index, attribute) of a marked field.
+    """
+    parts = field.split('.')
+    if parts[0] == 'migrations':
+        return ('migrations', int(parts[1]), parts[2])
+    deme = graph[parts[0]]
+    last = len(deme.epochs) - 1
+    if len(parts) == 2:
+        attr = parts[1]
+        if attr == 'start_time':
+            return (deme.name, None, 'start_time')
+        index = 0 if attr == 'start_size' else last
+        return (deme.name, index, attr)
+    index = int(parts[2])
+    return (deme.name, index if index >= 0 else last + 1 + index, parts[3])
+
+def find_marking(path):
+    """
+    Sidecar file (see MARKING_GLOB) that marks the YAML file path.
+    """
+    if path is None:
+        raise ValueError("The path of the YAML file is needed to find its fsc2 parameters")
+    for sidecar in sorted(glob.glob(MARKING_GLOB)):
+        with open(sidecar) as f:
+            graph_path = os.path.join(os.path.dirname(sidecar), json.load(f)['graph'])
+        if os.path.isfile(graph_path) and os.path.samefile(graph_path, path):
+            return sidecar
+    raise ValueError(f"No fsc2 parameters for {path} (no .demes.json sidecar next to the .est files)")
+
+def read_marking(graph, path):
+    """
+    fsc2 parameters of a graph loaded from path, from its sidecar file, with
+    the .est file parsed.
+    """
+    sidecar = find_marking(path)
+    with open(sidecar) as f:
+        meta = json.load(f)
+    est_path = os.path.join(os.path.dirname(sidecar), meta['est'])
+    marked = {_field_key(graph, f): p for f, p in meta['parameters'].items()}
+    return {'est': parse_est(est_path), 'demes': list(meta['demes']), 'fields': marked}
+
+def prune(graph, samples):
+    """
+    Names of the sampled demes and their ancestors, in graph order.
+    """
+    keep = set()
+    todo = list(samples)
+    while todo:
+        name = todo.pop()
+        if name not in keep:
+            keep.add(name)
+            todo += graph[name].ancestors
+    return [d.name for d in graph.demes if d.name in keep]
+
+##### compiled models
+
+class DemesModel:
+    """
+    dadi model function (params, ns, pts) of the joint spectrum of samples
+    (in that axis order) under a pruned Demes graph. Built by compile_model.
+    skeleton = demes and migrations, every field a constant (dadi units) or
+               the name of an .est parameter
+    est = parsed .est; kinds = unit ('size', 'time' or 'rate') of every used
+    .est parameter; ref = root size (.est parameter name or constant);
+    scale = root size of the graph, the unit of the bounds and initial values
+    """
+    def __init__(self, skeleton, samples, est, kinds, ref, scale, param_names, key):
+        self.skeleton = skeleton
+        self.samples = list(samples)
+        self.est = est
+        self.kinds = kinds
+        self.ref = ref
+        self.scale = scale
+        self.param_names = list(param_names)
+        self.key = key
+        # dadi.Numerics.make_extrap_log_func copies the name; the spectrum
+        # cache keys on the qualified name
+        self.__name__ = 'demes_' + '_'.join(self.samples)
+        self.__qualname__ = f"DemesModel.{key[:16]}"
+
+    def __repr__(self):
+        return f"DemesModel({self.samples}, {self.param_names})"
+
+    def _factor(self, kind):
+        """
+        .est units per dadi unit.
+        """
+        return 1.0 / self.scale if kind == 'rate' else self.scale
+
+    def est_values(self, params, scale=None):
+        """
+        Values of all used .est parameters for a dadi parameter vector, with
+        root size scale (gene copies; default the graph's, or 2*theta/(4*mu*L)
+        from a fit).
+        """
+        scale = self.scale if scale is None else scale
+        factor = {'rate': 1.0 / scale, 'size': scale, 'time': scale}
+        values = {}
+        if isinstance(self.ref, str):
+            values[self.ref] = scale
+        for name, p in zip(self.param_names, params):
+            values[name] = float(p) * factor[self.kinds[name]]
+        for name, expr in self.est['complex'].items():
+            if name in self.kinds:
+                values[name] = eval_complex(expr, values)
+        return values
+
+    def _valid(self, values):
+        for name in self.param_names:
+            prior = self.est['params'].get(name)
+            if prior is None:
+                continue
+            if isinstance(prior['min'], str) and values[name] < values[prior['min']]:
+                return False
+            if isinstance(prior['max'], str) and values[name] > values[prior['max']]:
+                return False
+        for a, op, b in self.est['rules']:
+            if a in values and b in values and not _rule_ops[op](values[a], values[b]):
+                return False
+        return True
+
+    def plan(self, params):
+        """
+        Operations building phi for a parameter vector, and the number of
+        operations done at each split (the points where phi is cached), or
+        None if the parameters are not valid.
+        """
+        values = self.est_values(params)
+        if not self._valid(values):
+            return None
+        dadi_values = {n: v / self._factor(self.kinds[n]) for n, v in values.items()}
+        def get(x):
+            return dadi_values[x] if isinstance(x, str) else x
+        demes_ = []
+        times = {0.0}
+        for d in self.skeleton['demes']:
+            start = get(d['start_time'])
+            epochs = []
+            for e in d['epochs']:
+                end = get(e['end_time'])
+                epochs.append((start, end, get(e['start_size']), get(e['end_size']), e['size_function']))
+                if end > start:
+                    return None
+                times.add(end)
+                start = end
+            demes_.append({'name': d['name'], 'ancestor': d['ancestor'], 'start': get(d['start_time']),
+                           'end': epochs[-1][1], 'epochs': epochs})
+            if d['ancestor'] is not None:
+                times.add(demes_[-1]['start'])
+        migrations = []
+        for m in self.skeleton['migrations']:
+            start, end = get(m['start_time']), get(m['end_time'])
+            if end > start:
+                return None
+            migrations.append((m['source'], m['dest'], start, end, get(m['rate'])))
+            times.update(t for t in (start, end) if np.isfinite(t))
+        by_name = {d['name']: d for d in demes_}
+        for d in demes_:
+            if d['ancestor'] is not None:
+                a = by_name[d['ancestor']]
+                if not a['start'] >= d['start'] >= a['end']:
+                    return None
+        times = sorted((t for t in times if np.isfinite(t)), reverse=True)
+        root = demes_[0]
+        ops = [('phi_1D', _round(root['epochs'][0][2]))]
+        marks = []
+        axes = [root['name']]
+        for hi, lo in zip([None] + times[:-1], times):
+            if hi is not None and hi > lo:
+                ops.append(_integrate_op(hi, lo, [by_name[a] for a in axes], migrations, axes))
+            split = False
+            # axis of every ancestor ending now, taken over by its first child
+            taken = {}
+            for d in demes_:
+                if d['ancestor'] is None or d['start'] != lo:
+                    continue
+                a = d['ancestor']
+                if a in axes:
+                    parent = axes.index(a)
+                    if by_name[a]['end'] == lo:
+                        axes[parent] = d['name']
+                        taken[a] = parent
+                        continue
+                else:
+                    parent = taken[a]
+                if len(axes) == MAX_DIMS:
+                    raise ValueError(f"More than {MAX_DIMS} demes of the pruned graph exist at once")
+                ops.append(('split', len(axes), parent))
+                axes.append(d['name'])
+                split = True
+            for i in reversed(range(len(axes))):
+                d = by_name[axes[i]]
+                if d['end'] == lo and lo > 0:
+                    ops.append(('marginalize', i))
+                    axes.pop(i)
+            if split:
+                marks.append(len(ops))
+        return ops, marks, axes
+
+    def __call__(self, params, ns, pts):
+        planned = self.plan(params)
+        xx = _grid(pts)
+        if planned is None:
+            fs = dadi.Spectrum(np.full([n + 1 for n in ns], np.nan), pop_ids=self.samples)
+            # as from_phi, for the extrapolation
+            fs.extrap_x = xx[1]
+            return fs
+        ops, marks, axes = planned
+        # longest cached prefix ending at a split
+        phi = None
+        done = 0
+        for k in reversed(marks):
+            phi = _phi_get((self.key, pts, tuple(ops[:k])))
+            if phi is not None:
+                done = k
+                break
+        for i in range(done, len(ops)):
+            phi = _apply(ops[i], phi, xx)
+            if i + 1 in marks:
+                _phi_put((self.key, pts, tuple(ops[:i+1])), phi)
+        order = [axes.index(s) for s in self.samples]
+        if len(order) > 1:
+            phi = np.transpose(phi, order)
+        return dadi.Spectrum.from_phi(phi, list(ns), [xx] * len(ns), pop_ids=self.samples)
+
+def _round(x, digits=12):
+    return float(f"{float(x):.{digits}g}")
+
+def _size_at(epochs, t):
+    """
+    (size at t, size function) of the epoch of a deme containing time t.
+    """
+    for start, end, s0, s1, fn in epochs:
+        if end <= t <= start:
+            if fn == 'constant' or s0 == s1:
+                return s0, 'constant'
+            if fn == 'exponential':
+                return s0 * (s1 / s0) ** ((start - t) / (start - end)), fn
+            return s0 + (s1 - s0) * (start - t) / (start - end), fn
+    raise ValueError(f"No epoch at time {t}")
+
+def _integrate_op(hi, lo, demes_, migrations, axes):
+    """
+    Integration of the active demes from time hi to lo: ('integrate', T,
+    ((function, size at hi, size at lo), ...), migration rates in dadi's order).
+    """
+    mid = (hi + lo) / 2
+    sizes = []
+    for d in demes_:
+        epochs = [e for e in d['epochs'] if e[1] <= mid <= e[0]]
+        a, fn = _size_at(epochs, hi)
+        b, _ = _size_at(epochs, lo)
+        sizes.append((fn, _round(a), _round(b)))
+    names = [d['name'] for d in demes_]
+    rates = []
+    for i in range(len(names)):
+        for j in range(len(names)):
+            if i != j:
+                # dadi's m_ij: into deme i from deme j, forwards in time
+                rates.append(_round(sum(r for src, dest, start, end, r in migrations
+                                        if dest == names[i] and src == names[j] and end <= mid <= start)))
+    return ('integrate', _round(hi - lo), tuple(sizes), tuple(rates))
+
+def _nu(size, T):
+    fn, a, b = size
+    if fn == 'constant':
+        return a
+    if fn == 'exponential':
+        return lambda t: a * (b / a) ** (t / T)
+    return lambda t: a + (b - a) * t / T
+
+def _apply(op, phi, xx):
+    if op[0] == 'phi_1D':
+        return dadi.PhiManip.phi_1D(xx, nu=op[1])
+    if op[0] == 'split':
+        _, dims, parent = op
+        if dims == 1:
+            return dadi.PhiManip.phi_1D_to_2D(xx, phi)
+        split = dadi.PhiManip.phi_2D_to_3D_split_1 if parent == 0 else dadi.PhiManip.phi_2D_to_3D_split_2
+        return split(xx, phi)
+    if op[0] == 'marginalize':
+        return dadi.Numerics.trapz(phi, xx, axis=op[1])
+    _, T, sizes, rates = op
+    nus = [_nu(s, T) for s in sizes]
+    if len(nus) == 1:
+        return dadi.Integration.one_pop(phi, xx, T, nus[0])
+    if len(nus) == 2:
+        return dadi.Integration.two_pops(phi, xx, T, *nus, *rates)
+    return dadi.Integration.three_pops(phi, xx, T, *nus, *rates)
+
+# per-process caches of grids and of phi at split events
+_grids = {}
+_phi_cache = collections.OrderedDict()
+_phi_bytes = 0
+_phi_stats = {'hits': 0, 'misses': 0}
+
+def _grid(pts):
+    if pts not in _grids:
+        _grids[pts] = dadi.Numerics.default_grid(pts)
+    return _grids[pts]
+
+def _phi_get(key):
+    if key in _phi_cache:
+        _phi_cache.move_to_end(key)
+        _phi_stats['hits'] += 1
+        return _phi_cache[key]
+    _phi_stats['misses'] += 1
+    return None
+
+def _phi_put(key, phi):
+    global _phi_bytes
+    if key in _phi_cache:
+        return
+    _phi_cache[key] = phi
+    _phi_bytes += phi.nbytes
+    while _phi_bytes > PHI_CACHE_BYTES and len(_phi_cache) > 1:
+        _, old = _phi_cache.popitem(last=False)
+        _phi_bytes -= old.nbytes
+
+def phi_cache_stats():
+    """
+    Lookups of phi at split events in this process: hits, misses, entries, bytes.
+    """
+    return dict(_phi_stats, entries=len(_phi_cache), bytes=_phi_bytes)
+
+##### compiler
+
+_kind_of = {'start_size': 'size', 'end_size': 'size', 'start_time': 'time', 'end_time': 'time', 'rate': 'rate'}
+
+def _skeleton(graph, names, marked, scale):
+    """
+    Pruned graph with every field a constant in dadi units or a parameter
+    name; also returns {parameter: kind} of the marked fields.
+    """
+    kinds = {}
+    def field(key, value):
+        name = marked.get(key)
+        kind = _kind_of[key[2]]
+        if name is None:
+            if kind == 'rate':
+                return _round(value * scale)
+            return _round(value / scale) if np.isfinite(value) else float('inf')
+        if kinds.setdefault(name, kind) != kind:
+            raise ValueError(f"{name} sets both a {kinds[name]} and a {kind}")
+        return name
+    keep = set(names)
+    demes_ = []
+    ends = {}
+    for name in names:
+        d = graph[name]
+        if len(d.ancestors) > 1:
+            raise ValueError(f"Deme {name} has several ancestors")
+        ancestor = d.ancestors[0] if d.ancestors else None
+        if ancestor is not None and (name, None, 'start_time') not in marked \
+           and d.start_time == graph[ancestor].end_time:
+            start = ends[ancestor]
+        else:
+            start = field((name, None, 'start_time'), d.start_time)
+        epochs = []
+        for i, e in enumerate(d.epochs):
+            size = field((name, i, 'start_size'), e.start_size)
+            end_size = size if e.size_function == 'constant' else field((name, i, 'end_size'), e.end_size)
+            epochs.append({'end_time': field((name, i, 'end_time'), e.end_time), 'start_size': size,
+                           'end_size': end_size, 'size_function': e.size_function})
+        ends[name] = epochs[-1]['end_time']
+        demes_.append({'name': name, 'ancestor': ancestor, 'start_time': start, 'epochs': epochs})
+    migrations = []
+    for i, m in enumerate(graph.migrations):
+        if m.source in keep and m.dest in keep:
+            migrations.append({'source': m.source, 'dest': m.dest,
+                               'start_time': field(('migrations', i, 'start_time'), m.start_time),
+                               'end_time': field(('migrations', i, 'end_time'), m.end_time),
+                               'rate': field(('migrations', i, 'rate'), m.rate)})
+        elif m.source in keep or m.dest in keep:
+            raise ValueError(f"Migration between {m.source} and {m.dest} involves a pruned deme")
+    for p in graph.pulses:
+        if keep.intersection(p.sources + [p.dest]):
+            raise ValueError("Pulses are not supported")
+    return {'demes': demes_, 'migrations': migrations}, kinds
+
+def _used_params(est, kinds):
+    """
+    Kinds of all .est parameters the marked ones depend on (operands of
+    complex parameters, range bounds), marked ones included.
+    """
+    kinds = dict(kinds)
+    todo = list(kinds)
+    while todo:
+        name = todo.pop()
+        deps = []
+        if name in est['complex']:
+            deps = [x for x in est['complex'][name][::2] if isinstance(x, str)]
+        elif name in est['params']:
+            deps = [b for b in (est['params'][name]['min'], est['params'][name]['max']) if isinstance(b, str)]
+        else:
+            raise ValueError(f"{name} is not an .est parameter")
+        for dep in deps:
+            if dep not in kinds:
+                kinds[dep] = kinds[name]
+                todo.append(dep)
+    return kinds
+
+def _static_bound(est, name, which):
+    b = est['params'][name][which]
+    return _static_bound(est, b, which) if isinstance(b, str) else b
+
+# compiled models by topology signature
+_compiled = {}
+
+def compile_model(graph, samples, path=None):
+    """
+    DemesModel of the joint spectrum of samples (deme names, at most 3, in
+    the axis order of the spectrum) under graph (a demes.Graph loaded from
+    path, or the path of a YAML file with a sidecar), and its initial values (dadi units,
+    from the graph). Models are cached by the signature of the pruned graph.
+    """
+    if isinstance(graph, str):
+        path = graph
+        graph = demes.load(path)
+    if not 1 <= len(samples) <= MAX_DIMS:
+        raise ValueError(f"dadi models need 1 to {MAX_DIMS} sampled demes")
+    marking = read_marking(graph, path)
+    names = prune(graph, samples)
+    roots = [n for n in names if not graph[n].ancestors]
+    if len(roots) != 1:
+        raise ValueError("The pruned graph must have a single root deme")
+    root = graph[roots[0]]
+    if names[0] != root.name:
+        names.remove(root.name)
+        names.insert(0, root.name)
+    scale = float(root.epochs[0].start_size)
+    skeleton, kinds = _skeleton(graph, names, marking['fields'], scale)
+    ref = skeleton['demes'][0]['epochs'][0]['start_size']
+    if isinstance(ref, str) and ref in marking['est']['complex']:
+        raise ValueError(f"The root size {ref} must be a simple parameter")
+    est = marking['est']
+    kinds = _used_params(est, kinds)
+    param_names = [n for n in est['params'] if n in kinds and n != ref]
+    used_est = {'params': {n: p for n, p in est['params'].items() if n in kinds},
+                'complex': {n: e for n, e in est['complex'].items() if n in kinds},
+                'rules': [r for r in est['rules'] if r[0] in kinds and r[2] in kinds]}
+    signature = json.dumps([skeleton, list(samples), used_est, kinds, ref, scale], sort_keys=True, default=str)
+    key = hashlib.sha1(signature.encode()).hexdigest()
+    if key not in _compiled:
+        _compiled[key] = DemesModel(skeleton, samples, used_est, kinds, ref, scale, param_names, key)
+    model = _compiled[key]
+    return model, _initial_values(model, graph, marking['fields'])
+
+def _initial_values(model, graph, marked):
+    """
+    dadi values of the free parameters that give the graph: the marked simple
+    parameters directly, the operands of %min%/%max% by inverting them, and
+    the rest midway between their bounds (given the others).
+    """
+    est = model.est
+    factor = {k: model._factor(k) for k in ('size', 'time', 'rate')}
+    values = {}
+    for (deme, index, attr), name in marked.items():
+        if name not in model.kinds:
+            continue
+        if deme == 'migrations':
+            value = getattr(graph.migrations[index], attr)
+        elif index is None:
+            value = graph[deme].start_time
+        else:
+            value = getattr(graph[deme].epochs[index], attr)
+        values[name] = float(value)
+    for op in ('%min%', '%max%'):
+        for name, expr in est['complex'].items():
+            if name in values and len(expr) == 3 and expr[1] == op:
+                a, b = expr[0], expr[2]
+                first, second = (a, b) if op == '%min%' else (b, a)
+                for x in (first, second):
+                    if isinstance(x, str) and x not in values:
+                        values[x] = values[name]
+                        break
+    for name in est['params']:
+        if name in values or name not in model.kinds:
+            continue
+        prior = est['params'][name]
+        lo = _static_bound(est, name, 'min')
+        hi = _static_bound(est, name, 'max')
+        for other, p in est['params'].items():
+            if other in values and p['max'] == name:
+                lo = max(lo, values[other])
+            if other in values and p['min'] == name:
+                hi = min(hi, values[other])
+        values[name] = np.sqrt(lo * hi) if prior['dist'] == 'logunif' else (lo + hi) / 2
+    return [values[n] / factor[model.kinds[n]] for n in model.param_names]
+
+def model_dict(graph, samples, path=None, name=None):
+    """
+    dadi_parallel model dictionary of the joint spectrum of samples: bounds
+    from the .est priors and initial values from the graph, in dadi units.
+    """
+    model, p0 = compile_model(graph, samples, path)
+    lower = [_static_bound(model.est, n, 'min') / model._factor(model.kinds[n]) for n in model.param_names]
+    upper = [_static_bound(model.est, n, 'max') / model._factor(model.kinds[n]) for n in model.param_names]
+    p0 = [min(max(v, lo), hi) for v, lo, hi in zip(p0, lower, upper)]
+    return {'name': name or model.__name__, 'func': model, 'param_names': model.param_names,
+            'lower_bound': lower, 'upper_bound': upper, 'initial_values': p0}
+
+##### re-fitting the pairwise spectra
+
+def perturb_valid(model, start, tries=100):
+    """
+    dadi_parallel.perturb_uniform, drawn again until the start satisfies the
+    ranges and rules of the .est (falls back to the initial values).
+    """
+    for _ in range(tries):
+        p0 = dadi_parallel.perturb_uniform(model, start)
+        if model['func'].plan(p0) is not None:
+            return p0
+    return list(model['initial_values'])
+
+def fit_obs(yaml_path, obs_paths, output_dir, n_starts=3, processes=None, pts_l=None,
+            maxiter=100, seed=None, mu=1.08e-8, length=None):
+    """
+    Fit the model of yaml_path to every joint .obs spectrum separately (one
+    set of estimates per spectrum, no composite likelihood over them), one
+    spectrum at a time with the starts of each fit on a process pool. Each spectrum is written
+    as <output_dir>/<obs name>.fs and its fit to <output_dir>/<obs name>_fit.txt,
+    with the .est values of the best fit (root size from theta, mu and the
+    number of sites length; by default the total count of the .obs file).
+    Returns the summary of every fit.
+    """
+    graph = demes.load(yaml_path)
+    order = read_marking(graph, yaml_path)['demes']
+    os.makedirs(output_dir, exist_ok=True)
+    fits = []
+    for obs_path in obs_paths:
+        obs = dadi_fsc_obs.load_obs(obs_path)
+        samples = [order[p] for p in obs.pops]
+        stem = re.sub(r'\.obs$', '', os.path.basename(obs_path))
+        fs_path = os.path.join(output_dir, stem + '.fs')
+        dadi_fsc_obs.to_spectrum(obs, samples).to_file(fs_path)
+        model = model_dict(graph, samples, yaml_path, name=stem)
+        fit_pts = pts_l or [max(obs.sample_sizes) + k for k in (10, 20, 30)]
+        print(f"{stem}: {' x '.join(samples)}, {len(model['param_names'])} parameters", flush=True)
+        best = dadi_parallel.fit_models([model], fs_path, fit_pts, n_starts, perturb_valid, seed=seed,
+                                        processes=processes, maxiter=maxiter,
+                                        store=os.path.join(output_dir, 'fits.sqlite'))[0]['best']
+        sites = length if length is not None else float(np.sum(obs.data))
+        scale = best['theta'] / (2 * mu * sites)
+        values = model['func'].est_values(best['popt'], scale)
+        with open(os.path.join(output_dir, stem + '_fit.txt'), 'w') as f:
+            f.write(f"Model: {yaml_path} ({', '.join(samples)})\n")
+            f.write(f"Log-likelihood: {best['ll']}\n")
+            f.write(f"Theta: {best['theta']}\n")
+            f.write(f"Parameters: {dict(zip(model['param_names'], map(float, best['popt'])))}\n")
+            f.write(f"Root size: {scale} (mu = {mu}, {sites:g} sites)\n")
+            f.write(f".est values: { {n: float(v) for n, v in values.items()} }\n")
+        fits.append(best)
+    return fits
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fit a Demes model with fsc2 parameters to each joint .obs spectrum, separately, with dadi.")
+    parser.add_argument('yaml', help="Demes file with an fsc2 sidecar (e.g. ../demes/3-deme_brvFirst.yaml)")
+    parser.add_argument('obs', nargs='+', help="_jointMAFpopX_Y.obs files")
+    parser.add_argument('--output-dir', default='demes_fits')
+    parser.add_argument('--starts', type=int, default=3, help="optimization starts per spectrum")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--pts', default=None, help="grid sizes, e.g. 40,50,60 (default: n+10,n+20,n+30)")
+    parser.add_argument('--maxiter', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--mu', type=float, default=1.08e-8, help="mutation rate, for the root size")
+    parser.add_argument('--length', type=float, default=None, help="sites of the spectra (default: total .obs count)")
+    args = parser.parse_args()
+    pts_l = [int(p) for p in args.pts.split(',')] if args.pts else None
+    fit_obs(args.yaml, args.obs, args.output_dir, args.starts, args.processes, pts_l,
+            args.maxiter, args.seed, args.mu, args.length)
@@ -7,92 +7,52 @@ Script to run optimizations for the models
 """
 import dadi
 import numpy as np
-import matplotlib.pyplot as plt
 import os
+import dadi_models
+import dadi_parallel
+import dadi_halving
+import dadi_grids
+import dadi_uncert
+import dadi_trace
+import dadi_report
 output_dir = 'resize_models_results'
-os.makedirs(output_dir, exist_ok=True)
 data_fs = "[/path/to/dadi-formatted/SFS-file-name].fs"
-fs = dadi.Spectrum.from_file(data_fs)
-if not fs.folded:
-    fs = fs.fold()
 pts_l = [40, 50, 60] #grid points for extrapolation
+n_starts = 5 # optimization runs per model
+n_processes = os.cpu_count() # worker processes; 1 runs the starts serially
+seed = None # run seed for the per-start perturbations; None picks (and prints) one
+# optional on-disk model spectrum cache shared by the workers and later runs, e.g. f"{output_dir}/func_ex_cache";
+# it keeps one file per distinct evaluation and is never pruned. None keeps the spectra in memory only
+cache_dir = None
+store = f"{output_dir}/fits.sqlite" # finished starts are saved here and skipped when the run is restarted; None disables
+# successive halving: cumulative iteration budgets ending at maxiter (100), e.g. [10, 30, 100]; only the best
+# halving_keep fraction of each model's starts goes on to the next budget. None runs every start to maxiter
+halving_budgets = None
+halving_keep = 0.5
+# EXPERIMENTAL adaptive grids (see dadi_grids.py): early iterations on coarser grids than pts_l, finer ones only
+# where the extrapolation has not converged to within grid_tol log-likelihood units. Not a speedup so far (BFGS
+# restarts its Hessian estimate at every grid level). None uses pts_l for every evaluation
+grid_tol = None
+uncert_eps = 0.01 # step of the finite-difference FIM standard errors of the best fits; None skips them
+# per-start func_ex calls, optimizer calls and integration time per grid size, written to trace.json/.csv; None disables
+trace = f"{output_dir}/trace"
+profile_dir = None # folder for a cProfile dump of every start, e.g. f"{output_dir}/profiles"; None disables
+# draw the fit/residual plots and the AIC table (dadi_report.py) at the end of the run; False only saves
+# their inputs, for a later `python dadi_report.py <output_dir>`
+render_report = True
 
-# define the models to test
-# Model 0: No size change (constant population size)
-def no_change(params, ns, pts):
-    """
-    No size change model.
-    params = [nu]
-    ns = sample size
-    """
-    nu = params[0]
-    xx = dadi.Numerics.default_grid(pts)
-    phi = dadi.PhiManip.phi_1D(xx)
-    phi = dadi.Integration.one_pop(phi, xx, 5.0, nu)
-    fs = dadi.Spectrum.from_phi(phi, ns, [xx])
-    return fs
-    
-# Model 1: One size change
-def one_change(params, ns, pts):
-    """
-    One size change model.
-    params = [nu, T]
-    ns = sample size
-    """
-    nu, T = params
-    xx = dadi.Numerics.default_grid(pts)
-    phi = dadi.PhiManip.phi_1D(xx)
-    phi = dadi.Integration.one_pop(phi, xx, T, nu)
-    fs = dadi.Spectrum.from_phi(phi, ns, [xx])
-    return fs
-
-# Model 2: Two size changes
-def two_changes(params, ns, pts):
-    """
-    Two size changes model.
-    params = [nu1, nu2, T1, T2]
-    ns = sample size
-    """
-    nu1, nu2, T1, T2 = params
-    xx = dadi.Numerics.default_grid(pts)
-    phi = dadi.PhiManip.phi_1D(xx)
-    phi = dadi.Integration.one_pop(phi, xx, T1, nu1)
-    phi = dadi.Integration.one_pop(phi, xx, T2, nu2)
-    fs = dadi.Spectrum.from_phi(phi, ns, [xx])
-    return fs
-
-# Model 3: Three size changes
-def three_changes(params, ns, pts):
-    """
-    Three size changes model.
-    params = [nu1, nu2, nu3, T1, T2, T3]
-    ns = sample size
-    """
-    nu1, nu2, nu3, T1, T2, T3 = params
-    xx = dadi.Numerics.default_grid(pts)
-    phi = dadi.PhiManip.phi_1D(xx)
-    phi = dadi.Integration.one_pop(phi, xx, T1, nu1)
-    phi = dadi.Integration.one_pop(phi, xx, T2, nu2)
-    phi = dadi.Integration.one_pop(phi, xx, T3, nu3)
-    fs = dadi.Spectrum.from_phi(phi, ns, [xx])
-    return fs
-
-# Model 4: Four size changes
-def four_changes(params, ns, pts):
-    """
-    Four size changes model.
-    params = [nu1, nu2, nu3, nu4, T1, T2, T3, T4]
-    ns = sample size
-    """
-    nu1, nu2, nu3, nu4, T1, T2, T3, T4 = params
-    xx = dadi.Numerics.default_grid(pts)
-    phi = dadi.PhiManip.phi_1D(xx)
-    phi = dadi.Integration.one_pop(phi, xx, T1, nu1)
-    phi = dadi.Integration.one_pop(phi, xx, T2, nu2)
-    phi = dadi.Integration.one_pop(phi, xx, T3, nu3)
-    phi = dadi.Integration.one_pop(phi, xx, T4, nu4)
-    fs = dadi.Spectrum.from_phi(phi, ns, [xx])
-    return fs
+# define the models to test: piecewise-constant size models with 0-4 size
+# changes (see dadi_models.py), params = [nu1, ..., nun, T1, ..., Tn]
+# Model 0: No size change (constant population size), params = [nu]
+no_change = dadi_models.SizeChangeModel(0)
+# Model 1: One size change, params = [nu, T]
+one_change = dadi_models.SizeChangeModel(1)
+# Model 2: Two size changes, params = [nu1, nu2, T1, T2]
+two_changes = dadi_models.SizeChangeModel(2)
+# Model 3: Three size changes, params = [nu1, nu2, nu3, T1, T2, T3]
+three_changes = dadi_models.SizeChangeModel(3)
+# Model 4: Four size changes, params = [nu1, nu2, nu3, nu4, T1, T2, T3, T4]
+four_changes = dadi_models.SizeChangeModel(4)
 
 # model configurations
 models = [
@@ -138,81 +98,72 @@ models = [
     }
 ]
 
-# optimization for each model (five)
-results = []
-for model in models:
-    print(f"\nOptimizing {model['name']} model...")
-    func_ex = dadi.Numerics.make_extrap_log_func(model['func'])
-    best_p = None
-    best_ll = -np.inf
-    for i in range(5):
-        print(f"  Optimization run {i+1}/5")
-        if i == 0:
-            p0 = model['initial_values']
-        else:
-            p0 = [v * np.random.uniform(0.8, 1.2) for v in model['initial_values']]
-            p0 = [max(min(p0[j], model['upper_bound'][j]), model['lower_bound'][j]) 
-                  for j in range(len(p0))]
-        popt = dadi.Inference.optimize_log(
-            p0, fs, func_ex, pts_l,
-            lower_bound=model['lower_bound'],
-            upper_bound=model['upper_bound'],
-            verbose=False, maxiter=100
-        )
-        model_fs = func_ex(popt, fs.sample_sizes, pts_l)
-        ll = dadi.Inference.ll_multinom(model_fs, fs)
-        print(f"    log-likelihood: {ll}")
-        if ll > best_ll:
-            best_ll = ll
-            best_p = popt
-    k = len(model['param_names'])
-    aic = 2 * k - 2 * best_ll
-    best_model = func_ex(best_p, fs.sample_sizes, pts_l)
-    results.append({
-        'name': model['name'],
-        'parameters': dict(zip(model['param_names'], best_p)),
-        'log_likelihood': best_ll,
-        'AIC': aic,
-        'model_fs': best_model
-    })
-    with open(f"{output_dir}/{model['name']}_results.txt", 'w') as f:
-        f.write(f"Model: {model['name']}\n")
-        f.write(f"Parameters: {dict(zip(model['param_names'], best_p))}\n")
-        f.write(f"Log-likelihood: {best_ll}\n")
-        f.write(f"AIC: {aic}\n")
-# model vs data plot 
-    fig = plt.figure(figsize=(8, 6))
-    dadi.Plotting.plot_1d_comp_multinom(best_model, fs)
-    plt.title(f"{model['name']} (AIC = {aic:.2f})")
-    plt.savefig(f"{output_dir}/{model['name']}_fit.png", dpi=300)
-    plt.close()
+if __name__ == '__main__':
+    os.makedirs(output_dir, exist_ok=True)
+    fs = dadi_parallel.load_folded(data_fs)
 
-# Compare models by AIC
-results.sort(key=lambda x: x['AIC'])
-best_model = results[0]
-print("\n\nModel Comparison by AIC:")
-for result in results:
-    print(f"{result['name']}: AIC = {result['AIC']:.2f}, Δ AIC = {result['AIC'] - best_model['AIC']:.2f}")
-print(f"\nBest model: {best_model['name']} (AIC = {best_model['AIC']:.2f})")
-print("Parameters:", best_model['parameters'])
-print("Log-likelihood:", best_model['log_likelihood'])
+    grids = pts_l if grid_tol is None else dadi_grids.AdaptiveGrid(pts_l, tol=grid_tol)
+    # optimization for each model (five), all starts run on a process pool
+    if halving_budgets is None:
+        fits = dadi_parallel.fit_models(models, data_fs, grids, n_starts,
+                                        perturb=dadi_parallel.perturb_uniform, seed=seed,
+                                        processes=n_processes, maxiter=100,
+                                        cache_dir=cache_dir, store=store,
+                                        profile_dir=profile_dir)
+    else:
+        fits = dadi_halving.race_models(models, data_fs, grids, n_starts,
+                                        perturb=dadi_parallel.perturb_uniform, seed=seed,
+                                        processes=n_processes, budgets=halving_budgets,
+                                        keep=halving_keep, cache_dir=cache_dir, store=store,
+                                        profile_dir=profile_dir)
+    print(f"\nRun seed: {fits[0]['seed']}")
+    if trace is not None:
+        dadi_trace.write_trace(trace, fits, run={'data': data_fs, 'grids': repr(grids), 'starts': n_starts,
+                                                 'processes': n_processes, 'seed': fits[0]['seed']})
+    if uncert_eps is not None:
+        # all perturbed-parameter evaluations of all models run on one pool
+        uncerts = dadi_uncert.fit_uncertainties(models, fits, fs, grids, eps=uncert_eps,
+                                                processes=n_processes, cache_dir=cache_dir)
+    results = []
+    for mi, (model, fit) in enumerate(zip(models, fits)):
+        best_p = fit['best']['popt']
+        best_ll = fit['best']['ll']
+        k = len(model['param_names'])
+        aic = 2 * k - 2 * best_ll
+        best_model = fit['best']['model_fs']
+        results.append({
+            'name': model['name'],
+            'parameters': dict(zip(model['param_names'], best_p)),
+            'log_likelihood': best_ll,
+            'AIC': aic,
+            'model_fs': best_model,
+            'theta': fit['best']['theta']
+        })
+        with open(f"{output_dir}/{model['name']}_results.txt", 'w') as f:
+            f.write(f"Model: {model['name']}\n")
+            f.write(f"Parameters: {dict(zip(model['param_names'], best_p))}\n")
+            f.write(f"Log-likelihood: {best_ll}\n")
+            f.write(f"AIC: {aic}\n")
+            if uncert_eps is not None:
+                se = dadi_uncert.format_se(model['param_names'], uncerts[mi]['se'])
+                f.write(f"Standard errors ({uncerts[mi]['method']}): {se}\n")
+            if fit['best']['grid_schedule'] is not None:
+                f.write(f"Grid schedule: {dadi_grids.format_schedule(fit['best']['grid_schedule'])}\n")
 
-# comparison plot of all models
-plt.figure(figsize=(10, 8))
-for i, result in enumerate(results):
-    plt.subplot(len(results), 1, i+1)
-    dadi.Plotting.plot_1d_comp_multinom(result['model_fs'], fs, residual=True)
-    plt.title(f"{result['name']} (AIC = {result['AIC']:.2f})")
-
-plt.tight_layout()
-plt.savefig(f"{output_dir}/all_models_comparison.png", dpi=300)
-plt.close()
-# summary table
-with open(f"{output_dir}/model_comparison.txt", 'w') as f:
-    f.write("Model Comparison by AIC:\n")
-    f.write("-------------------------\n")
+    # Compare models by AIC
+    results.sort(key=lambda x: x['AIC'])
+    best_model = results[0]
+    print("\n\nModel Comparison by AIC:")
     for result in results:
-        f.write(f"{result['name']}: AIC = {result['AIC']:.2f}, Δ AIC = {result['AIC'] - best_model['AIC']:.2f}\n")
-    f.write(f"\nBest model: {best_model['name']} (AIC = {best_model['AIC']:.2f})\n")
-    f.write(f"Parameters: {best_model['parameters']}\n")
-    f.write(f"Log-likelihood: {best_model['log_likelihood']}\n")
+        print(f"{result['name']}: AIC = {result['AIC']:.2f}, Δ AIC = {result['AIC'] - best_model['AIC']:.2f}")
+    print(f"\nBest model: {best_model['name']} (AIC = {best_model['AIC']:.2f})")
+    print("Parameters:", best_model['parameters'])
+    print("Log-likelihood:", best_model['log_likelihood'])
+
+    # fit plots, residual comparison and summary table, drawn off the fitting path
+    dadi_report.save_fits(output_dir, fs, [{'name': r['name'], 'param_names': list(r['parameters']),
+                                            'params': list(r['parameters'].values()), 'll': r['log_likelihood'],
+                                            'aic': r['AIC'], 'theta': r['theta'], 'model_fs': r['model_fs']}
+                                           for r in results], layout='demography')
+    if render_report:
+        dadi_report.render(output_dir, processes=n_processes)
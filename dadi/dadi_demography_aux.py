@@ -13,256 +13,171 @@ Script to test dadi's basic workflow for single population demographic inference
 """
 import numpy as np
 import dadi
-import matplotlib.pyplot as plt
 import os
+import dadi_parallel
+import dadi_halving
+import dadi_grids
+import dadi_uncert
+import dadi_trace
+import dadi_report
 output_dir = "1d_models_results"
-os.makedirs(output_dir, exist_ok=True)
-data_fs = dadi.Spectrum.from_file("acalahor_data_folded_full.fs")
-if not data_fs.folded:
-    data_fs = data_fs.fold()
+data_file = "acalahor_data_folded_full.fs"
 pts_l = [40, 50, 60] #grid points for extrapolation
 # optimization runs for each model
 n_runs = 20
 max_iter = 100
+n_processes = os.cpu_count() # worker processes; 1 runs the starts serially
+seed = None # run seed for the per-start perturbations; None picks (and prints) one
+# optional on-disk model spectrum cache shared by the workers and later runs, e.g. f"{output_dir}/func_ex_cache";
+# it keeps one file per distinct evaluation and is never pruned. None keeps the spectra in memory only
+cache_dir = None
+store = f"{output_dir}/fits.sqlite" # finished starts are saved here and skipped when the run is restarted; None disables
+# successive halving: cumulative iteration budgets ending at max_iter, e.g. [10, 30, max_iter];
+# only the best halving_keep fraction of each model's runs goes on to the next budget. None runs every run to max_iter
+halving_budgets = None
+halving_keep = 0.5
+# EXPERIMENTAL adaptive grids (see dadi_grids.py): early iterations on coarser grids than pts_l, finer ones only
+# where the extrapolation has not converged to within grid_tol log-likelihood units. Not a speedup so far (BFGS
+# restarts its Hessian estimate at every grid level). None uses pts_l for every evaluation
+grid_tol = None
+uncert_eps = 0.01 # step of the finite-difference FIM standard errors of the best fits; None skips them
+# per-start func_ex calls, optimizer calls and integration time per grid size, written to trace.json/.csv; None disables
+trace = f"{output_dir}/trace"
+profile_dir = None # folder for a cProfile dump of every start, e.g. f"{output_dir}/profiles"; None disables
+# draw the fit plots, AIC table and AIC chart (dadi_report.py) at the end of the run; False only saves
+# their inputs, for a later `python dadi_report.py <output_dir>`
+render_report = True
 
 # define the models to test
-models = ["snm", "two_epoch", "growth", "bottlegrowth", "three_epoch"]
-if "exponential_growth" in dir(dadi.Demographics1D):
-    models.append("exponential_growth")
-results = {}
-
-# Model 1: Standard neutral model (snm)
-func = dadi.Demographics1D.snm
-func_ex = dadi.Numerics.make_extrap_log_func(func)
-model = func_ex([], data_fs.sample_sizes, pts_l)
-ll_snm = dadi.Inference.ll_multinom(model, data_fs)
-theta_snm = dadi.Inference.optimal_sfs_scaling(model, data_fs)
-
-results["snm"] = {
-    "ll": ll_snm,
-    "aic": -2*ll_snm, 
-    "theta": theta_snm,
-    "params": {}
-}
-plt.figure()
-dadi.Plotting.plot_1d_comp_multinom(model, data_fs)
-plt.title(f"Standard neutral model\nLL={ll_snm:.2f}, AIC={-2*ll_snm:.2f}")
-plt.savefig(f"{output_dir}/snm_fit.png")
-plt.close()
-
-# Model 2: Two epoch model
-func = dadi.Demographics1D.two_epoch
-func_ex = dadi.Numerics.make_extrap_log_func(func)
-p0 = [1.0, 0.1]  # nu, T
-lower_bound = [0.01, 0.001]
-upper_bound = [100.0, 10.0]
-param_names = ["nu", "T"]
-best_params = []
-best_ll = -np.inf
-for i in range(n_runs):
-    p0_i = dadi.Misc.perturb_params(p0, fold=2, lower_bound=lower_bound, upper_bound=upper_bound)
-    popt = dadi.Inference.optimize_log(p0_i, data_fs, func_ex, pts_l,
-                                     lower_bound=lower_bound,
-                                     upper_bound=upper_bound,
-                                     maxiter=max_iter)
-    model = func_ex(popt, data_fs.sample_sizes, pts_l)
-    ll = dadi.Inference.ll_multinom(model, data_fs)
-    if ll > best_ll:
-        best_ll = ll
-        best_params = popt
-model = func_ex(best_params, data_fs.sample_sizes, pts_l)
-theta = dadi.Inference.optimal_sfs_scaling(model, data_fs)
-aic = 2*len(best_params) - 2*best_ll
-results["two_epoch"] = {
-    "ll": best_ll,
-    "aic": aic,
-    "theta": theta,
-    "params": dict(zip(param_names, best_params))
-}
-# plot the model fit
-plt.figure()
-dadi.Plotting.plot_1d_comp_multinom(model, data_fs)
-param_str = ", ".join([f"{name}={val:.4f}" for name, val in zip(param_names, best_params)])
-plt.title(f"Two epoch model\nLL={best_ll:.2f}, AIC={aic:.2f}\n{param_str}")
-plt.savefig(f"{output_dir}/two_epoch_fit.png")
-plt.close()
-
-# Model 3: Growth model
-func = dadi.Demographics1D.growth
-func_ex = dadi.Numerics.make_extrap_log_func(func)
-p0 = [1.0, 0.1]  # nu, T
-lower_bound = [0.01, 0.001]
-upper_bound = [100.0, 10.0]
-param_names = ["nu", "T"]
-best_params = []
-best_ll = -np.inf
-for i in range(n_runs):
-    p0_i = dadi.Misc.perturb_params(p0, fold=2, lower_bound=lower_bound, upper_bound=upper_bound)
-    popt = dadi.Inference.optimize_log(p0_i, data_fs, func_ex, pts_l,
-                                     lower_bound=lower_bound,
-                                     upper_bound=upper_bound,
-                                     maxiter=max_iter)
-    model = func_ex(popt, data_fs.sample_sizes, pts_l)
-    ll = dadi.Inference.ll_multinom(model, data_fs)
-    if ll > best_ll:
-        best_ll = ll
-        best_params = popt
-model = func_ex(best_params, data_fs.sample_sizes, pts_l)
-theta = dadi.Inference.optimal_sfs_scaling(model, data_fs)
-aic = 2*len(best_params) - 2*best_ll
-results["growth"] = {
-    "ll": best_ll,
-    "aic": aic,
-    "theta": theta,
-    "params": dict(zip(param_names, best_params))
-}
-# plot the model fit
-plt.figure()
-dadi.Plotting.plot_1d_comp_multinom(model, data_fs)
-param_str = ", ".join([f"{name}={val:.4f}" for name, val in zip(param_names, best_params)])
-plt.title(f"Growth model\nLL={best_ll:.2f}, AIC={aic:.2f}\n{param_str}")
-plt.savefig(f"{output_dir}/growth_fit.png")
-plt.close()
-
-# Model 4: Bottlegrowth model
-func = dadi.Demographics1D.bottlegrowth
-func_ex = dadi.Numerics.make_extrap_log_func(func)
-p0 = [0.1, 2.0, 0.05]  # nuB, nuF, T
-lower_bound = [0.01, 0.01, 0.001]
-upper_bound = [1.0, 100.0, 10.0]
-param_names = ["nuB", "nuF", "T"]
-best_params = []
-best_ll = -np.inf
-for i in range(n_runs):
-    p0_i = dadi.Misc.perturb_params(p0, fold=2, lower_bound=lower_bound, upper_bound=upper_bound)
-    popt = dadi.Inference.optimize_log(p0_i, data_fs, func_ex, pts_l,
-                                     lower_bound=lower_bound,
-                                     upper_bound=upper_bound,
-                                     maxiter=max_iter)
-    model = func_ex(popt, data_fs.sample_sizes, pts_l)
-    ll = dadi.Inference.ll_multinom(model, data_fs)
-    if ll > best_ll:
-        best_ll = ll
-        best_params = popt
-model = func_ex(best_params, data_fs.sample_sizes, pts_l)
-theta = dadi.Inference.optimal_sfs_scaling(model, data_fs)
-aic = 2*len(best_params) - 2*best_ll
-results["bottlegrowth"] = {
-    "ll": best_ll,
-    "aic": aic,
-    "theta": theta,
-    "params": dict(zip(param_names, best_params))
-}
-# plot the model fit
-plt.figure()
-dadi.Plotting.plot_1d_comp_multinom(model, data_fs)
-param_str = ", ".join([f"{name}={val:.4f}" for name, val in zip(param_names, best_params)])
-plt.title(f"Bottlegrowth model\nLL={best_ll:.2f}, AIC={aic:.2f}\n{param_str}")
-plt.savefig(f"{output_dir}/bottlegrowth_fit.png")
-plt.close()
-
-# Model 5: Three epoch model
-func = dadi.Demographics1D.three_epoch
-func_ex = dadi.Numerics.make_extrap_log_func(func)
-p0 = [0.5, 5.0, 0.1, 0.1]  # nuB, nuF, TB, TF
-lower_bound = [0.01, 0.01, 0.001, 0.001]
-upper_bound = [10.0, 100.0, 5.0, 5.0]
-param_names = ["nuB", "nuF", "TB", "TF"]
-best_params = []
-best_ll = -np.inf
-for i in range(n_runs):
-    p0_i = dadi.Misc.perturb_params(p0, fold=2, lower_bound=lower_bound, upper_bound=upper_bound)
-    popt = dadi.Inference.optimize_log(p0_i, data_fs, func_ex, pts_l,
-                                     lower_bound=lower_bound,
-                                     upper_bound=upper_bound,
-                                     maxiter=max_iter)
-    model = func_ex(popt, data_fs.sample_sizes, pts_l)
-    ll = dadi.Inference.ll_multinom(model, data_fs)
-    if ll > best_ll:
-        best_ll = ll
-        best_params = popt
-model = func_ex(best_params, data_fs.sample_sizes, pts_l)
-theta = dadi.Inference.optimal_sfs_scaling(model, data_fs)
-aic = 2*len(best_params) - 2*best_ll
-results["three_epoch"] = {
-    "ll": best_ll,
-    "aic": aic,
-    "theta": theta,
-    "params": dict(zip(param_names, best_params))
-}
-# plot the model fit
-plt.figure()
-dadi.Plotting.plot_1d_comp_multinom(model, data_fs)
-param_str = ", ".join([f"{name}={val:.4f}" for name, val in zip(param_names, best_params)])
-plt.title(f"Three epoch model\nLL={best_ll:.2f}, AIC={aic:.2f}\n{param_str}")
-plt.savefig(f"{output_dir}/three_epoch_fit.png")
-plt.close()
-
+models = [
+    # Model 1: Standard neutral model (snm)
+    {
+        'name': 'snm',
+        'title': 'Standard neutral model',
+        'func': dadi.Demographics1D.snm,
+        'param_names': [],
+        'lower_bound': [],
+        'upper_bound': [],
+        'initial_values': []
+    },
+    # Model 2: Two epoch model
+    {
+        'name': 'two_epoch',
+        'title': 'Two epoch model',
+        'func': dadi.Demographics1D.two_epoch,
+        'param_names': ["nu", "T"],
+        'lower_bound': [0.01, 0.001],
+        'upper_bound': [100.0, 10.0],
+        'initial_values': [1.0, 0.1]
+    },
+    # Model 3: Growth model
+    {
+        'name': 'growth',
+        'title': 'Growth model',
+        'func': dadi.Demographics1D.growth,
+        'param_names': ["nu", "T"],
+        'lower_bound': [0.01, 0.001],
+        'upper_bound': [100.0, 10.0],
+        'initial_values': [1.0, 0.1]
+    },
+    # Model 4: Bottlegrowth model
+    {
+        'name': 'bottlegrowth',
+        'title': 'Bottlegrowth model',
+        'func': dadi.Demographics1D.bottlegrowth,
+        'param_names': ["nuB", "nuF", "T"],
+        'lower_bound': [0.01, 0.01, 0.001],
+        'upper_bound': [1.0, 100.0, 10.0],
+        'initial_values': [0.1, 2.0, 0.05]
+    },
+    # Model 5: Three epoch model
+    {
+        'name': 'three_epoch',
+        'title': 'Three epoch model',
+        'func': dadi.Demographics1D.three_epoch,
+        'param_names': ["nuB", "nuF", "TB", "TF"],
+        'lower_bound': [0.01, 0.01, 0.001, 0.001],
+        'upper_bound': [10.0, 100.0, 5.0, 5.0],
+        'initial_values': [0.5, 5.0, 0.1, 0.1]
+    }
+]
 # check and run exponential_growth model if available 
 # (this avoids crashes in previous versions of dadi)
 if "exponential_growth" in dir(dadi.Demographics1D):
-    func = dadi.Demographics1D.exponential_growth
-    func_ex = dadi.Numerics.make_extrap_log_func(func)
-    p0 = [0.1, 0.1, 0.1]  # nu0, nuF, T
-    lower_bound = [0.001, 0.001, 0.001]
-    upper_bound = [10.0, 100.0, 10.0]
-    param_names = ["nu0", "nuF", "T"]
-    best_params = []
-    best_ll = -np.inf
-    for i in range(n_runs):
-        p0_i = dadi.Misc.perturb_params(p0, fold=2, lower_bound=lower_bound, upper_bound=upper_bound)
-        popt = dadi.Inference.optimize_log(p0_i, data_fs, func_ex, pts_l,
-                                         lower_bound=lower_bound,
-                                         upper_bound=upper_bound,
-                                         maxiter=max_iter)
-        model = func_ex(popt, data_fs.sample_sizes, pts_l)
-        ll = dadi.Inference.ll_multinom(model, data_fs)
-        if ll > best_ll:
-            best_ll = ll
-            best_params = popt
-    model = func_ex(best_params, data_fs.sample_sizes, pts_l)
-    theta = dadi.Inference.optimal_sfs_scaling(model, data_fs)
-    aic = 2*len(best_params) - 2*best_ll
-    results["exponential_growth"] = {
-        "ll": best_ll,
-        "aic": aic,
-        "theta": theta,
-        "params": dict(zip(param_names, best_params))
-    }
-    # plot the model fit
-    plt.figure()
-    dadi.Plotting.plot_1d_comp_multinom(model, data_fs)
-    param_str = ", ".join([f"{name}={val:.4f}" for name, val in zip(param_names, best_params)])
-    plt.title(f"Exponential growth model\nLL={best_ll:.2f}, AIC={aic:.2f}\n{param_str}")
-    plt.savefig(f"{output_dir}/exponential_growth_fit.png")
-    plt.close()
-for model_name, model_results in results.items():
-    with open(f"{output_dir}/{model_name}_results.txt", 'w') as f:
-        f.write(f"Model: {model_name}\n")
-        f.write(f"Log-likelihood: {model_results['ll']:.4f}\n")
-        f.write(f"AIC: {model_results['aic']:.4f}\n")
-        f.write(f"Optimal theta: {model_results['theta']:.4f}\n")
-        f.write("Parameters:\n")
-        for param, value in model_results['params'].items():
-            f.write(f"{param}: {value:.4f}\n")
+    models.append({
+        'name': 'exponential_growth',
+        'title': 'Exponential growth model',
+        'func': dadi.Demographics1D.exponential_growth,
+        'param_names': ["nu0", "nuF", "T"],
+        'lower_bound': [0.001, 0.001, 0.001],
+        'upper_bound': [10.0, 100.0, 10.0],
+        'initial_values': [0.1, 0.1, 0.1]
+    })
+
+if __name__ == '__main__':
+    os.makedirs(output_dir, exist_ok=True)
+    data_fs = dadi_parallel.load_folded(data_file)
+    grids = pts_l if grid_tol is None else dadi_grids.AdaptiveGrid(pts_l, tol=grid_tol)
+    # all (model, run) pairs are optimized on a process pool
+    if halving_budgets is None:
+        fits = dadi_parallel.fit_models(models, data_file, grids, n_runs,
+                                        perturb=dadi_parallel.perturb_fold, seed=seed,
+                                        processes=n_processes, maxiter=max_iter,
+                                        cache_dir=cache_dir, store=store,
+                                        profile_dir=profile_dir)
+    else:
+        fits = dadi_halving.race_models(models, data_file, grids, n_runs,
+                                        perturb=dadi_parallel.perturb_fold, seed=seed,
+                                        processes=n_processes, budgets=halving_budgets,
+                                        keep=halving_keep, cache_dir=cache_dir, store=store,
+                                        profile_dir=profile_dir)
+    print(f"Run seed: {fits[0]['seed']}")
+    if trace is not None:
+        dadi_trace.write_trace(trace, fits, run={'data': data_file, 'grids': repr(grids), 'starts': n_runs,
+                                                 'processes': n_processes, 'seed': fits[0]['seed']})
+    if uncert_eps is not None:
+        # all perturbed-parameter evaluations of all models run on one pool
+        uncerts = dadi_uncert.fit_uncertainties(models, fits, data_fs, grids, eps=uncert_eps,
+                                                processes=n_processes, cache_dir=cache_dir)
+    results = {}
+    reports = []
+    for mi, (model, fit) in enumerate(zip(models, fits)):
+        param_names = model['param_names']
+        best_params = fit['best']['popt']
+        best_ll = fit['best']['ll']
+        theta = fit['best']['theta']
+        aic = 2*len(best_params) - 2*best_ll
+        results[model['name']] = {
+            "ll": best_ll,
+            "aic": aic,
+            "theta": theta,
+            "params": dict(zip(param_names, best_params)),
+            "grid_schedule": fit['best']['grid_schedule'],
+            "uncert": uncerts[mi] if uncert_eps is not None else None
+        }
+        reports.append({'name': model['name'], 'title': model['title'], 'param_names': param_names,
+                        'params': best_params, 'll': best_ll, 'aic': aic, 'theta': theta,
+                        'model_fs': fit['best']['model_fs']})
+    for model_name, model_results in results.items():
+        with open(f"{output_dir}/{model_name}_results.txt", 'w') as f:
+            f.write(f"Model: {model_name}\n")
+            f.write(f"Log-likelihood: {model_results['ll']:.4f}\n")
+            f.write(f"AIC: {model_results['aic']:.4f}\n")
+            f.write(f"Optimal theta: {model_results['theta']:.4f}\n")
+            f.write("Parameters:\n")
+            for param, value in model_results['params'].items():
+                f.write(f"{param}: {value:.4f}\n")
+            if model_results['uncert'] is not None and model_results['params']:
+                f.write(f"Standard errors ({model_results['uncert']['method']}):\n")
+                se = dadi_uncert.format_se(model_results['params'], model_results['uncert']['se'])
+                for param, value in se.items():
+                    f.write(f"{param}: {value:.4f}\n")
+            if model_results['grid_schedule'] is not None:
+                f.write(f"Grid schedule: {dadi_grids.format_schedule(model_results['grid_schedule'])}\n")
 
-### ---------- comparing 1d models 
-# Compare models by AIC
-sorted_results = sorted(results.items(), key=lambda x: x[1]['aic'])
-# Generate summary table
-with open(f"{output_dir}/model_comparison.txt", 'w') as f:
-    f.write("Model\tLog-likelihood\tAIC\tTheta\tParameters\n")
-    for model_name, model_results in sorted_results:
-        param_str = ", ".join([f"{k}={v:.4f}" for k, v in model_results['params'].items()])
-        f.write(f"{model_name}\t{model_results['ll']:.4f}\t{model_results['aic']:.4f}\t{model_results['theta']:.4f}\t{param_str}\n")
-# Plot model comparison
-plt.figure(figsize=(10, 6))
-models = [x[0] for x in sorted_results]
-aics = [x[1]['aic'] for x in sorted_results]
-plt.bar(models, aics)
-plt.xticks(rotation=45, ha="right")
-plt.ylabel("AIC")
-plt.title("Model Comparison by AIC")
-plt.tight_layout()
-plt.savefig(f"{output_dir}/model_comparison.png")
-print("Analysis complete. Results saved to:", output_dir)
\ No newline at end of file
+    ### ---------- comparing 1d models 
+    # fit plots, summary table and AIC chart, drawn off the fitting path
+    dadi_report.save_fits(output_dir, data_fs, reports, layout='aux')
+    if render_report:
+        dadi_report.render(output_dir, processes=n_processes)
+    print("Analysis complete. Results saved to:", output_dir)
\ No newline at end of file
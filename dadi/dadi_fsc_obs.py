@@ -0,0 +1,54 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# fastsimcoal2 .obs spectra: dadi conversion
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+dadi side of the observed spectra in fastsimcoal2/*/sfs-files/.
+
+The .obs files are read and written by msprime/pubrhe_obs.py, which needs
+only NumPy and is shared with the msprime scripts (install the helpers with
+`pip install -e .` from the top of the repository). Its ObsSpectrum,
+parse_obs, load_obs (memory-mapped binary cache) and load_obs_dir are
+available from here too; this module adds the conversions to and from dadi
+spectra.
+"""
+import re
+import dadi
+import numpy as np
+from pubrhe_obs import ObsSpectrum, parse_obs, load_obs, load_obs_dir, cache_paths
+
+def to_spectrum(obs, pop_ids=None, folded=True):
+    """
+    dadi Spectrum of the counts of an ObsSpectrum (folded and corner-masked
+    as the MAF files are). pop_ids default to pop<index>.
+    """
+    if pop_ids is None:
+        pop_ids = [f"pop{p}" for p in obs.pops]
+    data = np.array(obs.data, dtype=float)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask.flat[0] = mask.flat[-1] = True
+    if folded:
+        # entries beyond half the total sample size, as in Spectrum.fold
+        total = sum(np.ogrid[tuple(slice(0, n) for n in data.shape)])
+        mask |= total > int(sum(obs.sample_sizes)/2)
+    return dadi.Spectrum(data, mask=mask, data_folded=folded, pop_ids=pop_ids)
+
+def from_spectrum(fs, pops=None, n_monomorphic=None):
+    """
+    ObsSpectrum of a dadi Spectrum (folded first if needed). Masked cells
+    are written as 0, except the first one, which keeps its value or
+    n_monomorphic if given. pops default to the <index> of pop<index>
+    pop_ids.
+    """
+    if pops is None:
+        if fs.pop_ids is None or not all(re.fullmatch(r'pop\d+', str(p)) for p in fs.pop_ids):
+            raise ValueError("pops must be given for pop_ids " + repr(fs.pop_ids))
+        pops = [int(str(p)[3:]) for p in fs.pop_ids]
+    if not fs.folded:
+        fs = fs.fold()
+    data = np.array(fs.data, dtype=float)
+    first = (0,) * fs.ndim
+    monomorphic = data[first] if n_monomorphic is None else n_monomorphic
+    data[np.ma.getmaskarray(fs)] = 0
+    data[first] = monomorphic
+    return ObsSpectrum(data, pops)
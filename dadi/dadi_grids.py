@@ -0,0 +1,134 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi adaptive extrapolation grids
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Adaptive grid sizes for the pts_l extrapolation of the dadi fits.
+
+EXPERIMENTAL: every level is a separate optimize_log call, so BFGS starts its
+inverse-Hessian estimate over at each level and the iterations saved on the
+coarse grids are spent again rebuilding it on pts_l. On our test spectra this
+was not faster than the fixed pts_l; carrying the optimizer state across
+levels would need an optimizer loop of our own instead of optimize_log.
+
+With a fixed pts_l = [40, 50, 60] every likelihood evaluation of the
+optimizer costs three integrations at the full grid sizes, even in the first
+iterations, far from the optimum. An AdaptiveGrid is passed in place of pts_l
+(to dadi_parallel.fit_models, dadi_halving.race_models or fit_start) and
+runs the optimization on a ladder of grids: pts_l halved for the coarse
+levels, pts_l, then pts_l shifted up by its spacing for the finer levels:
+
+    [20, 25, 30] -> [40, 50, 60] -> [50, 60, 70] -> [60, 70, 80]
+    coarse level       pts_l         finer levels
+
+The first iterations (coarse_maxiter, with a looser gradient tolerance) run
+on the coarse grids, whose integrations cost about a quarter of those on
+pts_l; the optimization then restarts on the next level from the current
+parameters and runs to convergence. Once pts_l is reached, the extrapolation is checked: the log-likelihood of
+the current parameters on the next finer grids must agree with the one on
+the current grids within tol, otherwise the optimization goes on at the finer
+level (so for large samples, e.g. ns = 158, grids beyond 60 are used only
+where pts_l has not converged). The final log-likelihood is computed on the
+last grids used, and every level is recorded in the start's 'grid_schedule'.
+"""
+import dadi
+import numpy as np
+
+def grid_levels(pts_l, coarse=1, fine=2, min_pts=20):
+    """
+    pts_l divided by 2**k for the coarse levels (those whose smallest grid is
+    at least min_pts), then pts_l shifted up by its spacing for the fine
+    levels; returns (levels, index of pts_l).
+    """
+    pts_l = [int(p) for p in pts_l]
+    step = pts_l[1] - pts_l[0] if len(pts_l) > 1 else 10
+    levels = [[int(round(p / 2**k)) for p in pts_l] for k in range(coarse, 0, -1)
+              if pts_l[0] / 2**k >= min_pts]
+    ref = len(levels)
+    levels += [[p + k * step for p in pts_l] for k in range(0, fine + 1)]
+    return levels, ref
+
+class AdaptiveGrid:
+    """
+    Grid schedule used in place of pts_l.
+    pts_l = reference grids (those of the fixed-grid runs)
+    coarse = number of coarser levels to start from
+    fine = number of finer levels available beyond pts_l
+    tol = largest log-likelihood difference between two successive levels for
+          the extrapolation to count as converged
+    min_pts = smallest grid size of the coarse levels
+    coarse_maxiter = BFGS iterations on each coarse level
+    coarse_gtol = BFGS gradient tolerance on the coarse levels, looser than
+                  dadi's default (1e-5) used from pts_l on
+    """
+    def __init__(self, pts_l, coarse=1, fine=2, tol=0.05, min_pts=20, coarse_maxiter=10,
+                 coarse_gtol=1e-3):
+        self.pts_l = [int(p) for p in pts_l]
+        self.coarse = coarse
+        self.fine = fine
+        self.tol = tol
+        self.min_pts = min_pts
+        self.coarse_maxiter = coarse_maxiter
+        self.coarse_gtol = coarse_gtol
+        self.levels, self.ref = grid_levels(pts_l, coarse, fine, min_pts)
+
+    def __repr__(self):
+        return (f"AdaptiveGrid({self.pts_l}, coarse={self.coarse}, fine={self.fine}, "
+                f"tol={self.tol}, min_pts={self.min_pts}, coarse_maxiter={self.coarse_maxiter}, "
+                f"coarse_gtol={self.coarse_gtol})")
+
+    def config(self):
+        """
+        JSON-able description, for the result store.
+        """
+        return {'pts_l': self.pts_l, 'coarse': self.coarse, 'fine': self.fine,
+                'tol': self.tol, 'min_pts': self.min_pts,
+                'coarse_maxiter': self.coarse_maxiter, 'coarse_gtol': self.coarse_gtol}
+
+    def optimize(self, p0, fs, func_ex, lower_bound, upper_bound, verbose=False, maxiter=100):
+        """
+        Run optimize_log along the grid levels (coarse_maxiter iterations on
+        the coarse levels, up to maxiter on the others). Returns (popt, warnflag of the last level, final pts_l,
+        schedule), schedule = one dictionary per level with its 'pts_l', the
+        log-likelihood 'll' at the end of that level, the log-likelihood
+        'check' of the same parameters on the next level (None if not
+        checked), the 'integrations' run on that level (when func_ex
+        counts them, see dadi_cache.py) and the optimizer's 'func_calls' and
+        'grad_calls' on that level.
+        """
+        schedule = []
+        popt = np.asarray(p0)
+        for k, grid in enumerate(self.levels):
+            misses = _misses(func_ex)
+            popt, _, _, _, func_calls, grad_calls, warnflag = dadi.Inference.optimize_log(
+                popt, fs, func_ex, grid, lower_bound=lower_bound, upper_bound=upper_bound,
+                gtol=self.coarse_gtol if k < self.ref else 1e-5, verbose=verbose,
+                maxiter=self.coarse_maxiter if k < self.ref else maxiter, full_output=True)
+            level = {'pts_l': grid, 'll': _ll(func_ex, popt, fs, grid), 'check': None,
+                     'func_calls': func_calls, 'grad_calls': grad_calls}
+            schedule.append(level)
+            if k >= self.ref and k + 1 < len(self.levels):
+                level['check'] = _ll(func_ex, popt, fs, self.levels[k + 1])
+            level['integrations'] = None if misses is None else _misses(func_ex) - misses
+            if k >= self.ref and (level['check'] is None or abs(level['check'] - level['ll']) <= self.tol):
+                break
+        return popt, warnflag, grid, schedule
+
+def _ll(func_ex, params, fs, grid):
+    return dadi.Inference.ll_multinom(func_ex(params, fs.sample_sizes, grid), fs)
+
+def _misses(func_ex):
+    return func_ex.stats()['misses'] if hasattr(func_ex, 'stats') else None
+
+def format_schedule(schedule):
+    """
+    One-line description of a grid schedule, e.g.
+    "[20, 25, 30] (-71.2) -> [40, 50, 60] (-70.9, next -70.9)".
+    """
+    parts = []
+    for level in schedule:
+        text = f"{level['pts_l']} ({level['ll']:.4f}"
+        if level['check'] is not None:
+            text += f", next {level['check']:.4f}"
+        parts.append(text + ")")
+    return " -> ".join(parts)
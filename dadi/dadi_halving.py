@@ -0,0 +1,216 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi successive-halving multi-start scheduler
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Successive halving for the multi-start loops of dadi_demography.py and
+dadi_demography_aux.py: instead of running every start for the full maxiter,
+all starts of a model are run for a short iteration budget, the best fraction
+of them (by log-likelihood) is kept, and the kept starts are resumed from
+where they stopped with the next budget, until the last budget (the maxiter
+of the exhaustive loop) is reached.
+
+budgets are cumulative BFGS iteration counts, e.g. [10, 30, 100]: a start
+kept to the end runs 10, then 20 more, then 70 more iterations. Starts that
+converge before their budget is used are not resumed (they stay in the race
+with their log-likelihood). The BFGS Hessian estimate is rebuilt at every
+resume, so a start resumed to 100 iterations is close to, but not exactly,
+the same as a start run for 100 iterations in one go.
+
+The number of integrations (model spectra not found in the cache) is counted
+for every start, and the integrations saved compared with the exhaustive loop
+are estimated by assuming that every pruned start would have cost as much as
+the starts of the same model that ran to the end.
+"""
+import math
+import multiprocessing
+import os
+import numpy as np
+import dadi_grids
+import dadi_parallel
+import dadi_store
+
+def survivors(records, keep):
+    """
+    Starts kept for the next rung: the best ceil(keep * n) records of a model
+    (highest log-likelihood, then lowest start index), at least one.
+    """
+    ranked = sorted(records, key=lambda r: (-r['ll'], r['start']))
+    return ranked[:max(1, math.ceil(keep * len(ranked)))]
+
+def _integrations(rec):
+    # records read back from a store have no cache statistics
+    return rec['cache']['misses'] if 'cache' in rec else (rec['integrations'] or 0)
+
+def race_models(models, data_fs, pts_l, n_starts, perturb=dadi_parallel.perturb_uniform,
+                seed=None, processes=None, budgets=(10, 30, 100), keep=0.5,
+                verbose=False, cache_dir=None, store=None, profile_dir=None):
+    """
+    Optimize every model with successive halving over its starts.
+    Arguments are those of dadi_parallel.fit_models, except:
+    budgets = increasing cumulative iteration budgets; the last one plays the
+              role of maxiter
+    keep = fraction of the starts of a model kept at every rung
+    store = optional SQLite file (see dadi_store.py); every rung is saved as
+            its own run, so a restarted race skips the rungs (and the starts
+            of a rung) that already finished
+
+    Returns the summaries of fit_models, where every start record is the last
+    one of that start ('rung' = index of its last budget, 'integrations' =
+    integrations over all its rungs, 'pruned' = dropped before the last rung;
+    the optimizer calls and 'grid_time' of the trace also cover all rungs).
+    Every summary also has a 'halving' dictionary with the integrations run,
+    the estimated integrations of the exhaustive loop and the number of
+    pruned starts.
+    """
+    budgets = [int(b) for b in budgets]
+    if any(b <= a for a, b in zip(budgets, budgets[1:])):
+        raise ValueError(f"budgets must increase: {budgets}")
+    db = None
+    if store is not None:
+        db = dadi_store.ResultStore(store)
+    if seed is None and db is None:
+        seed = np.random.SeedSequence().entropy
+    seeds = None
+
+    if processes is None:
+        processes = os.cpu_count()
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=dadi_parallel._init_worker,
+                                    initargs=(data_fs,))
+    else:
+        dadi_parallel._init_worker(data_fs)
+
+    # latest record and total integrations of every (model index, start)
+    latest = {}
+    spent = {}
+    alive = {mi: list(range(n_starts if len(m['param_names']) > 0 else 1))
+             for mi, m in enumerate(models)}
+    try:
+        for rung, budget in enumerate(budgets):
+            done = {}
+            if db is not None:
+                config = dadi_store.run_config(models, data_fs, pts_l, n_starts, perturb, budget)
+                config['halving'] = {'budgets': budgets[:rung+1], 'keep': keep}
+                run_key, seed = db.open_run(config, seed)
+                done = db.finished(run_key)
+            if seeds is None:
+                seeds = dadi_parallel.start_seeds(seed, len(models), n_starts)
+            tasks = []
+            for mi, model in enumerate(models):
+                for start in alive[mi]:
+                    prev = latest.get((mi, start))
+                    if prev is not None and prev['converged']:
+                        # nothing left to optimize, carried over as it is
+                        continue
+                    if (model['name'], start) in done:
+                        _record(latest, spent, mi, done[(model['name'], start)], rung)
+                        continue
+                    p0 = None if prev is None else list(prev['popt'])
+                    tasks.append((mi, start, model, pts_l, seeds[mi][start], perturb,
+                                  budget - (budgets[rung-1] if rung > 0 else 0),
+                                  verbose, cache_dir, p0, profile_dir))
+            tasks.sort(key=lambda t: (-len(t[2]['param_names']), t[0], t[1]))
+            if len(done) > 0:
+                print(f"  rung {rung+1}: {len(done)} finished starts read from {store}", flush=True)
+            if pool is None:
+                results = map(dadi_parallel._fit_start, tasks)
+            else:
+                results = pool.imap_unordered(dadi_parallel._fit_start, tasks, chunksize=1)
+            for rec in results:
+                prev = latest.get((rec['model_index'], rec['start']))
+                if prev is not None:
+                    # p0 of the start, not of the resume
+                    rec['p0'] = prev['p0']
+                if db is not None:
+                    db.add(run_key, rec)
+                _record(latest, spent, rec['model_index'], rec, rung)
+                _report(rec, budget)
+            if rung == len(budgets) - 1:
+                break
+            for mi, model in enumerate(models):
+                kept = survivors([latest[(mi, s)] for s in alive[mi]], keep)
+                pruned = sorted(set(alive[mi]) - set(r['start'] for r in kept))
+                for s in pruned:
+                    latest[(mi, s)]['pruned'] = True
+                alive[mi] = sorted(r['start'] for r in kept)
+                if len(pruned) > 0:
+                    print(f"  {model['name']}: kept starts {[s+1 for s in alive[mi]]} "
+                          f"after {budget} iterations", flush=True)
+        records = []
+        for (mi, start), rec in latest.items():
+            rec['integrations'] = spent[(mi, start)]
+            rec.setdefault('pruned', False)
+            records.append(rec)
+        if db is not None:
+            # the last record of every start, as the run that dadi_store.py reports
+            config['halving']['final'] = True
+            run_key, _ = db.open_run(config, seed)
+            for rec in records:
+                db.add(run_key, rec)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if db is not None:
+            db.close()
+
+    summaries = dadi_parallel.summarize_fits(models, records, data_fs, pts_l, seed, cache_dir)
+    for fit in summaries:
+        fit['halving'] = halving_stats(fit['starts'])
+    report_savings(summaries)
+    return summaries
+
+def _record(latest, spent, mi, rec, rung):
+    key = (mi, rec['start'])
+    prev = latest.get(key)
+    if prev is not None:
+        for k in ('func_calls', 'grad_calls'):
+            rec[k] = rec.get(k, 0) + prev.get(k, 0)
+        grid_time = dict(prev.get('grid_time') or {})
+        for pts, (n, sec) in (rec.get('grid_time') or {}).items():
+            n0, sec0 = grid_time.get(pts, (0, 0.0))
+            grid_time[pts] = (n + n0, sec + sec0)
+        rec['grid_time'] = grid_time
+    rec['rung'] = rung
+    latest[key] = rec
+    spent[key] = spent.get(key, 0) + _integrations(rec)
+
+def halving_stats(starts):
+    """
+    Integrations run for the starts of one model, and an estimate of the
+    integrations the exhaustive loop would have run: every pruned start is
+    counted at the mean cost of the starts that were not pruned.
+    """
+    used = sum(r['integrations'] for r in starts)
+    full = [r['integrations'] for r in starts if not r['pruned']]
+    full_cost = np.mean(full) if len(full) > 0 else 0
+    exhaustive = sum(max(r['integrations'], full_cost) if r['pruned'] else r['integrations']
+                     for r in starts)
+    return {'integrations': used, 'exhaustive': exhaustive,
+            'pruned': sum(1 for r in starts if r['pruned'])}
+
+def report_savings(summaries):
+    """
+    Print the integrations run and saved per model and in total.
+    """
+    print("\nSuccessive halving:")
+    total_used = total_full = 0
+    for fit in summaries:
+        h = fit['halving']
+        total_used += h['integrations']
+        total_full += h['exhaustive']
+        print(f"  {fit['name']}: {h['integrations']} integrations, {h['pruned']} starts pruned, "
+              f"~{h['exhaustive'] - h['integrations']:.0f} saved", flush=True)
+    if total_full > 0:
+        print(f"  total: {total_used} integrations, ~{total_full:.0f} for the exhaustive loop "
+              f"(~{100 * (1 - total_used / total_full):.0f}% saved)", flush=True)
+
+def _report(rec, budget):
+    cache = rec['cache']
+    print(f"  {rec['model']} start {rec['start']+1} ({budget} iterations): "
+          f"log-likelihood {rec['ll']} ({rec['wall_time']:.1f} s, {cache['misses']} integrations, "
+          f"{cache['hits'] + cache['disk_hits']} cached)", flush=True)
+    if rec['grid_schedule'] is not None:
+        print(f"    grids: {dadi_grids.format_schedule(rec['grid_schedule'])}", flush=True)
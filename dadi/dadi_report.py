@@ -0,0 +1,230 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi report rendering
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Report stage of the fitting scripts, run after (and separately from) the
+fits: the fit, residual and comparison plots and the AIC table.
+
+The fitting scripts only save the spectra and the numbers the report needs
+(save_fits): the data and best model spectra in <output_dir>/spectra/ and
+<output_dir>/report.json. render() then builds the list of outputs of the
+script's layout ('demography' for dadi_demography.py, 'aux' for
+dadi_demography_aux.py) and draws the figures on a process pool with the
+headless Agg backend. Every output is keyed on a digest of what it is drawn
+from (the bytes of its spectra, its title and numbers, the layout); the
+digests are kept in <output_dir>/.report_digests.json and an output whose
+digest has not changed is not drawn again. A report can be rendered (or
+re-rendered, e.g. after a restyle) on its own with
+
+    python dadi_report.py <output_dir> [--processes P] [--force]
+
+Layouts:
+    demography  <model>_fit.png (300 dpi), all_models_comparison.png (the
+                Anscombe residuals of every model, one panel per model, in
+                AIC order) and model_comparison.txt
+    aux         <model>_fit.png, model_comparison.txt (tab-separated, with
+                theta) and model_comparison.png (AIC bar chart)
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import dadi
+import matplotlib
+import numpy as np
+
+LAYOUTS = ('demography', 'aux')
+# bump when the drawing code changes, so every output is drawn again
+REPORT_VERSION = 1
+
+def save_fits(output_dir, data, entries, layout='demography'):
+    """
+    Save the inputs of the report of a run.
+    data = folded data Spectrum
+    entries = one dictionary per model: 'name', 'param_names', 'params',
+              'll', 'aic', 'theta', 'model_fs' (Spectrum) and, for the aux
+              layout, 'title'
+    Returns the path of report.json.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown report layout {layout!r}")
+    spectra = os.path.join(output_dir, 'spectra')
+    os.makedirs(spectra, exist_ok=True)
+    data.to_file(os.path.join(spectra, 'data.fs'))
+    models = []
+    for e in entries:
+        e['model_fs'].to_file(os.path.join(spectra, f"{e['name']}.fs"))
+        models.append({'name': e['name'], 'title': e.get('title', e['name']),
+                       'param_names': list(e['param_names']),
+                       'params': [float(p) for p in e['params']],
+                       'll': float(e['ll']), 'aic': float(e['aic']), 'theta': float(e['theta']),
+                       'model_fs': f"spectra/{e['name']}.fs"})
+    path = os.path.join(output_dir, 'report.json')
+    with open(path, 'w') as f:
+        json.dump({'layout': layout, 'data': 'spectra/data.fs', 'models': models}, f, indent=1)
+    return path
+
+##### outputs
+
+def report_jobs(output_dir):
+    """
+    Outputs of the report of a run: one dictionary per output with its
+    'output' file name, 'kind' of drawing, the 'spectra' it is drawn from
+    (paths relative to output_dir) and the other 'args' of the drawing.
+    """
+    with open(os.path.join(output_dir, 'report.json')) as f:
+        report = json.load(f)
+    layout = report['layout']
+    models = report['models']
+    ranked = sorted(models, key=lambda m: m['aic'])
+    jobs = []
+    for m in models:
+        if layout == 'demography':
+            title = f"{m['name']} (AIC = {m['aic']:.2f})"
+            args = {'title': title, 'figsize': [8, 6], 'dpi': 300}
+        else:
+            title = f"{m['title']}\nLL={m['ll']:.2f}, AIC={m['aic']:.2f}"
+            if m['param_names']:
+                title += "\n" + ", ".join(f"{n}={v:.4f}" for n, v in zip(m['param_names'], m['params']))
+            args = {'title': title, 'figsize': None, 'dpi': None}
+        jobs.append({'output': f"{m['name']}_fit.png", 'kind': 'fit',
+                     'spectra': [report['data'], m['model_fs']], 'args': args})
+    if layout == 'demography':
+        jobs.append({'output': 'all_models_comparison.png', 'kind': 'residuals',
+                     'spectra': [report['data']] + [m['model_fs'] for m in ranked],
+                     'args': {'titles': [f"{m['name']} (AIC = {m['aic']:.2f})" for m in ranked],
+                              'figsize': [10, 8], 'dpi': 300}})
+        jobs.append({'output': 'model_comparison.txt', 'kind': 'table',
+                     'spectra': [], 'args': {'layout': layout, 'models': ranked}})
+    else:
+        jobs.append({'output': 'model_comparison.txt', 'kind': 'table',
+                     'spectra': [], 'args': {'layout': layout, 'models': ranked}})
+        jobs.append({'output': 'model_comparison.png', 'kind': 'aic_bar', 'spectra': [],
+                     'args': {'names': [m['name'] for m in ranked], 'aics': [m['aic'] for m in ranked],
+                              'figsize': [10, 6], 'dpi': None}})
+    return jobs
+
+def job_digest(output_dir, job):
+    """
+    Digest of everything an output is drawn from.
+    """
+    h = hashlib.sha1(json.dumps([REPORT_VERSION, job['kind'], job['args']], sort_keys=True).encode())
+    for path in job['spectra']:
+        with open(os.path.join(output_dir, path), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def _init_worker():
+    """
+    Pool initializer: draw off-screen (dadi has already imported pyplot).
+    """
+    matplotlib.use('Agg', force=True)
+
+def _render(task):
+    """
+    Draw one output, in a worker; returns its file name.
+    """
+    output_dir, job = task
+    import matplotlib.pyplot as plt
+    path = os.path.join(output_dir, job['output'])
+    spectra = [dadi.Spectrum.from_file(os.path.join(output_dir, p)) for p in job['spectra']]
+    args = job['args']
+    if job['kind'] == 'table':
+        _write_table(path, args['layout'], args['models'])
+        return job['output']
+    fig = plt.figure(figsize=args.get('figsize'))
+    if job['kind'] == 'fit':
+        data, model = spectra
+        dadi.Plotting.plot_1d_comp_multinom(model, data, show=False)
+        plt.title(args['title'])
+    elif job['kind'] == 'residuals':
+        data = spectra[0]
+        for i, (model, title) in enumerate(zip(spectra[1:], args['titles'])):
+            # as dadi.Plotting does: an unfolded model is compared to folded data folded
+            if data.folded and not model.folded:
+                model = model.fold()
+            model = dadi.Inference.optimally_scaled_sfs(model, data)
+            masked_model, masked_data = dadi.Numerics.intersect_masks(model, data)
+            ax = fig.add_subplot(len(args['titles']), 1, i+1)
+            ax.plot(dadi.Inference.Anscombe_Poisson_residual(masked_model, masked_data), '-og')
+            ax.axhline(0, color='k', lw=0.5)
+            ax.set_xlim(0, data.shape[0]-1)
+            ax.set_title(title)
+        fig.tight_layout()
+    elif job['kind'] == 'aic_bar':
+        plt.bar(args['names'], args['aics'])
+        plt.xticks(rotation=45, ha="right")
+        plt.ylabel("AIC")
+        plt.title("Model Comparison by AIC")
+        plt.tight_layout()
+    # drawn to a temporary file and renamed, so an interrupted report leaves no partial figure
+    fd, tmp = tempfile.mkstemp(dir=output_dir, suffix='.png')
+    os.close(fd)
+    plt.savefig(tmp, dpi=args.get('dpi') or 'figure')
+    plt.close(fig)
+    os.replace(tmp, path)
+    return job['output']
+
+def _write_table(path, layout, ranked):
+    best = ranked[0]
+    with open(path, 'w') as f:
+        if layout == 'demography':
+            f.write("Model Comparison by AIC:\n")
+            f.write("-------------------------\n")
+            for m in ranked:
+                f.write(f"{m['name']}: AIC = {m['aic']:.2f}, Δ AIC = {m['aic'] - best['aic']:.2f}\n")
+            f.write(f"\nBest model: {best['name']} (AIC = {best['aic']:.2f})\n")
+            # NumPy scalars, as the parameters of the fits print
+            f.write(f"Parameters: {dict(zip(best['param_names'], np.array(best['params'])))}\n")
+            f.write(f"Log-likelihood: {best['ll']}\n")
+        else:
+            f.write("Model\tLog-likelihood\tAIC\tTheta\tParameters\n")
+            for m in ranked:
+                param_str = ", ".join([f"{k}={v:.4f}" for k, v in zip(m['param_names'], m['params'])])
+                f.write(f"{m['name']}\t{m['ll']:.4f}\t{m['aic']:.4f}\t{m['theta']:.4f}\t{param_str}\n")
+
+def render(output_dir, processes=None, force=False):
+    """
+    Draw the outputs of the report of output_dir whose inputs changed since
+    they were last drawn (all of them with force). Returns (drawn, skipped)
+    lists of file names.
+    """
+    digest_path = os.path.join(output_dir, '.report_digests.json')
+    digests = {}
+    if os.path.isfile(digest_path) and not force:
+        with open(digest_path) as f:
+            digests = json.load(f)
+    todo = []
+    skipped = []
+    new_digests = {}
+    for job in report_jobs(output_dir):
+        digest = job_digest(output_dir, job)
+        new_digests[job['output']] = digest
+        if digests.get(job['output']) == digest and os.path.isfile(os.path.join(output_dir, job['output'])):
+            skipped.append(job['output'])
+        else:
+            todo.append((output_dir, job))
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, len(todo)))
+    if processes == 1:
+        _init_worker()
+        drawn = [_render(t) for t in todo]
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+            drawn = pool.map(_render, todo, chunksize=1)
+    with open(digest_path, 'w') as f:
+        json.dump(new_digests, f, indent=1)
+    return drawn, skipped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render the plots and AIC table of a fitting run.")
+    parser.add_argument('output_dir', help="output folder of dadi_demography.py or dadi_demography_aux.py")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--force', action='store_true', help="draw every output, changed or not")
+    args = parser.parse_args()
+    drawn, skipped = render(args.output_dir, args.processes, args.force)
+    print(f"{len(drawn)} output(s) drawn, {len(skipped)} unchanged")
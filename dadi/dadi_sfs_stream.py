@@ -0,0 +1,390 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Streaming VCF to SFS
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Streaming replacement for
+
+    dd = dadi.Misc.make_data_dict_vcf(datafile, popfile)
+    fs = dadi.Spectrum.from_data_dict(dd, pop_ids, ns, polarized=...)
+
+The VCF ((b)gzipped or plain) is read in chunks of lines. Genotypes are parsed
+into NumPy arrays (diploid GT-only records, e.g. msprime output, are decoded
+for a whole chunk at once) and every site is reduced straight to its
+(successful calls, derived calls, polarized) pattern, so only a histogram of
+patterns is kept instead of one dict entry per SNP. The spectrum is then built
+from that histogram by hypergeometric projection, as from_data_dict does; it
+equals dadi's up to floating-point rounding.
+
+The same filters as make_data_dict_vcf apply: FILTER must be PASS or '.',
+REF and ALT must be single A/C/G/T bases, genotypes of samples with AD=0,0 or
+DP=0 are not counted, and the AA/AA_ensembl/AA_chimp INFO field polarizes
+the site. As in the data dictionary, a record whose CHROM_POS repeats an
+earlier record replaces it, wherever the earlier one is; for this an 8-byte
+hash of every CHROM_POS and the index of its pattern are kept (12 bytes per
+SNP instead of a dict entry).
+
+With processes > 1, a single VCF is parsed chunk by chunk on a process pool,
+and several VCFs (e.g. one per contig) are each parsed by their own worker;
+the partial histograms are merged in input order.
+"""
+import collections
+import functools
+import gzip
+import hashlib
+import multiprocessing
+import os
+import zipfile
+import dadi
+import numpy as np
+from scipy.special import gammaln
+
+_bases = ('A', 'C', 'G', 'T')
+_aa_fields = ('AA=', 'AA_ensembl=', 'AA_chimp=')
+
+def _open_vcf(vcf_filename):
+    """
+    Open a VCF the way make_data_dict_vcf does.
+    """
+    ext = os.path.splitext(vcf_filename)[1]
+    if ext == '.gz':
+        return gzip.open(vcf_filename)
+    if ext == '.zip':
+        archive = zipfile.ZipFile(vcf_filename)
+        namelist = archive.namelist()
+        if len(namelist) != 1:
+            raise ValueError("Must be only a single vcf file in zip "
+                             "archive: {}".format(vcf_filename))
+        return archive.open(namelist[0])
+    return open(vcf_filename)
+
+def read_popinfo(popinfo_filename):
+    """
+    {sample: pop} from a population file (sample and population id in the
+    first two columns; '#' starts a comment), as make_data_dict_vcf reads it.
+    """
+    ext = os.path.splitext(popinfo_filename)[1]
+    if ext == '.gz':
+        popinfo_file = gzip.open(popinfo_filename, 'rt')
+    elif ext == '.zip':
+        archive = zipfile.ZipFile(popinfo_filename)
+        namelist = archive.namelist()
+        if len(namelist) != 1:
+            raise ValueError("Must be only a single popinfo file in zip "
+                             "archive: {}".format(popinfo_filename))
+        popinfo_file = archive.open(namelist[0])
+    else:
+        popinfo_file = open(popinfo_filename)
+    popinfo = {}
+    try:
+        for line in popinfo_file:
+            cols = _decode(line).split('#')[0].split()
+            if not cols:
+                continue
+            popinfo[cols[0]] = cols[1]
+    except IndexError:
+        raise ValueError('Failed in parsing popinfo file.')
+    finally:
+        popinfo_file.close()
+    return popinfo
+
+def _sample_pops(header_line, popinfo, pop_ids):
+    """
+    Index into pop_ids of every sample column (-1 if not used).
+    """
+    header_cols = header_line.split()
+    if len(header_cols) <= 9:
+        raise ValueError("No samples in VCF file")
+    samples = header_cols[9:]
+    present = {popinfo[s] for s in samples if s in popinfo}
+    for pop in pop_ids:
+        if pop not in present:
+            raise ValueError(f"Population {pop} has no samples in the VCF file")
+    return np.array([pop_ids.index(popinfo[s]) if s in popinfo and popinfo[s] in pop_ids
+                     else -1 for s in samples])
+
+def _decode(line):
+    try:
+        return line.decode()
+    except AttributeError:
+        return line
+
+def _iter_chunks(vcf_filename, chunk_lines):
+    """
+    Yields the header line, then lists of undecoded data lines.
+    """
+    vcf_file = _open_vcf(vcf_filename)
+    with vcf_file:
+        for line in vcf_file:
+            text = _decode(line)
+            if text.startswith('##'):
+                continue
+            if text.startswith('#'):
+                yield text
+                break
+        chunk = []
+        for line in vcf_file:
+            chunk.append(line)
+            if len(chunk) == chunk_lines:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+def _count_sample(sample, gtindex, dpindex, covindex):
+    """
+    (ref, alt) calls of one sample, following make_data_dict_vcf exactly.
+    """
+    fields = sample.split(':')
+    try:
+        if fields[covindex] == '0,0' or fields[dpindex] == '0':
+            return 0, 0
+    except Exception:
+        pass
+    gt = fields[gtindex]
+    return gt[::2].count('0'), gt[::2].count('1')
+
+def _snp_hash(snp_id):
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(snp_id.encode(), digest_size=8).digest(), 'little')
+
+def _count_chunk(args):
+    """
+    Reduce a chunk of VCF lines to its distinct patterns.
+    Returns (patterns, hashes, pattern_of): patterns is a list of keys in
+    order of first occurrence, hashes the CHROM_POS hash of every record and
+    pattern_of the index into patterns of every record.
+    """
+    lines, sample_pop, n_pops, filter = args
+    n_samples = len(sample_pop)
+    member = np.zeros((n_samples, n_pops), dtype=np.int64)
+    used = sample_pop >= 0
+    member[np.nonzero(used)[0], sample_pop[used]] = 1
+    fast_len = 4 * n_samples
+    fast_seps = '\t' * (n_samples - 1) + '\n'
+
+    ids = []
+    derived_is_ref = []
+    polarized = []
+    calls = []      # (ref, alt) per pop, or None for fast-path rows
+    fast_rows = []
+    fast_tails = []
+    for line in lines:
+        line = _decode(line)
+        if line.startswith('#'):
+            continue
+        cols = line.split('\t', 9)
+        if filter and cols[6] != 'PASS' and cols[6] != '.':
+            continue
+        ref, alt = cols[3].upper(), cols[4].upper()
+        if ref not in _bases or alt not in _bases:
+            continue
+        outgroup = '-'
+        for field in cols[7].split(';'):
+            if field.startswith(_aa_fields):
+                outgroup = field.split('=')[1].upper().split('|')[0]
+                if outgroup not in _bases:
+                    outgroup = '-'
+                break
+        is_polarized = outgroup != '-' and outgroup in (ref, alt)
+        ids.append(cols[0] + '_' + cols[1])
+        polarized.append(is_polarized)
+        derived_is_ref.append(is_polarized and outgroup != ref)
+
+        tail = cols[9] if len(cols) == 10 else ''
+        if cols[8] == 'GT' and len(tail) == fast_len and tail[3::4] == fast_seps:
+            fast_rows.append(len(calls))
+            fast_tails.append(tail)
+            calls.append(None)
+            continue
+        fmt = cols[8].split(':')
+        gtindex = fmt.index('GT')
+        dpindex = fmt.index('DP') if 'DP' in fmt else None
+        covindex = fmt.index('AD') if 'AD' in fmt else None
+        row = np.zeros((2, n_pops), dtype=np.int64)
+        for pop, sample in zip(sample_pop, tail.split('\t') if tail else []):
+            if pop < 0:
+                continue
+            r, a = _count_sample(sample, gtindex, dpindex, covindex)
+            row[0, pop] += r
+            row[1, pop] += a
+        calls.append(row)
+
+    if not ids:
+        return [], np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    ref_alt = np.zeros((len(ids), 2, n_pops), dtype=np.int64)
+    for i, row in enumerate(calls):
+        if row is not None:
+            ref_alt[i] = row
+    if fast_rows:
+        # every sample field is exactly 'a?b' followed by a tab (or the newline)
+        gts = np.frombuffer(''.join(fast_tails).encode('ascii'), dtype=np.uint8)
+        gts = gts.reshape(len(fast_rows), n_samples, 4)[:, :, 0:3:2]
+        ref_alt[fast_rows, 0] = (gts == ord('0')).sum(axis=2) @ member
+        ref_alt[fast_rows, 1] = (gts == ord('1')).sum(axis=2) @ member
+
+    called = ref_alt[:, 0] + ref_alt[:, 1]
+    derived = np.where(np.array(derived_is_ref)[:, None], ref_alt[:, 0], ref_alt[:, 1])
+    table = np.column_stack([called, derived, np.array(polarized, dtype=np.int64)])
+    rows, index, inverse = np.unique(table, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(index, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    patterns = [_key(rows[i], n_pops) for i in order]
+    hashes = np.array([_snp_hash(i) for i in ids], dtype=np.uint64)
+    return patterns, hashes, rank[np.ravel(inverse)]
+
+def _key(row, n_pops):
+    return (tuple(int(v) for v in row[:n_pops]),
+            tuple(int(v) for v in row[n_pops:2*n_pops]),
+            bool(row[-1]))
+
+def _count_file(args):
+    """
+    _count_chunk result of a whole VCF file (one worker per file).
+    """
+    vcf_filename, popinfo, pop_ids, filter, chunk_lines = args
+    merged = _Merger()
+    chunks = _iter_chunks(vcf_filename, chunk_lines)
+    sample_pop = _sample_pops(next(chunks), popinfo, pop_ids)
+    for chunk in chunks:
+        merged.add(_count_chunk((chunk, sample_pop, len(pop_ids), filter)))
+    return merged.part()
+
+class _Merger:
+    """
+    Merge the chunk results in input order into one list of (pattern, count),
+    where a record repeating an earlier CHROM_POS replaces it, and patterns
+    are in dadi's first-occurrence order.
+    """
+    def __init__(self):
+        self.index = {}
+        self.patterns = []
+        self.hashes = []
+        self.pattern_of = []
+
+    def add(self, part):
+        patterns, hashes, pattern_of = part
+        ids = []
+        for key in patterns:
+            if key not in self.index:
+                self.index[key] = len(self.patterns)
+                self.patterns.append(key)
+            ids.append(self.index[key])
+        self.hashes.append(hashes)
+        self.pattern_of.append(np.array(ids, dtype=np.int64)[pattern_of])
+
+    def part(self):
+        """
+        Everything added so far as one chunk result, for merging files.
+        """
+        if not self.hashes:
+            return [], np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+        return list(self.patterns), np.concatenate(self.hashes), np.concatenate(self.pattern_of)
+
+    def result(self):
+        _, hashes, pattern_of = self.part()
+        if len(hashes) == 0:
+            return []
+        # every CHROM_POS keeps the position of its first record and the
+        # pattern of its last one, as a dict entry that is overwritten
+        order = np.argsort(hashes, kind='stable')
+        sorted_hashes = hashes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_hashes[1:] != sorted_hashes[:-1]])
+        ends = np.r_[starts[1:], len(order)] - 1
+        first_pos = order[starts]
+        final = pattern_of[order[ends]][np.argsort(first_pos, kind='stable')]
+        counts = np.bincount(final, minlength=len(self.patterns))
+        seen, first = np.unique(final, return_index=True)
+        return [(self.patterns[p], int(counts[p])) for p in seen[np.argsort(first, kind='stable')]]
+
+def count_dict_from_vcf(vcf_files, popinfo_filename, pop_ids, filter=True,
+                        processes=1, chunk_lines=20000):
+    """
+    Pattern histogram equivalent to dadi.Misc.count_data_dict(
+    make_data_dict_vcf(vcf, popinfo), pop_ids), built without a data dictionary.
+    vcf_files = one VCF path, or a list of VCFs (e.g. one per contig) treated
+                as their concatenation
+    processes = worker processes (chunks of one file, or one file per worker)
+    """
+    if isinstance(vcf_files, str):
+        vcf_files = [vcf_files]
+    popinfo = read_popinfo(popinfo_filename)
+    pop_ids = list(pop_ids)
+    merged = _Merger()
+    if processes <= 1:
+        for vcf_filename in vcf_files:
+            merged.add(_count_file((vcf_filename, popinfo, pop_ids, filter, chunk_lines)))
+    elif len(vcf_files) > 1:
+        tasks = [(f, popinfo, pop_ids, filter, chunk_lines) for f in vcf_files]
+        with multiprocessing.Pool(min(processes, len(vcf_files))) as pool:
+            for part in pool.imap(_count_file, tasks):
+                merged.add(part)
+    else:
+        chunks = _iter_chunks(vcf_files[0], chunk_lines)
+        sample_pop = _sample_pops(next(chunks), popinfo, pop_ids)
+        with multiprocessing.Pool(processes) as pool:
+            # keep a bounded number of chunks in flight, in submission order
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(
+                    _count_chunk, ((chunk, sample_pop, len(pop_ids), filter),)))
+                if len(pending) >= 2 * processes:
+                    merged.add(pending.popleft().get())
+            while pending:
+                merged.add(pending.popleft().get())
+    count_dict = collections.defaultdict(int)
+    for key, count in merged.result():
+        count_dict[key] += count
+    return count_dict
+
+@functools.lru_cache(maxsize=None)
+def _projection(n_to, n_from, hits):
+    """
+    Hypergeometric probabilities of 0..n_to derived copies when n_to of n_from
+    calls (hits of them derived) are sampled; zero if n_from < n_to.
+    """
+    k = np.arange(n_to + 1)
+    contrib = np.zeros(n_to + 1)
+    if n_from < n_to:
+        return contrib
+    valid = (k <= hits) & (n_to - k <= n_from - hits)
+    kv = k[valid]
+    contrib[valid] = np.exp(_lncomb(hits, kv) + _lncomb(n_from - hits, n_to - kv)
+                            - _lncomb(n_from, n_to))
+    return contrib
+
+def _lncomb(n, k):
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+def spectrum_from_count_dict(count_dict, projections, polarized=True, pop_ids=None,
+                             mask_corners=True):
+    """
+    Spectrum of a pattern histogram ({(called, derived, polarized): count}),
+    projected down to the sample sizes in projections. With polarized=False
+    every site counts and the spectrum is folded; otherwise only the
+    polarized sites count.
+    """
+    data = np.zeros(np.array(projections) + 1)
+    for (called, derived, this_polarized), count in count_dict.items():
+        if polarized and not this_polarized:
+            continue
+        contrib = _projection(projections[0], called[0], derived[0])
+        for n_to, n_from, hits in zip(projections[1:], called[1:], derived[1:]):
+            contrib = np.multiply.outer(contrib, _projection(n_to, n_from, hits))
+        data += count * contrib
+    fs = dadi.Spectrum(data, pop_ids=pop_ids, mask_corners=mask_corners)
+    return fs if polarized else fs.fold()
+
+def sfs_from_vcf(vcf_files, popinfo_filename, pop_ids, projections, polarized=True,
+                 mask_corners=True, filter=True, processes=1, chunk_lines=20000):
+    """
+    Spectrum equal (up to rounding) to dadi.Spectrum.from_data_dict(
+    make_data_dict_vcf(...), pop_ids, projections, mask_corners=mask_corners,
+    polarized=polarized), computed in a single streaming pass (see
+    count_dict_from_vcf).
+    """
+    count_dict = count_dict_from_vcf(vcf_files, popinfo_filename, pop_ids, filter=filter,
+                                     processes=processes, chunk_lines=chunk_lines)
+    return spectrum_from_count_dict(count_dict, projections, polarized, pop_ids,
+                                    mask_corners=mask_corners)
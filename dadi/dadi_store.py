@@ -0,0 +1,207 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi optimization results store
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Append-only SQLite store of finished optimization starts, used by
+dadi_parallel.fit_models to checkpoint long runs.
+
+Every start is written as soon as it finishes (initial params, popt,
+log-likelihood, theta, number of model evaluations, wall time), keyed on the
+run and the (model, start) pair. A run is identified by its configuration
+(models, data file contents, pts_l, number of starts, perturbation,
+maxiter) and its seed; a restarted run with seed=None picks up the seed of
+the last run with the same configuration, so it continues where it stopped
+and only the missing starts are optimized.
+
+Usage: python dadi_store.py <store.sqlite> [output_dir]
+prints the AIC comparison of the last run in the store (and writes
+output_dir/model_comparison.txt) without running anything.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import numpy as np
+
+_schema = """
+create table if not exists runs (
+    run_key text primary key, config_key text, seed text, config text, created real);
+create table if not exists models (
+    run_key text, model_index integer, model text, param_names text,
+    primary key (run_key, model));
+create table if not exists starts (
+    run_key text, model text, start integer, model_index integer, seed integer,
+    p0 text, popt text, ll real, theta real, n_evals integer, wall_time real,
+    pid integer, finished real, integrations integer, converged integer, grid_schedule text,
+    primary key (run_key, model, start));
+"""
+# columns added after the first version of the schema
+_added_columns = {'integrations': 'integer', 'converged': 'integer', 'grid_schedule': 'text'}
+
+def _func_id(func):
+    if hasattr(func, 'n_changes'):
+        return repr(func)
+    return f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+
+def run_config(models, data_fs, pts_l, n_starts, perturb, maxiter):
+    """
+    JSON-able description of a run; runs with the same description (and seed)
+    share their finished starts.
+    """
+    with open(data_fs, 'rb') as f:
+        data_sha1 = hashlib.sha1(f.read()).hexdigest()
+    return {
+        'models': [{k: (_func_id(v) if k == 'func' else v) for k, v in m.items()
+                    if k in ('name', 'func', 'param_names', 'lower_bound', 'upper_bound', 'initial_values')}
+                   for m in models],
+        'data_fs': os.path.abspath(data_fs),
+        'data_sha1': data_sha1,
+        'pts_l': pts_l.config() if hasattr(pts_l, 'config') else list(pts_l),
+        'n_starts': n_starts,
+        'perturb': getattr(perturb, '__name__', repr(perturb)),
+        'maxiter': maxiter
+    }
+
+class ResultStore:
+    """
+    SQLite store of finished starts.
+    path = database file (created if needed)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_schema)
+        columns = [row[1] for row in self.db.execute("pragma table_info(starts)")]
+        for name, kind in _added_columns.items():
+            if name not in columns:
+                self.db.execute(f"alter table starts add column {name} {kind}")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def open_run(self, config, seed=None):
+        """
+        (run_key, seed) of the run with this configuration and seed. With
+        seed=None the last run with this configuration is continued, or a
+        new seed is drawn.
+        """
+        text = json.dumps(config, sort_keys=True, default=float)
+        config_key = hashlib.sha1(text.encode()).hexdigest()
+        if seed is None:
+            row = self.db.execute("select seed from runs where config_key = ? order by created desc limit 1",
+                                  (config_key,)).fetchone()
+            seed = int(row[0]) if row is not None else np.random.SeedSequence().entropy
+        run_key = hashlib.sha1(f"{config_key}:{seed}".encode()).hexdigest()
+        self.db.execute("insert or ignore into runs values (?, ?, ?, ?, ?)",
+                        (run_key, config_key, str(seed), text, time.time()))
+        for mi, m in enumerate(config['models']):
+            self.db.execute("insert or ignore into models values (?, ?, ?, ?)",
+                            (run_key, mi, m['name'], json.dumps(list(m['param_names']))))
+        self.db.commit()
+        return run_key, seed
+
+    def add(self, run_key, rec):
+        """
+        Append one finished start (a dadi_parallel.fit_start record).
+        """
+        n_evals = sum(rec['cache'].values()) if 'cache' in rec else rec.get('n_evals')
+        integrations = rec['integrations'] if 'integrations' in rec else rec['cache']['misses'] if 'cache' in rec else None
+        converged = None if rec.get('converged') is None else int(rec['converged'])
+        schedule = rec.get('grid_schedule')
+        if schedule is not None:
+            schedule = json.dumps(schedule, default=float)
+        self.db.execute("insert or ignore into starts (run_key, model, start, model_index, seed, p0, popt, ll, "
+                        "theta, n_evals, wall_time, pid, finished, integrations, converged, grid_schedule) "
+                        "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (run_key, rec['model'], rec['start'], rec['model_index'], rec['seed'],
+                         json.dumps([float(p) for p in rec['p0']]),
+                         json.dumps([float(p) for p in rec['popt']]),
+                         float(rec['ll']), float(rec['theta']), n_evals,
+                         rec['wall_time'], rec['pid'], time.time(), integrations, converged, schedule))
+        self.db.commit()
+
+    def finished(self, run_key):
+        """
+        Records of the finished starts of a run, keyed on (model, start).
+        The model spectrum is not stored ('model_fs' is None).
+        """
+        rows = self.db.execute("select model, start, model_index, seed, p0, popt, ll, theta, n_evals, "
+                               "wall_time, pid, integrations, converged, grid_schedule from starts "
+                               "where run_key = ?", (run_key,))
+        records = {}
+        for (model, start, mi, seed, p0, popt, ll, theta, n_evals, wall, pid, integrations,
+             converged, schedule) in rows:
+            schedule = None if schedule is None else json.loads(schedule)
+            records[(model, start)] = {
+                'model_index': mi, 'model': model, 'start': start, 'seed': seed,
+                'p0': json.loads(p0), 'popt': np.array(json.loads(popt)), 'll': ll,
+                'theta': theta, 'n_evals': n_evals, 'model_fs': None, 'wall_time': wall,
+                'pid': pid, 'integrations': integrations,
+                'converged': None if converged is None else bool(converged),
+                'grid_schedule': schedule, 'pts_l': None if schedule is None else schedule[-1]['pts_l'],
+                'stored': True
+            }
+        return records
+
+    def last_run(self):
+        row = self.db.execute("select run_key from runs order by created desc limit 1").fetchone()
+        return None if row is None else row[0]
+
+    def comparison(self, run_key):
+        """
+        Best start of every model of a run with its AIC, sorted by AIC:
+        list of {'name', 'parameters', 'log_likelihood', 'AIC', 'theta', 'starts'}.
+        """
+        results = []
+        models = self.db.execute("select model, param_names from models where run_key = ? order by model_index",
+                                 (run_key,)).fetchall()
+        for name, param_names in models:
+            param_names = json.loads(param_names)
+            # first start with the highest log-likelihood, as in fit_models
+            rows = self.db.execute("select popt, ll, theta from starts where run_key = ? and model = ? "
+                                   "order by ll desc, start asc", (run_key, name)).fetchall()
+            if len(rows) == 0:
+                continue
+            popt, ll, theta = rows[0]
+            results.append({
+                'name': name,
+                'parameters': dict(zip(param_names, np.array(json.loads(popt)))),
+                'log_likelihood': ll,
+                'AIC': 2 * len(param_names) - 2 * ll,
+                'theta': theta,
+                'starts': len(rows)
+            })
+        results.sort(key=lambda x: x['AIC'])
+        return results
+
+def write_comparison(results, path):
+    """
+    model_comparison.txt in the dadi_demography.py format.
+    """
+    best_model = results[0]
+    with open(path, 'w') as f:
+        f.write("Model Comparison by AIC:\n")
+        f.write("-------------------------\n")
+        for result in results:
+            f.write(f"{result['name']}: AIC = {result['AIC']:.2f}, Δ AIC = {result['AIC'] - best_model['AIC']:.2f}\n")
+        f.write(f"\nBest model: {best_model['name']} (AIC = {best_model['AIC']:.2f})\n")
+        f.write(f"Parameters: {best_model['parameters']}\n")
+        f.write(f"Log-likelihood: {best_model['log_likelihood']}\n")
+
+if __name__ == '__main__':
+    store = ResultStore(sys.argv[1])
+    run_key = store.last_run()
+    if run_key is None:
+        sys.exit(f"No runs in {sys.argv[1]}")
+    results = store.comparison(run_key)
+    best_model = results[0]
+    print("Model Comparison by AIC:")
+    for result in results:
+        print(f"{result['name']}: AIC = {result['AIC']:.2f}, Δ AIC = {result['AIC'] - best_model['AIC']:.2f} "
+              f"({result['starts']} starts)")
+    if len(sys.argv) > 2:
+        write_comparison(results, os.path.join(sys.argv[2], 'model_comparison.txt'))
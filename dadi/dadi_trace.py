@@ -0,0 +1,105 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi run trace
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Trace of where the time of a dadi run goes, written next to its results as
+<prefix>.json and <prefix>.csv.
+
+For every (model, start) it records the func_ex calls of the optimizer and
+how they were served (memory and disk cache hits, integrations), the number
+of integrations and their time for every grid size of pts_l, the numbers of
+objective and gradient evaluations of the optimizer ('func_calls' and
+'gradient_calls'; optimize_log does not report its BFGS iterations), the wall
+time and the worker process.
+These are the fields fit_start adds to its records (the per-grid timings come
+from dadi_cache.CachedExtrapFunc); starts read back from a result store were
+not run, and have no counts ('stored' is true). The JSON file also has the
+totals per model and any run information passed in (grids, processes...), the
+CSV file one row per start with one integrations/seconds column pair per grid
+size.
+
+A cProfile dump of every start is written by fit_models / race_models when
+they are given a profile_dir (see dadi_parallel.fit_start); read it with
+python -m pstats <file>.
+"""
+import csv
+import json
+
+def start_trace(rec):
+    """
+    JSON-able trace of one start record.
+    """
+    cache = rec.get('cache')
+    grid_time = rec.get('grid_time') or {}
+    return {
+        'model': rec['model'],
+        'start': rec['start'],
+        'seed': rec.get('seed'),
+        'pid': rec.get('pid'),
+        'stored': bool(rec.get('stored', False)),
+        'rung': rec.get('rung'),
+        'wall_time': rec.get('wall_time'),
+        'll': float(rec['ll']),
+        'converged': rec.get('converged'),
+        'func_ex_calls': None if cache is None else sum(cache.values()),
+        'cache_hits': None if cache is None else cache['hits'] + cache['disk_hits'],
+        'integrations': rec.get('integrations', None if cache is None else cache['misses']),
+        'func_calls': rec.get('func_calls'),
+        'gradient_calls': rec.get('grad_calls'),
+        'grid_time': {str(pts): {'integrations': n, 'seconds': sec}
+                      for pts, (n, sec) in sorted(grid_time.items())}
+    }
+
+def model_totals(starts):
+    """
+    Totals of the start traces of one model.
+    """
+    run = [s for s in starts if not s['stored']]
+    grids = {}
+    for s in run:
+        for pts, entry in s['grid_time'].items():
+            total = grids.setdefault(pts, {'integrations': 0, 'seconds': 0.0})
+            total['integrations'] += entry['integrations']
+            total['seconds'] += entry['seconds']
+    return {
+        'starts': len(starts),
+        'stored': len(starts) - len(run),
+        'wall_time': sum(s['wall_time'] or 0 for s in run),
+        'func_ex_calls': sum(s['func_ex_calls'] or 0 for s in run),
+        'integrations': sum(s['integrations'] or 0 for s in run),
+        'func_calls': sum(s['func_calls'] or 0 for s in run),
+        'gradient_calls': sum(s['gradient_calls'] or 0 for s in run),
+        'grid_time': dict(sorted(grids.items(), key=lambda kv: int(kv[0])))
+    }
+
+def write_trace(prefix, fits, run=None):
+    """
+    Write <prefix>.json and <prefix>.csv for the summaries returned by
+    dadi_parallel.fit_models or dadi_halving.race_models.
+    run = optional dictionary of run information stored in the JSON file
+    Returns the two paths.
+    """
+    models = []
+    rows = []
+    for fit in fits:
+        starts = [start_trace(r) for r in fit['starts']]
+        models.append({'name': fit['name'], 'totals': model_totals(starts), 'starts': starts})
+        rows += starts
+    with open(prefix + '.json', 'w') as f:
+        json.dump({'run': run or {}, 'models': models}, f, indent=1, default=str)
+
+    grids = sorted({int(pts) for r in rows for pts in r['grid_time']})
+    fields = ['model', 'start', 'seed', 'pid', 'stored', 'rung', 'wall_time', 'll', 'converged',
+              'func_ex_calls', 'cache_hits', 'integrations', 'func_calls', 'gradient_calls']
+    with open(prefix + '.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields + [f"{name}_{pts}" for pts in grids
+                                  for name in ('integrations', 'seconds')])
+        for r in rows:
+            cells = [r[k] for k in fields]
+            for pts in grids:
+                entry = r['grid_time'].get(str(pts))
+                cells += [None, None] if entry is None else [entry['integrations'], f"{entry['seconds']:.4f}"]
+            writer.writerow(cells)
+    return [prefix + '.json', prefix + '.csv']
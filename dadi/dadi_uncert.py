@@ -0,0 +1,158 @@
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+# Dadi parameter uncertainties (FIM / Godambe) on a process pool
+##### ---------- ##### ---------- ##### ---------- ##### ---------- #####
+#!/usr/bin/env python3
+"""
+Standard errors of the best-fit parameters from the Fisher information
+matrix (or the Godambe information matrix, given bootstrap spectra), as
+computed by dadi.Godambe.FIM_uncert / GIM_uncert, with the model evaluations
+run on a process pool.
+
+The finite-difference Hessian of a k-parameter model (plus theta, as dadi
+does for multinomial fits) needs the model spectrum at a fixed set of
+perturbed parameter vectors, which only depends on the best fit and eps.
+That set is enumerated first with the step sizes of dadi.Godambe.get_hess,
+with duplicates removed: the diagonal and off-diagonal entries share their
+points, and perturbations of theta only rescale a spectrum, so they cost
+nothing. This is 1 + 2k + 2k(k-1) integrations (129 for four_changes). All
+points of all models are then integrated on one pool, and dadi's FIM_uncert /
+GIM_uncert run unchanged on a func_ex that looks the spectra up by their
+rounded parameters (as dadi_cache.make_key does). A point dadi asks for that
+was not precomputed (e.g. if a dadi version changes its step sizes) is
+integrated on the spot, so this only costs time.
+"""
+import multiprocessing
+import os
+import dadi
+import numpy as np
+import dadi_cache
+
+def uncertainty_points(popt, eps=0.01, log=False):
+    """
+    Model parameter vectors at which dadi.Godambe evaluates the model for
+    the finite-difference Hessian around popt (in log parameters if log),
+    without duplicates; popt itself comes first. Steps are eps times the
+    parameter, or eps with one-sided differences where that is below 1e-6.
+    """
+    p0 = np.log(popt) if log else np.array(popt, dtype=float)
+    two_sided = (p0 != 0) & (p0 * eps >= 1e-6)
+    steps = np.where(two_sided, eps * p0, eps)
+    points = {}
+    def add(offsets):
+        p = p0.copy()
+        for i, k in offsets:
+            p[i] += k * steps[i]
+        params = tuple(float(v) for v in (np.exp(p) if log else p))
+        points.setdefault(dadi_cache.round_params(params), params)
+    add([])
+    k = len(p0)
+    for i in range(k):
+        for s in ([1, -1] if two_sided[i] else [1, 2]):
+            add([(i, s)])
+        for j in range(i + 1, k):
+            if two_sided[i] and two_sided[j]:
+                for si in (1, -1):
+                    for sj in (1, -1):
+                        add([(i, si), (j, sj)])
+            else:
+                add([(i, 1), (j, 1)])
+                add([(i, 1)])
+                add([(j, 1)])
+    return list(points.values())
+
+def _evaluate(task):
+    """
+    Model spectrum at one parameter vector, in a worker.
+    """
+    mi, model, params, ns, pts_l, cache_dir = task
+    func_ex = dadi_cache.cached_extrap_func(model, cache_dir=cache_dir)
+    return mi, params, func_ex(np.array(params), ns, pts_l)
+
+class _Lookup:
+    """
+    func_ex for dadi.Godambe that returns the precomputed spectra, keyed on
+    rounded parameters, and integrates any other point directly.
+    """
+    def __init__(self, table, model, cache_dir):
+        self.table = table
+        self.model = model
+        self.cache_dir = cache_dir
+        self.extra = 0
+
+    def __call__(self, params, ns, pts):
+        key = dadi_cache.round_params(params)
+        if key not in self.table:
+            func_ex = dadi_cache.cached_extrap_func(self.model, cache_dir=self.cache_dir)
+            self.table[key] = func_ex(np.array(params), ns, pts)
+            self.extra += 1
+        return self.table[key]
+
+def fit_uncertainties(models, fits, data, pts_l, eps=0.01, log=False, processes=None,
+                      cache_dir=None, boots=None):
+    """
+    Uncertainties of the best fit of every model.
+    models = list of model dictionaries
+    fits = summaries returned by dadi_parallel.fit_models (or race_models)
+    data = folded data Spectrum
+    pts_l = grid sizes (the grids of each best fit are used if recorded)
+    eps, log = as in dadi.Godambe.FIM_uncert
+    processes = pool size; 1 evaluates serially in this process
+    boots = optional list of bootstrap spectra of the data, for Godambe (GIM)
+            uncertainties instead of FIM ones
+
+    Returns one dictionary per model: 'se' = standard errors of the parameters
+    and of theta (last entry; NaN when the matrix cannot be inverted),
+    'method' ('FIM' or 'GIM'), 'integrations' (number of distinct model
+    evaluations) and 'extra' (those not precomputed on the pool).
+    """
+    ns = data.sample_sizes
+    tasks = []
+    grids = []
+    for mi, (model, fit) in enumerate(zip(models, fits)):
+        grid = list(fit['best'].get('pts_l') or getattr(pts_l, 'pts_l', pts_l))
+        grids.append(grid)
+        if len(model['param_names']) == 0:
+            continue
+        popt = [float(p) for p in fit['best']['popt']]
+        for params in uncertainty_points(popt, eps, log):
+            tasks.append((mi, model, params, ns, grid, cache_dir))
+    # larger models have more points, hand them out first
+    tasks.sort(key=lambda t: (-len(t[1]['param_names']), t[0]))
+
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, len(tasks)))
+    spectra = [{} for m in models]
+    if processes == 1:
+        results = map(_evaluate, tasks)
+        for mi, params, fs in results:
+            spectra[mi][dadi_cache.round_params(params)] = fs
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            for mi, params, fs in pool.imap_unordered(_evaluate, tasks, chunksize=4):
+                spectra[mi][dadi_cache.round_params(params)] = fs
+
+    uncerts = []
+    for mi, (model, fit) in enumerate(zip(models, fits)):
+        if len(model['param_names']) == 0:
+            uncerts.append({'se': np.array([]), 'method': None, 'integrations': 0, 'extra': 0})
+            continue
+        func_ex = _Lookup(spectra[mi], model, cache_dir)
+        popt = [float(p) for p in fit['best']['popt']]
+        with np.errstate(invalid='ignore'):
+            try:
+                if boots is None:
+                    se = dadi.Godambe.FIM_uncert(func_ex, grids[mi], popt, data, log=log, eps=eps)
+                else:
+                    se = dadi.Godambe.GIM_uncert(func_ex, grids[mi], boots, popt, data, log=log, eps=eps)
+            except np.linalg.LinAlgError:
+                se = np.full(len(popt) + 1, np.nan)
+        uncerts.append({'se': np.asarray(se), 'method': 'FIM' if boots is None else 'GIM',
+                        'integrations': len(func_ex.table), 'extra': func_ex.extra})
+    return uncerts
+
+def format_se(param_names, se):
+    """
+    {name: standard error} of the parameters and theta.
+    """
+    return dict(zip(list(param_names) + ['theta'], [float(s) for s in se]))
@@ -0,0 +1,49 @@
+"""
+SizeChangeModel against the model functions it replaced in
+dadi_demography.py, and its batched evaluation against single calls.
+"""
+import dadi
+import numpy as np
+import pytest
+import dadi_models
+
+def reference_model(n_changes):
+    """
+    The no_change ... four_changes functions of dadi_demography.py.
+    """
+    def model(params, ns, pts):
+        xx = dadi.Numerics.default_grid(pts)
+        phi = dadi.PhiManip.phi_1D(xx)
+        if n_changes == 0:
+            phi = dadi.Integration.one_pop(phi, xx, 5.0, params[0])
+        else:
+            for nu, T in zip(params[:n_changes], params[n_changes:]):
+                phi = dadi.Integration.one_pop(phi, xx, T, nu)
+        return dadi.Spectrum.from_phi(phi, ns, [xx])
+    return model
+
+PARAMS = {0: [1.5], 1: [2.0, 0.5], 2: [2.0, 0.5, 0.5, 0.1],
+          3: [2.0, 1.0, 0.5, 0.5, 0.2, 0.1], 4: [2.0, 1.5, 1.0, 0.5, 0.5, 0.3, 0.2, 0.1]}
+
+@pytest.mark.parametrize('n_changes', sorted(PARAMS))
+def test_matches_reference(n_changes):
+    model = dadi_models.SizeChangeModel(n_changes)
+    assert model.__name__ == dadi_models._names[n_changes]
+    expected = reference_model(n_changes)(PARAMS[n_changes], [20], 40)
+    np.testing.assert_allclose(model(PARAMS[n_changes], [20], 40), expected, rtol=1e-12)
+
+def test_extrap_matches_reference():
+    params = PARAMS[2]
+    expected = dadi.Numerics.make_extrap_log_func(reference_model(2))(params, [20], [30, 40, 50])
+    fs = dadi.Numerics.make_extrap_log_func(dadi_models.SizeChangeModel(2))(params, [20], [30, 40, 50])
+    np.testing.assert_allclose(fs, expected, rtol=1e-12)
+
+def test_batch_matches_single_calls():
+    model = dadi_models.SizeChangeModel(2)
+    # the second vector shares its oldest epoch with the first
+    batch = [PARAMS[2], [2.0, 0.8, 0.5, 0.3], [1.0, 1.0, 0.2, 0.2]]
+    func_ex = dadi.Numerics.make_extrap_log_func(model)
+    spectra = model.batch_extrap(batch, [20], [30, 40, 50])
+    for params, fs in zip(batch, spectra):
+        expected = func_ex(params, [20], [30, 40, 50])
+        np.testing.assert_allclose(fs[1:-1], expected.data[1:-1], rtol=1e-10)
@@ -0,0 +1,62 @@
+"""
+fit_models gives the same summaries in serial and on a process pool, and a
+run saved in a result store is resumed without running its starts again.
+"""
+import sqlite3
+import dadi
+import numpy as np
+import pytest
+import dadi_cache
+import dadi_models
+import dadi_parallel
+
+PTS_L = [30, 40, 50]
+
+def size_models():
+    return [{'name': m.__name__, 'func': m, 'param_names': m.param_names,
+             'lower_bound': [0.01] * len(m.param_names), 'upper_bound': [100] * len(m.param_names),
+             'initial_values': [1.0] * m.n_changes + [0.5] * m.n_changes}
+            for m in (dadi_models.SizeChangeModel(1), dadi_models.SizeChangeModel(2))]
+
+@pytest.fixture
+def data_fs(tmp_path):
+    func_ex = dadi.Numerics.make_extrap_log_func(dadi_models.SizeChangeModel(2))
+    np.random.seed(1)
+    fs = (5000 * func_ex([2.0, 0.5, 0.5, 0.1], [20], PTS_L)).sample().fold()
+    path = str(tmp_path / 'data.fs')
+    fs.to_file(path)
+    return path
+
+def fit(data_fs, **kwargs):
+    # the in-process model spectrum cache would serve the second run
+    dadi_cache._caches.clear()
+    return dadi_parallel.fit_models(size_models(), data_fs, PTS_L, 3, seed=7, maxiter=5, **kwargs)
+
+def assert_same_fits(fits, expected):
+    assert [f['name'] for f in fits] == [f['name'] for f in expected]
+    for fit, ref in zip(fits, expected):
+        assert [r['start'] for r in fit['starts']] == [r['start'] for r in ref['starts']]
+        for r, s in zip(fit['starts'], ref['starts']):
+            assert r['seed'] == s['seed']
+            np.testing.assert_allclose(r['popt'], s['popt'], rtol=1e-10)
+            assert r['ll'] == pytest.approx(s['ll'], rel=1e-10)
+        assert fit['best']['start'] == ref['best']['start']
+        np.testing.assert_allclose(fit['best']['model_fs'], ref['best']['model_fs'], rtol=1e-10)
+
+def test_serial_matches_parallel(data_fs):
+    serial = fit(data_fs, processes=1)
+    parallel = fit(data_fs, processes=3)
+    assert_same_fits(parallel, serial)
+
+def test_store_resume(data_fs, tmp_path):
+    store = str(tmp_path / 'fits.sqlite')
+    first = fit(data_fs, processes=1, store=store)
+    resumed = fit(data_fs, processes=1, store=store)
+    assert all(r.get('stored') for f in resumed for r in f['starts'])
+    assert_same_fits(resumed, first)
+    # an interrupted run: the last start of every model is missing
+    with sqlite3.connect(store) as db:
+        db.execute("delete from starts where start = 2")
+    resumed = fit(data_fs, processes=1, store=store)
+    assert [bool(r.get('stored')) for r in resumed[0]['starts']] == [True, True, False]
+    assert_same_fits(resumed, first)
@@ -0,0 +1,59 @@
+"""
+sfs_from_vcf against dadi's make_data_dict_vcf + Spectrum.from_data_dict on a
+small random VCF with missing calls, filtered and non-SNP rows, unpolarized
+sites and duplicated positions (adjacent and not).
+"""
+import dadi
+import numpy as np
+import pytest
+import dadi_sfs_stream
+
+POPS = {'A': 5, 'B': 4}
+
+@pytest.fixture(scope='module')
+def vcf(tmp_path_factory):
+    rng = np.random.default_rng(3)
+    folder = tmp_path_factory.mktemp('vcf')
+    samples = [f"{pop}{i}" for pop, n in POPS.items() for i in range(n)]
+    with open(folder / 'popinfo.txt', 'w') as f:
+        for s in samples:
+            f.write(f"{s}\t{s[0]}\n")
+    rows = []
+    for pos in range(1, 301):
+        ref, alt = rng.choice(list('ACGT'), 2, replace=False)
+        if rng.random() < 0.05:
+            alt = 'AT'
+        aa = rng.choice([ref, alt, ref.lower(), '.', None])
+        info = 'DP=10' if aa is None else f"DP=10;AA={aa}"
+        flt = 'LowQual' if rng.random() < 0.05 else rng.choice(['PASS', '.'])
+        freq = rng.random()
+        gts = []
+        for _ in samples:
+            if rng.random() < 0.1:
+                gts.append('./.')
+            else:
+                a, b = (rng.random(2) < freq).astype(int)
+                gts.append(f"{a}/{b}")
+        rows.append(['1', str(pos), '.', ref, alt, '50', flt, info, 'GT'] + gts)
+    # duplicated positions: one next to the original, one much later in the file
+    rows.insert(11, rows[10][:3] + rows[20][3:])
+    rows.append(rows[50][:3] + rows[60][3:])
+    with open(folder / 'data.vcf', 'w') as f:
+        f.write("##fileformat=VCFv4.2\n")
+        f.write("\t".join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples) + "\n")
+        for row in rows:
+            f.write("\t".join(row) + "\n")
+    return str(folder / 'data.vcf'), str(folder / 'popinfo.txt')
+
+@pytest.mark.parametrize('polarized', [True, False])
+@pytest.mark.parametrize('processes, chunk_lines', [(1, 20000), (1, 7), (3, 7)])
+def test_matches_dadi(vcf, polarized, processes, chunk_lines):
+    vcf_path, popinfo = vcf
+    projections = [8, 6]
+    dd = dadi.Misc.make_data_dict_vcf(vcf_path, popinfo)
+    expected = dadi.Spectrum.from_data_dict(dd, list(POPS), projections, polarized=polarized)
+    fs = dadi_sfs_stream.sfs_from_vcf(vcf_path, popinfo, list(POPS), projections, polarized=polarized,
+                                      processes=processes, chunk_lines=chunk_lines)
+    assert fs.folded == expected.folded
+    np.testing.assert_array_equal(fs.mask, expected.mask)
+    np.testing.assert_allclose(fs.data, expected.data, rtol=1e-10, atol=1e-12)
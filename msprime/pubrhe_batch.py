@@ -0,0 +1,242 @@
+## Batch runner for the simulations: expand a manifest of models x replicates x rates into tasks with derived seeds, run
+## them on a local worker pool, skip the tasks whose outputs already exist and validate, and keep a ledger of every run.
+##
+## Usage: python pubrhe_batch.py manifest.json [--processes P] [--dry-run] [--trace]
+##
+## The manifest is a JSON file; only "models" is required:
+##   {"models": ["fsc2-3", "5-deme_re-estimated"],   fsc2-3, fsc2-4 or Demes files, as for pubrhe_msprimeSimulations
+##    "replicates": 100,                              replicates 1..100, or [first, last]
+##    "recomb_rates": [1e-8], "mut_rates": [1.08e-8], every combination is run
+##    "length": 223000000, "segments": 1,             sequence length, split into independent segments
+##    "output": "sfs", "format": "vcf",               as --output and --format of pubrhe_msprimeSimulations
+##    "branch_sfs": false, "samples": null, "size_scale": 0.5,
+##    "seed": null,                                   batch seed, mixed into every task seed
+##    "stats": false, "window_size": 1000000,         windowed statistics, as --stats and --window-size
+##    "out_dir": "batch"}                             outputs, traces and ledger
+##
+## Every task is one replicate of one model at one (recombination rate, mutation rate); its outputs are named
+## <out_dir>/<model>.r<recomb rate>.mu<mut rate>.<rep> plus the extension of pubrhe_output.py or pubrhe_sfs.write_sfs, and
+## its seed is derived from the model, the rates, the replicate number and the batch seed only, so a task gives the same
+## output whatever the rest of the manifest, the order of the runs or the number of processes. Tasks whose outputs all
+## validate (pubrhe_output.validate_output) are skipped, so an interrupted batch is resumed by running it again, and a
+## manifest can be extended with more replicates or rates. A task is only skipped when the configuration it was run with,
+## saved in <output>.json when it finishes (its seed, the length, segments, output, format, branch_sfs, samples,
+## size_scale, stats and window_size of the manifest, and a hash of the compiled demography), is the current one;
+## otherwise it is run again and its outputs overwritten. The segments of a task are simulated one after the other;
+## the pool runs P tasks at a time, each in a fresh worker process, so the peak memory of a task is its own.
+## Every finished (or failed) task is appended to <out_dir>/ledger.tsv as it ends, with its seed, status, wall time,
+## peak RSS, numbers of trees and sites, and files; with --trace (or "trace": true) the steps of every task are also
+## written to <output>.trace.json/.csv (see pubrhe_trace.py). With "stats" the windowed statistics of every task
+## (pubrhe_stats.py, both modes) are written to <output>.stats.npz.
+
+import os
+import sys
+import json
+import time
+import zlib
+import argparse
+import traceback
+import multiprocessing
+import numpy as np
+import pubrhe_demes
+import pubrhe_output
+import pubrhe_segments
+import pubrhe_sfs
+import pubrhe_stats
+import pubrhe_trace
+
+DEFAULTS = {"replicates": 1, "recomb_rates": [1e-8], "mut_rates": [1.08e-8], "length": 223000000, "segments": 1, "output": "sfs", "format": "vcf",
+	"branch_sfs": False, "samples": None, "size_scale": 0.5, "seed": None, "out_dir": "batch", "trace": False, "stats": False, "window_size": 1000000};
+
+CONFIG_KEYS = ["length", "segments", "output", "format", "branch_sfs", "samples", "size_scale", "stats", "window_size"];
+
+LEDGER_FIELDS = ["task", "model", "rep", "recomb_rate", "mut_rate", "seed", "status", "wall_time", "peak_rss_mb", "num_trees", "num_sites", "files", "finished", "error"];
+
+def read_manifest(path):
+	#Manifest dictionary with the defaults filled in.
+	with open(path) as fid:
+		manifest = json.load(fid);
+	unknown = set(manifest) - set(DEFAULTS) - {"models"};
+	if len(unknown) > 0:
+		raise ValueError("Unknown manifest keys: " + ", ".join(sorted(unknown)));
+	if "models" not in manifest:
+		raise ValueError("The manifest has no \"models\"");
+	full = dict(DEFAULTS);
+	full.update(manifest);
+	if full["output"] not in ("vcf", "sfs", "both"):
+		raise ValueError("output must be vcf, sfs or both");
+	if full["format"] not in pubrhe_output.FORMATS:
+		raise ValueError("format must be one of " + ", ".join(pubrhe_output.FORMATS));
+	return full;
+
+def _rate_key(rate):
+	return zlib.crc32(repr(float(rate)).encode());
+
+def task_seed(model, recomb_rate, mut_rate, rep, seed=None):
+	#Replicate seed of one task (split into segment seeds by pubrhe_segments.segment_seeds).
+	entropy = [zlib.crc32(model.encode()), _rate_key(recomb_rate), _rate_key(mut_rate), rep] + ([seed] if seed is not None else []);
+	return int(np.random.SeedSequence(entropy).generate_state(1)[0]);
+
+def task_name(model, recomb_rate, mut_rate, rep):
+	return model + ".r" + ("%g" % recomb_rate) + ".mu" + ("%g" % mut_rate) + "." + str(rep);
+
+def expand(manifest):
+	#One task dictionary per (model, recombination rate, mutation rate, replicate), in manifest order.
+	reps = manifest["replicates"];
+	reps = range(reps[0], reps[1] + 1) if isinstance(reps, list) else range(1, reps + 1);
+	tasks = [];
+	for model in manifest["models"]:
+		name, _ = pubrhe_demes.resolve_model(model);
+		for r in manifest["recomb_rates"]:
+			for mu in manifest["mut_rates"]:
+				for rep in reps:
+					task = task_name(name, r, mu, rep);
+					tasks.append({"task": task, "model": model, "name": name, "rep": rep, "recomb_rate": r, "mut_rate": mu, "seed": task_seed(name, r, mu, rep, manifest["seed"]),
+						"prefix": os.path.join(manifest["out_dir"], task)});
+	return tasks;
+
+def task_outputs(task, manifest):
+	#Files a finished task has written.
+	paths = [];
+	if manifest["output"] in ("vcf", "both"):
+		paths.append(pubrhe_output.output_path(task["prefix"], manifest["format"]));
+	if manifest["output"] in ("sfs", "both"):
+		paths += [task["prefix"] + ".fs", task["prefix"] + "_MAFpop0.obs"];
+		if manifest["branch_sfs"]:
+			paths += [task["prefix"] + ".branch.fs", task["prefix"] + ".branch_MAFpop0.obs"];
+	if manifest["stats"]:
+		paths.append(task["prefix"] + ".stats.npz");
+	return paths;
+
+def task_config(task, manifest, compiled):
+	#Everything the outputs of a task depend on, as saved in its <prefix>.json.
+	config = {k: task[k] for k in ("model", "rep", "recomb_rate", "mut_rate", "seed")};
+	config.update({k: manifest[k] for k in CONFIG_KEYS});
+	config["demography"] = pubrhe_demes.demography_hash(compiled["demography"], compiled["samples"]);
+	#as read back from the file
+	return json.loads(json.dumps(config));
+
+def read_config(prefix):
+	try:
+		with open(prefix + ".json") as fid:
+			return json.load(fid);
+	except (OSError, ValueError):
+		return None;
+
+def write_config(prefix, config):
+	tmp = prefix + ".json.tmp";
+	with open(tmp, "w") as out:
+		json.dump(config, out, indent=1);
+	os.replace(tmp, prefix + ".json");
+
+def is_done(task, manifest, compiled):
+	#Outputs all there and valid, and written with the current configuration.
+	if read_config(task["prefix"]) != task_config(task, manifest, compiled):
+		return False;
+	return all(pubrhe_output.validate_output(p) for p in task_outputs(task, manifest));
+
+def run_task(job):
+	#Simulate one task in a worker; returns its ledger row (status "failed" with the error if it raised).
+	task, manifest, compiled = job;
+	t0 = time.time();
+	trace = pubrhe_trace.Trace();
+	row = {k: task[k] for k in ("task", "model", "rep", "recomb_rate", "mut_rate", "seed")};
+	try:
+		#the outputs are overwritten: the record of an earlier run no longer describes them
+		if os.path.isfile(task["prefix"] + ".json"):
+			os.remove(task["prefix"] + ".json");
+		length = manifest["length"];
+		mutRate = task["mut_rate"] if manifest["branch_sfs"] else None;
+		args = (compiled["demography"], compiled["samples"], length, task["recomb_rate"], task["mut_rate"], task["seed"]);
+		if manifest["stats"]:
+			bounds = pubrhe_segments.split_genome(length, manifest["segments"]);
+			breaks, windowSegment = pubrhe_stats.window_breaks(bounds, manifest["window_size"]);
+			statsConfig = pubrhe_stats.stats_config();
+		if manifest["output"] == "sfs":
+			#spectra summed over the segments, never merged
+			writeSegment = pubrhe_sfs.SegmentSfs(mutRate);
+			if manifest["stats"]:
+				writeSegment = pubrhe_stats.SegmentStats(bounds, manifest["window_size"], statsConfig, writeSegment);
+			segmentSfs = pubrhe_segments.simulate_segments(*args, n_segments=manifest["segments"], write_segment=writeSegment, trace=trace);
+			if manifest["stats"]:
+				segmentSfs, stats = pubrhe_stats.split_segment_stats(segmentSfs);
+			files = pubrhe_sfs.write_sfs(task["prefix"], pubrhe_sfs.add_sfs(segmentSfs), length);
+		else:
+			mutated_tree = pubrhe_segments.simulate_segments(*args, n_segments=manifest["segments"], trace=trace);
+			files = [trace.call("write_output", pubrhe_output.write_output, mutated_tree, task["prefix"], manifest["format"])];
+			if manifest["output"] == "both":
+				with trace.step("sfs"):
+					files += pubrhe_sfs.write_sfs(task["prefix"], pubrhe_sfs.segment_sfs(mutated_tree, mutRate), length);
+			if manifest["stats"]:
+				stats = trace.call("stats", pubrhe_stats.windowed_stats, mutated_tree, breaks, statsConfig);
+		if manifest["stats"]:
+			files.append(pubrhe_stats.write_stats(task["prefix"], stats, breaks, windowSegment, statsConfig));
+		write_config(task["prefix"], task_config(task, manifest, compiled));
+		row["status"] = "done";
+		row["files"] = ",".join(os.path.basename(f) for f in files);
+	except Exception as e:
+		row["status"] = "failed";
+		row["error"] = repr(e);
+		traceback.print_exc();
+	segments = [e for e in trace.events if e["step"] == "sim_mutations"];
+	row["num_trees"] = sum(e["num_trees"] for e in segments);
+	row["num_sites"] = sum(e["num_sites"] for e in segments);
+	row["wall_time"] = "%.2f" % (time.time() - t0);
+	row["peak_rss_mb"] = "%.1f" % pubrhe_trace.peak_rss_mb();
+	row["finished"] = time.strftime("%Y-%m-%d %H:%M:%S");
+	if manifest["trace"]:
+		trace.write(task["prefix"], {k: task[k] for k in ("task", "model", "rep", "recomb_rate", "mut_rate", "seed")});
+	return row;
+
+def append_ledger(path, row):
+	new = not os.path.isfile(path);
+	with open(path, "a") as out:
+		if new:
+			out.write("\t".join(LEDGER_FIELDS) + "\n");
+		out.write("\t".join(str(row.get(k, "")) for k in LEDGER_FIELDS) + "\n");
+
+def run_batch(manifest, processes=1, dry_run=False, DEBUG=False):
+	#Run every task of the manifest whose outputs are missing or incomplete; returns the ledger rows of this run.
+	os.makedirs(manifest["out_dir"], exist_ok=True);
+	tasks = expand(manifest);
+	#every model is compiled (or read from the compiled-model cache) once, here
+	samples = pubrhe_demes.parse_samples(manifest["samples"]) if manifest["samples"] is not None else None;
+	compiled = {};
+	for t in tasks:
+		if t["model"] not in compiled:
+			compiled[t["model"]] = pubrhe_demes.load_model(t["model"], manifest["size_scale"], samples, os.path.join(pubrhe_demes.DEMES_DIR, ".compiled"))[1];
+	todo = [t for t in tasks if not is_done(t, manifest, compiled[t["model"]])];
+	if DEBUG: print(str(len(tasks)) + " task(s), " + str(len(tasks) - len(todo)) + " already done, " + str(len(todo)) + " to run on " + str(processes) + " process(es)");
+	if dry_run:
+		for t in todo:
+			print(t["task"] + "\tseed " + str(t["seed"]));
+		return [];
+	if manifest["output"] in ("sfs", "both"):
+		for t in todo:
+			pubrhe_sfs.check_single_deme(compiled[t["model"]]["samples"]);
+	ledger = os.path.join(manifest["out_dir"], "ledger.tsv");
+	rows = [];
+	if len(todo) > 0:
+		#one task per worker process, so ru_maxrss is the peak of that task alone
+		with multiprocessing.Pool(min(processes, len(todo)), maxtasksperchild=1) as pool:
+			for row in pool.imap_unordered(run_task, [(t, manifest, compiled[t["model"]]) for t in todo], chunksize=1):
+				append_ledger(ledger, row);
+				rows.append(row);
+				if DEBUG: print(row["task"] + "\t" + row["status"] + "\t" + row["wall_time"] + " s\t" + row["peak_rss_mb"] + " MB");
+	return rows;
+
+parser = argparse.ArgumentParser(description="Run a manifest of simulation replicates on a local worker pool.");
+parser.add_argument("manifest", help="JSON manifest (see the top of this file)");
+parser.add_argument("--processes", type=int, default=1, help="tasks run at the same time");
+parser.add_argument("--dry-run", action="store_true", help="list the tasks left to run, with their seeds, and exit");
+parser.add_argument("--trace", action="store_true", help="write the steps of every task to <output>.trace.json/.csv");
+
+if __name__ == "__main__":
+	args = parser.parse_args();
+	manifest = read_manifest(args.manifest);
+	if args.trace:
+		manifest["trace"] = True;
+	rows = run_batch(manifest, args.processes, args.dry_run, DEBUG=True);
+	failed = [r["task"] for r in rows if r["status"] == "failed"];
+	if len(failed) > 0:
+		sys.exit(str(len(failed)) + " task(s) failed: " + ", ".join(failed));
@@ -0,0 +1,148 @@
+## Helpers for pubrhe_msprimeSimulations: build the msprime demography from a Demes YAML file in demes/.
+##
+## The Demes files hold the fastsimcoal2 estimates, whose sizes count gene copies; msprime sizes count diploid
+## individuals, so sizes are scaled by 0.5 by default (as the hand-coded fsc2-3/fsc2-4 models did). The compiled
+## model (validated and sorted msprime.Demography, sample configuration and DemographyDebugger coalescence-rate
+## tables) is pickled in a cache keyed on the YAML contents and options, so batch runs of many replicates skip
+## parsing and validating the YAML every time the script starts.
+
+import os
+import hashlib
+import pickle
+import tempfile
+import numpy as np
+import demes
+import msprime
+
+DEMES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demes");
+
+#Model names used before the Demes files, kept so their output names and seeds do not change.
+MODEL_ALIASES = {"fsc2-3": "1-deme_3.yaml", "fsc2-4": "1-deme_4.yaml"};
+#Deme (name, description) of the hand-coded fsc2-3/fsc2-4 models, kept for the aliases because the population
+#name ends up in the VCF/.trees metadata of their outputs.
+ALIAS_DEMES = {"fsc2-3": {"Rhesus_Single": ("Rhesus", "Single Rhesus Population")},
+	"fsc2-4": {"Rhesus_Single": ("Rhesus", "Single Rhesus Population")}};
+
+#Diploid sample sizes of the sampled demes (half the haploid sample sizes of the fastsimcoal2 .tpl files).
+DEFAULT_SAMPLES = {"Rhesus": 79, "Rhesus_Single": 79, "tcheliensis": 5, "littoralis": 28, "brevicaudus": 5, "lasiotis": 31, "mulatta": 10, "mul_lit_las": 69};
+
+def resolve_model(model):
+	#(model name, YAML path) for an alias, a path, or a file name (with or without .yaml) in demes/.
+	if model in MODEL_ALIASES:
+		return model, os.path.join(DEMES_DIR, MODEL_ALIASES[model]);
+	for path in [model, os.path.join(DEMES_DIR, model), os.path.join(DEMES_DIR, model + ".yaml")]:
+		if os.path.isfile(path):
+			return os.path.splitext(os.path.basename(path))[0], path;
+	available = sorted(MODEL_ALIASES) + sorted(f for f in os.listdir(DEMES_DIR) if f.endswith(".yaml"));
+	raise ValueError("Model " + model + " does not exist. Available: " + ", ".join(available));
+
+def parse_samples(text):
+	#"deme=n,deme=n" -> {deme: n} (diploid individuals).
+	samples = {};
+	for item in text.split(","):
+		name, n = item.split("=");
+		samples[name.strip()] = int(n);
+	return samples;
+
+def rename_demes(data, renames):
+	#Rename demes of a Demes dictionary in place; renames = {old name: (new name, new description)}.
+	names = {old: new for old, (new, _) in renames.items()};
+	for d in data["demes"]:
+		if d["name"] in renames:
+			d["name"], d["description"] = renames[d["name"]];
+		d["ancestors"] = [names.get(a, a) for a in d.get("ancestors", [])];
+	for m in data.get("migrations", []):
+		for key in ("source", "dest"):
+			if key in m:
+				m[key] = names.get(m[key], m[key]);
+		if "demes" in m:
+			m["demes"] = [names.get(a, a) for a in m["demes"]];
+	for p in data.get("pulses", []):
+		p["sources"] = [names.get(a, a) for a in p.get("sources", [])];
+		p["dest"] = names.get(p["dest"], p["dest"]);
+
+def scaled_graph(path, size_scale=0.5, renames=None):
+	#Demes graph with every deme size multiplied by size_scale (growth rates and times are unchanged), and the
+	#demes in renames renamed.
+	data = demes.load_asdict(path);
+	if renames:
+		rename_demes(data, renames);
+	epochs = [e for d in data["demes"] for e in d.get("epochs", [])];
+	epochs += [data.get("defaults", {}).get("epoch", {})];
+	epochs += [d.get("defaults", {}).get("epoch", {}) for d in data["demes"]];
+	for epoch in epochs:
+		for key in ("start_size", "end_size"):
+			if key in epoch:
+				epoch[key] = epoch[key] * size_scale;
+	return demes.Graph.fromdict(data);
+
+def default_samples(graph):
+	#Sample sizes for the demes present at time 0.
+	extant = [d.name for d in graph.demes if d.end_time == 0];
+	if len(extant) == 1 and extant[0] not in DEFAULT_SAMPLES:
+		return {extant[0]: 79};
+	missing = [name for name in extant if name not in DEFAULT_SAMPLES];
+	if len(missing) > 0:
+		raise ValueError("No default sample size for deme(s) " + ", ".join(missing) + "; use --samples");
+	return {name: DEFAULT_SAMPLES[name] for name in extant};
+
+def coalescence_tables(demog, samples, n_steps=200):
+	#Pairwise coalescence rates (and probabilities of not having coalesced) through time for every pair of sampled
+	#demes, from the DemographyDebugger: {"steps": times, "pairs": {(a, b): (rates, P)}, "epoch_times", "sizes"}.
+	debugger = demog.debug();
+	oldest = max(debugger.epoch_start_time);
+	if oldest == 0:
+		oldest = 4 * max(p.initial_size for p in demog.populations);
+	steps = np.concatenate([[0.0], np.geomspace(1, 10 * oldest, n_steps - 1)]);
+	names = list(samples);
+	pairs = {};
+	for i, a in enumerate(names):
+		for b in names[i:]:
+			lineages = {a: 2} if a == b else {a: 1, b: 1};
+			pairs[(a, b)] = debugger.coalescence_rate_trajectory(steps, lineages);
+	return {"steps": steps, "pairs": pairs, "epoch_times": np.array(debugger.epoch_start_time), "sizes": debugger.population_size_history};
+
+def compile_model(path, size_scale=0.5, samples=None, renames=None):
+	#Compiled model of one YAML file: {"demography", "samples", "coalescence", "source"}.
+	graph = scaled_graph(path, size_scale, renames);
+	demog = msprime.Demography.from_demes(graph).validate();
+	demog.sort_events();
+	if samples is None:
+		samples = default_samples(graph);
+	return {"demography": demog, "samples": samples, "coalescence": coalescence_tables(demog, samples), "source": path};
+
+def cache_key(path, size_scale, samples, renames=None):
+	h = hashlib.sha1();
+	with open(path, "rb") as f:
+		h.update(f.read());
+	h.update(repr((size_scale, sorted(samples.items()) if samples else None, sorted(renames.items()) if renames else None, msprime.__version__, demes.__version__)).encode());
+	return h.hexdigest();
+
+def demography_hash(demog, samples):
+	#SHA-1 of a compiled demography and its samples, to tell whether a saved simulation was run with the same model.
+	return hashlib.sha1(repr((demog, samples)).encode()).hexdigest();
+
+def load_model(model, size_scale=0.5, samples=None, cache_dir=None, DEBUG=False):
+	#(model name, compiled model), read from the cache in cache_dir/<model name>/ when the YAML, options and
+	#library versions are unchanged, compiled (and cached) otherwise. cache_dir=None disables the cache.
+	name, path = resolve_model(model);
+	renames = ALIAS_DEMES.get(model);
+	if cache_dir is None:
+		return name, compile_model(path, size_scale, samples, renames);
+	cache_path = os.path.join(cache_dir, name, cache_key(path, size_scale, samples, renames) + ".pkl");
+	if os.path.isfile(cache_path):
+		if DEBUG: print("Using compiled model " + cache_path);
+		with open(cache_path, "rb") as f:
+			return name, pickle.load(f);
+	compiled = compile_model(path, size_scale, samples, renames);
+	try:
+		os.makedirs(os.path.dirname(cache_path), exist_ok=True);
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp");
+		with os.fdopen(fd, "wb") as f:
+			pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL);
+		os.replace(tmp, cache_path);
+		if DEBUG: print("Cached compiled model " + cache_path);
+	except OSError as e:
+		#a read-only or full cache directory only costs the compilation time
+		if DEBUG: print("Could not cache compiled model: " + str(e));
+	return name, compiled;
@@ -1,80 +1,152 @@
-## Usage: python pubrhe.msprimeSimulations_v0.03.py ModelName ReplicateNumber
+## Usage: python pubrhe.msprimeSimulations_v0.03.py ModelName ReplicateNumber [--segments N | --segment-lengths L1,L2,...] [--processes P] [--seed S] [--per-segment]
+##                                                   [--output vcf|sfs|both] [--format vcf|vcf.gz|geno|trees] [--branch-sfs] [--samples deme=n,...]
+##                                                   [--size-scale X] [--cache-dir DIR] [--trace] [--profile FILE]
+##                                                   [--stats] [--window-size W] [--stats-modes site,branch] [--ld-sites N]
+##
+## ModelName is fsc2-3 or fsc2-4 (demes/1-deme_3.yaml and demes/1-deme_4.yaml) or any Demes YAML file, e.g. 5-deme_re-estimated
+## or demes/3-deme_brvFirst.yaml; the compiled demography is cached (see pubrhe_demes.py).
+## With --segments/--segment-lengths the genome is simulated as independent segments on a process pool (see pubrhe_segments.py);
+## the outputs are merged into one VCF, or written one VCF per segment with --per-segment.
+## With --output sfs (or both) the folded site frequency spectrum is computed straight from the tree sequence and written as
+## dadi .fs and fastsimcoal2 _MAFpop0.obs files (see pubrhe_sfs.py), skipping the VCF (or in addition to it).
+## --format sets how the genotypes are written: plain VCF (the default), BGZF-compressed VCF, chunked NumPy genotype arrays
+## with the site positions, or the .trees file itself (see pubrhe_output.py). When the segments are simulated in this
+## process (--processes 1) the outputs are written on a background thread while the next segment is simulated, and the
+## merged output while the spectra are computed.
+## With --trace the wall time, peak RSS and tree/site counts of every sim_ancestry, sim_mutations and output step are
+## written to <file-header>.trace.json/.csv (see pubrhe_trace.py); --profile saves cProfile statistics of the run.
+## With --stats the windowed diversity, Tajima's D, folded spectra and LD decay of every deme are computed from the tree
+## sequence and written to <file-header>-0.stats.npz (see pubrhe_stats.py): on the merged tree sequence, its windows split
+## over the --processes workers, or in the segment workers when the segments are not merged.
 
 #import libraries to be used.
 import sys
 import os
+import argparse
 import msprime
 import tskit
+import pubrhe_segments
+import pubrhe_sfs
+import pubrhe_demes
+import pubrhe_output
+import pubrhe_trace
+import pubrhe_stats
 
 DEBUG=True;
 
-model=sys.argv[1];
-rep=int(sys.argv[2]);
-nrep = 1;
-samp = 79;
+parser = argparse.ArgumentParser(description="Simulate a replicate under a Demes model.");
+parser.add_argument("model", help="fsc2-3, fsc2-4, or a Demes YAML file (a path, or a file name in demes/)");
+parser.add_argument("rep", type=int, help="replicate number");
+parser.add_argument("--segments", type=int, default=1, help="number of equal-length segments to simulate independently");
+parser.add_argument("--segment-lengths", default=None, help="comma-separated segment lengths (must add up to the sequence length)");
+parser.add_argument("--processes", type=int, default=1, help="worker processes for the segments");
+parser.add_argument("--seed", type=int, default=None, help="replicate seed (default: derived from the model name and replicate number)");
+parser.add_argument("--per-segment", action="store_true", help="write one VCF per segment instead of merging");
+parser.add_argument("--output", choices=["vcf", "sfs", "both"], default="vcf", help="write the VCF, the spectrum files, or both");
+parser.add_argument("--format", choices=pubrhe_output.FORMATS, default="vcf", help="genotype output: VCF, bgzipped VCF, chunked .npy genotypes, or the .trees file");
+parser.add_argument("--samples", default=None, help="comma-separated deme=diploids (default: the fastsimcoal2 sample sizes)");
+parser.add_argument("--size-scale", type=float, default=0.5, help="factor applied to the Demes sizes (default 0.5: gene copies to diploids)");
+parser.add_argument("--cache-dir", default=os.path.join(pubrhe_demes.DEMES_DIR, ".compiled"), help="compiled-model cache folder (\"none\" to disable)");
+parser.add_argument("--trace", action="store_true", help="write the timings and memory of every step to <file-header>.trace.json/.csv");
+parser.add_argument("--profile", default=None, help="save cProfile statistics of the run to this file");
+parser.add_argument("--branch-sfs", action="store_true", help="also write the branch (expected) spectrum with the site spectrum");
+parser.add_argument("--stats", action="store_true", help="write windowed diversity, Tajima's D, spectra and LD decay to <file-header>-0.stats.npz");
+parser.add_argument("--window-size", type=int, default=1000000, help="window size of --stats in bp (default 1 Mb)");
+parser.add_argument("--stats-modes", default="site,branch", help="comma-separated modes of --stats: site, branch or both");
+parser.add_argument("--ld-sites", type=int, default=100, help="sites per block of the LD decay of --stats");
 
-#Define model based on command line argument
-if DEBUG: print("Setting Demography based on " + model);
-demog = msprime.Demography()
+if __name__ == "__main__":
+	args = parser.parse_args();
+	profiler = pubrhe_trace.start_profile(args.profile);
+	if args.cache_dir == "none":
+		args.cache_dir = None;
+	model=args.model;
+	rep=args.rep;
 
-recombRate = 1e-8;
+	#Define model based on command line argument: a Demes YAML file (fsc2-3/fsc2-4 are the 1-deme_3/1-deme_4 files)
+	if DEBUG: print("Setting Demography based on " + model);
+	samples = pubrhe_demes.parse_samples(args.samples) if args.samples is not None else None;
+	try:
+		model, compiled = pubrhe_demes.load_model(model, args.size_scale, samples, args.cache_dir, DEBUG=DEBUG);
+	except ValueError as e:
+		print(str(e) + " Exiting.");
+		exit();
+	demog = compiled["demography"];
+	samp = compiled["samples"];
+	if DEBUG: print(samp);
 
-if ( model == "fsc2-3" ):
-	NCur = 126626/2;
-	N_T1 = 374873/2;
-	N_T2 = 219439/2;
-	N_T3 = 65196/2;
-	
-	T1 = 562;
-	T2 = 31130;
-	T3 = 68368;
-	
-	demog.add_population(name="Rhesus", description="Single Rhesus Population", initial_size=NCur, growth_rate=0);
-	demog.add_population_parameters_change(time=T1, initial_size=N_T1, population="Rhesus");
-	demog.add_population_parameters_change(time=T2, initial_size=N_T2, population="Rhesus");
-	demog.add_population_parameters_change(time=T3, initial_size=N_T3, population="Rhesus");
+	recombRate = 1e-8;
+	mutRate = 1.08e-8;
+	seqLength = 223000000;
 
-elif ( model == "fsc2-4" ):
-	NCur = 160646/2;
-	N_T1 = 640374/2;
-	N_T2 = 275692/2;
-	N_T3 = 393753/2;
-	N_T4 = 60170/2;
-	
-	T1 = 1707;
-	T2 = 9494;
-	T3 = 42956;
-	T4 = 67421;
-	
-	demog.add_population(name="Rhesus", description="Single Rhesus Population", initial_size=NCur, growth_rate=0);
-	demog.add_population_parameters_change(time=T1, initial_size=N_T1, population="Rhesus");
-	demog.add_population_parameters_change(time=T2, initial_size=N_T2, population="Rhesus");
-	demog.add_population_parameters_change(time=T3, initial_size=N_T3, population="Rhesus");
-	demog.add_population_parameters_change(time=T4, initial_size=N_T4, population="Rhesus");
-	
-else:
-	print("Model " + model + " does not exist. Exiting.");
-	exit();
+	segment_lengths = None;
+	if args.segment_lengths is not None:
+		segment_lengths = [int(x) for x in args.segment_lengths.split(",")];
+	seed = pubrhe_segments.replicate_seed(model, rep, args.seed);
+	outHeader = "[/path/to/output/folder/file-header]." + model + "." + str(rep);
 
-demog.sort_events();
+	#Windows of the statistics, none spanning two segments
+	if args.stats:
+		bounds = pubrhe_segments.split_genome(seqLength, args.segments, segment_lengths);
+		breaks, windowSegment = pubrhe_stats.window_breaks(bounds, args.window_size);
+		statsConfig = pubrhe_stats.stats_config(args.stats_modes.split(","), args.ld_sites);
 
-#Make Tree(s)
-if DEBUG: print("Making Tree");
-treeRep = msprime.sim_ancestry(samp, demography=demog, recombination_rate = recombRate, sequence_length = 223000000, num_replicates=nrep);
-if DEBUG: print(treeRep);
+	#Make and mutate tree(s), one per segment
+	background = pubrhe_output.BackgroundWriter();
+	trace = pubrhe_trace.Trace();
+	if DEBUG: print("Making Tree");
+	writeVcf = args.output in ("vcf", "both");
+	writeSfs = args.output in ("sfs", "both");
+	if writeSfs:
+		try:
+			pubrhe_sfs.check_single_deme(samp);
+		except ValueError as e:
+			print(str(e) + ". Exiting.");
+			exit();
+	if writeSfs and (args.per_segment or not writeVcf):
+		#spectra are summed over the segments in the workers, so the segments are never merged
+		vcfWriter = pubrhe_output.segment_writer(outHeader, args.format, args.processes, background) if writeVcf else None;
+		writeSegment = pubrhe_sfs.SegmentSfs(mutRate if args.branch_sfs else None, vcfWriter);
+		if args.stats:
+			writeSegment = pubrhe_stats.SegmentStats(bounds, args.window_size, statsConfig, writeSegment);
+		segmentSfs = pubrhe_segments.simulate_segments(demog, samp, seqLength, recombRate, mutRate, seed, n_segments=args.segments, segment_lengths=segment_lengths, processes=args.processes, write_segment=writeSegment, trace=trace, DEBUG=DEBUG);
+		if args.stats:
+			segmentSfs, stats = pubrhe_stats.split_segment_stats(segmentSfs);
+		paths = pubrhe_sfs.write_sfs(outHeader + "-0", pubrhe_sfs.add_sfs(segmentSfs), seqLength);
+		if DEBUG: print(paths);
+	elif args.per_segment:
+		writeSegment = pubrhe_output.segment_writer(outHeader, args.format, args.processes, background);
+		if args.stats:
+			writeSegment = pubrhe_stats.SegmentStats(bounds, args.window_size, statsConfig, writeSegment);
+		paths = pubrhe_segments.simulate_segments(demog, samp, seqLength, recombRate, mutRate, seed, n_segments=args.segments, segment_lengths=segment_lengths, processes=args.processes, write_segment=writeSegment, trace=trace, DEBUG=DEBUG);
+		if args.stats:
+			paths, stats = pubrhe_stats.split_segment_stats(paths);
+		if DEBUG: print(paths);
+	else:
+		mutated_tree = pubrhe_segments.simulate_segments(demog, samp, seqLength, recombRate, mutRate, seed, n_segments=args.segments, segment_lengths=segment_lengths, processes=args.processes, trace=trace, DEBUG=DEBUG);
+		if DEBUG: print(mutated_tree);
 
-#Mutate Tree(s)
-ntree=0
-for tree in treeRep:
-	#Mutate each tree generated individually
-	if DEBUG: print(tree);
-	if DEBUG: print("Mutating Tree");
-	mutated_tree = msprime.sim_mutations(tree, rate=1.08e-8);
-	if DEBUG: print(mutated_tree);
-	
-	#Output vcf to scratch folder.
-	out = open("[/path/to/output/folder/file-header]." + model + "." + str(rep) + "-" + str(ntree) + ".SNPs.vcf", "w");
-	tskit.TreeSequence.write_vcf(mutated_tree, out);
-	ntree = ntree + 1;
+		#Output vcf to scratch folder (on the writer thread, while the spectra are computed).
+		ntree=0
+		if writeVcf:
+			background.submit(trace.call, "write_output", pubrhe_output.write_output, mutated_tree, outHeader + "-" + str(ntree), args.format);
+		if writeSfs:
+			with trace.step("sfs"):
+				paths = pubrhe_sfs.write_sfs(outHeader + "-" + str(ntree), pubrhe_sfs.segment_sfs(mutated_tree, mutRate if args.branch_sfs else None), seqLength);
+			if DEBUG: print(paths);
+		if args.stats:
+			with trace.step("stats"):
+				stats = pubrhe_stats.windowed_stats(mutated_tree, breaks, statsConfig, args.processes);
 
-if DEBUG: print("done.")
+	if args.stats:
+		path = pubrhe_stats.write_stats(outHeader + "-0", stats, breaks, windowSegment, statsConfig);
+		if DEBUG: print(path);
+
+	#wait for the writer thread to finish the outputs
+	background.close();
+	pubrhe_trace.stop_profile(profiler, args.profile);
+	if args.trace:
+		run = {"model": model, "rep": rep, "seed": seed, "segments": args.segments, "processes": args.processes, "output": args.output, "format": args.format};
+		paths = trace.write(outHeader, run);
+		if DEBUG: print(paths);
+	if DEBUG: print("done.")
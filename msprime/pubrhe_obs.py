@@ -0,0 +1,152 @@
+## Reader and writer of the fastsimcoal2 observed spectra (fastsimcoal2/*/sfs-files/), shared by the msprime and dadi
+## scripts; it needs only NumPy (the dadi conversions are in dadi/dadi_fsc_obs.py).
+##
+## Both the 1-deme <prefix>_MAFpopX.obs files (one row of n+1 counts) and the joint <prefix>_jointMAFpopX_Y.obs files
+## (a (nX+1) x (nY+1) matrix, rows are deme X, columns deme Y) are parsed into ObsSpectrum objects: the counts as a
+## NumPy array plus the deme index of each axis, from which the d<pop>_<i> labels of the file are rebuilt.
+##
+## load_obs() keeps a binary copy of each parsed file (a .npy file plus a .json record of the source size, modification
+## time and SHA-1) and returns it memory-mapped read-only, so many workers share one copy of the data without parsing
+## the text. The copy is rebuilt when the source file changes.
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+NAME_RE = re.compile(r"_(joint)?MAFpop(\d+)(?:_(\d+))?\.obs$");
+
+class ObsSpectrum:
+	#One fastsimcoal2 observed spectrum.
+	#data = counts, shape (n+1,) or (nX+1, nY+1); a read-only memmap when returned by load_obs
+	#pops = deme index of each axis, e.g. (0,) or (2, 0) for _jointMAFpop2_0
+	#path = source file, if any
+	#The first entry (all axes 0) holds the monomorphic sites.
+	def __init__(self, data, pops, path=None):
+		if len(pops) != np.ndim(data):
+			raise ValueError(str(len(pops)) + " deme indices for a " + str(np.ndim(data)) + "-dimensional spectrum");
+		self.data = data;
+		self.pops = tuple(int(p) for p in pops);
+		self.path = path;
+
+	def __repr__(self):
+		return "ObsSpectrum(shape=" + str(self.data.shape) + ", pops=" + str(self.pops) + ")";
+
+	@property
+	def sample_sizes(self):
+		return [n - 1 for n in self.data.shape];
+
+	@property
+	def labels(self):
+		#d<pop>_<i> labels of every axis, as in the .obs file.
+		return [["d" + str(p) + "_" + str(i) for i in range(n)] for p, n in zip(self.pops, self.data.shape)];
+
+	def to_file(self, path):
+		#Write the spectrum in fastsimcoal2 .obs format.
+		with open(path, "w") as fid:
+			fid.write("1 observation\n");
+			if self.data.ndim == 1:
+				fid.write("\t".join(self.labels[0]) + "\n");
+				fid.write(format_row(self.data) + "\n\n");
+			else:
+				rows, cols = self.labels;
+				fid.write("\t" + "\t".join(cols) + "\n");
+				for label, row in zip(rows, self.data):
+					fid.write(label + "\t" + format_row(row) + "\n");
+
+def format_row(values):
+	return " ".join(("%d" % v) if float(v).is_integer() else ("%.10g" % v) for v in values);
+
+def parse_obs(path):
+	#Parse one .obs file (text) into an ObsSpectrum.
+	with open(path) as fid:
+		lines = [line.rstrip("\n") for line in fid];
+	lines = [line for line in lines if line.strip()];
+	if not lines[0].split()[0] == "1":
+		raise ValueError(path + ": only files with 1 observation are supported");
+	if not lines[1].startswith("\t"):
+		#one deme: labels, then one row of counts
+		labels = lines[1].split();
+		data = np.array(lines[2].split(), dtype=float);
+		pops = [label_pop(labels[0])];
+	else:
+		#joint: column labels, then one labelled row per entry of the first deme
+		cols = lines[1].split();
+		rows = [line.split(None, 1) for line in lines[2:]];
+		data = np.array([r[1].split() for r in rows], dtype=float);
+		pops = [label_pop(rows[0][0]), label_pop(cols[0])];
+		if data.shape[1] != len(cols):
+			raise ValueError(path + ": " + str(data.shape[1]) + " columns for " + str(len(cols)) + " labels");
+	return ObsSpectrum(data, pops, path);
+
+def label_pop(label):
+	return int(label[1:].split("_")[0]);
+
+def _source_stat(path):
+	st = os.stat(path);
+	return st.st_size, st.st_mtime_ns;
+
+def _sha1(path):
+	with open(path, "rb") as fid:
+		return hashlib.sha1(fid.read()).hexdigest();
+
+def cache_paths(path, cache_dir=None):
+	#(.npy, .json) cache files of one source file; cache_dir defaults to a .obs_cache folder next to it.
+	path = os.path.abspath(path);
+	if cache_dir is None:
+		cache_dir = os.path.join(os.path.dirname(path), ".obs_cache");
+	stem = os.path.basename(path) + "." + hashlib.sha1(path.encode()).hexdigest()[:12];
+	return os.path.join(cache_dir, stem + ".npy"), os.path.join(cache_dir, stem + ".json");
+
+def load_obs(path, cache_dir=None):
+	#ObsSpectrum of one .obs file with data memory-mapped from the binary cache, which is (re)built when missing or
+	#when the source has changed (the size or modification time differ and so does the SHA-1). If the cache cannot be
+	#written the parsed spectrum is returned in memory.
+	npy_path, json_path = cache_paths(path, cache_dir);
+	size, mtime = _source_stat(path);
+	try:
+		with open(json_path) as fid:
+			record = json.load(fid);
+	except (OSError, ValueError):
+		record = None;
+	if record is not None and os.path.exists(npy_path):
+		if (record["size"], record["mtime_ns"]) == (size, mtime):
+			return ObsSpectrum(np.load(npy_path, mmap_mode="r"), record["pops"], path);
+		if record["sha1"] == _sha1(path):
+			#touched (e.g. by a checkout) but unchanged
+			record["size"], record["mtime_ns"] = size, mtime;
+			try:
+				_write_json(json_path, record);
+			except OSError:
+				pass;
+			return ObsSpectrum(np.load(npy_path, mmap_mode="r"), record["pops"], path);
+	obs = parse_obs(path);
+	try:
+		os.makedirs(os.path.dirname(npy_path), exist_ok=True);
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(npy_path), suffix=".tmp");
+		with os.fdopen(fd, "wb") as fid:
+			np.save(fid, obs.data);
+		os.replace(tmp, npy_path);
+		_write_json(json_path, {"source": os.path.abspath(path), "size": size, "mtime_ns": mtime, "sha1": _sha1(path), "pops": list(obs.pops)});
+	except OSError:
+		return obs;
+	return ObsSpectrum(np.load(npy_path, mmap_mode="r"), obs.pops, path);
+
+def _write_json(json_path, record):
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(json_path), suffix=".tmp");
+	with os.fdopen(fd, "w") as fid:
+		json.dump(record, fid);
+	os.replace(tmp, json_path);
+
+def load_obs_dir(folder, cache_dir=None):
+	#All .obs files of a folder (e.g. fastsimcoal2/5-deme/sfs-files), as a dict keyed on the deme indices of the file
+	#name: {(0,): ...} or {(1, 0): ..., (2, 0): ..., ...}.
+	spectra = {};
+	for name in sorted(os.listdir(folder)):
+		if NAME_RE.search(name) is None:
+			continue;
+		obs = load_obs(os.path.join(folder, name), cache_dir);
+		spectra[obs.pops] = obs;
+	return spectra;
@@ -0,0 +1,228 @@
+## Helpers for pubrhe_msprimeSimulations: genotype output formats for the simulated tree sequences, and a background
+## writer thread.
+##
+## Formats ("--format"):
+##  - vcf: plain-text .SNPs.vcf (tskit's write_vcf), as before;
+##  - vcf.gz: the same VCF, BGZF-compressed (blocked gzip, readable by gzip/zcat and indexable by tabix), .SNPs.vcf.gz;
+##  - geno: a .geno folder of chunked NumPy arrays: genotypes.<k>.npy (int8 allele indices, sites x sample nodes,
+##    chunk_sites rows per chunk), positions.<k>.npy (float64 site positions) and meta.json (sample nodes and their
+##    populations, sequence length, number of sites and chunks), written last;
+##  - trees: the mutated tree sequence itself (.trees, tskit.load), from which any of the above can be made later.
+## Every file is written under a temporary name and renamed when complete, so an existing output is a finished one.
+##
+## BackgroundWriter runs the encoding and writing on a thread, so the main thread can go on simulating the next
+## segment or replicate (msprime and tskit release the GIL in their C code). At most max_pending outputs wait in the
+## queue, which bounds the memory held by tree sequences not yet written.
+
+import os
+import json
+import queue
+import shutil
+import struct
+import threading
+import zlib
+import zipfile
+import numpy as np
+import tskit
+
+FORMATS = ("vcf", "vcf.gz", "geno", "trees");
+EXTENSIONS = {"vcf": ".SNPs.vcf", "vcf.gz": ".SNPs.vcf.gz", "geno": ".geno", "trees": ".trees"};
+
+#BGZF: gzip members of at most 64 KiB with a "BC" extra field holding the member size, then an empty end-of-file member.
+_BGZF_INPUT = 65280;
+_BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000");
+
+class BgzfWriter:
+	#Text file object writing BGZF-compressed output.
+	def __init__(self, path, level=6):
+		self.fid = open(path, "wb");
+		self.level = level;
+		self.buffer = bytearray();
+
+	def write(self, text):
+		self.buffer += text.encode() if isinstance(text, str) else text;
+		while len(self.buffer) >= _BGZF_INPUT:
+			self._block(bytes(self.buffer[:_BGZF_INPUT]));
+			del self.buffer[:_BGZF_INPUT];
+		return len(text);
+
+	def _block(self, data):
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15);
+		deflated = compressor.compress(data) + compressor.flush();
+		header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(deflated) + 25);
+		self.fid.write(header + deflated + struct.pack("<2I", zlib.crc32(data) & 0xffffffff, len(data)));
+
+	def close(self):
+		if len(self.buffer) > 0:
+			self._block(bytes(self.buffer));
+			self.buffer = bytearray();
+		self.fid.write(_BGZF_EOF);
+		self.fid.close();
+
+	def __enter__(self):
+		return self;
+
+	def __exit__(self, *exc):
+		self.close();
+
+def output_path(prefix, fmt):
+	return prefix + EXTENSIONS[fmt];
+
+def _write_vcf(ts, tmp):
+	with open(tmp, "w") as out:
+		ts.write_vcf(out);
+
+def _write_vcf_gz(ts, tmp):
+	with BgzfWriter(tmp) as out:
+		ts.write_vcf(out);
+
+def _write_geno(ts, tmp, chunk_sites=65536):
+	os.makedirs(tmp);
+	samples = ts.samples();
+	n_chunks = 0;
+	genotypes = np.empty((chunk_sites, len(samples)), dtype=np.int8);
+	positions = np.empty(chunk_sites);
+	filled = 0;
+	def flush():
+		nonlocal n_chunks, filled;
+		np.save(os.path.join(tmp, "genotypes." + str(n_chunks) + ".npy"), genotypes[:filled]);
+		np.save(os.path.join(tmp, "positions." + str(n_chunks) + ".npy"), positions[:filled]);
+		n_chunks += 1;
+		filled = 0;
+	for var in ts.variants(copy=False):
+		genotypes[filled] = var.genotypes;
+		positions[filled] = var.site.position;
+		filled += 1;
+		if filled == chunk_sites:
+			flush();
+	if filled > 0:
+		flush();
+	meta = {"samples": samples.tolist(), "populations": ts.tables.nodes.population[samples].tolist(), "sequence_length": ts.sequence_length,
+		"num_sites": ts.num_sites, "chunk_sites": chunk_sites, "num_chunks": n_chunks};
+	with open(os.path.join(tmp, "meta.json"), "w") as out:
+		json.dump(meta, out);
+
+def _write_trees(ts, tmp):
+	ts.dump(tmp);
+
+WRITERS = {"vcf": _write_vcf, "vcf.gz": _write_vcf_gz, "geno": _write_geno, "trees": _write_trees};
+
+def write_output(ts, prefix, fmt="vcf"):
+	#Write one tree sequence in the given format; returns the path. The output is renamed into place when complete.
+	path = output_path(prefix, fmt);
+	tmp = path + ".tmp";
+	if os.path.isdir(tmp):
+		shutil.rmtree(tmp);
+	WRITERS[fmt](ts, tmp);
+	if fmt == "geno" and os.path.isdir(path):
+		shutil.rmtree(path);
+	os.replace(tmp, path);
+	return path;
+
+def read_geno(path):
+	#(positions, genotypes, meta) of a .geno folder, chunks concatenated.
+	with open(os.path.join(path, "meta.json")) as fid:
+		meta = json.load(fid);
+	chunks = range(meta["num_chunks"]);
+	positions = np.concatenate([np.load(os.path.join(path, "positions." + str(k) + ".npy")) for k in chunks]) if meta["num_chunks"] > 0 else np.zeros(0);
+	genotypes = np.concatenate([np.load(os.path.join(path, "genotypes." + str(k) + ".npy")) for k in chunks]) if meta["num_chunks"] > 0 else np.zeros((0, len(meta["samples"])), dtype=np.int8);
+	return positions, genotypes, meta;
+
+def validate_output(path):
+	#True if path is a complete output: one of the formats above, a .fs / _MAFpop0.obs file of pubrhe_sfs.write_sfs, or a
+	#.stats.npz file of pubrhe_stats.write_stats.
+	try:
+		if path.endswith(".geno"):
+			with open(os.path.join(path, "meta.json")) as fid:
+				meta = json.load(fid);
+			return all(os.path.isfile(os.path.join(path, name + "." + str(k) + ".npy")) for k in range(meta["num_chunks"]) for name in ("genotypes", "positions"));
+		if path.endswith(".trees"):
+			tskit.load(path);
+			return True;
+		if path.endswith(".npz"):
+			with np.load(path) as data:
+				return "breaks" in data.files;
+		with open(path, "rb") as fid:
+			if path.endswith(".vcf.gz"):
+				fid.seek(0, os.SEEK_END);
+				if fid.tell() < len(_BGZF_EOF):
+					return False;
+				fid.seek(-len(_BGZF_EOF), os.SEEK_END);
+				return fid.read() == _BGZF_EOF;
+			data = fid.read();
+		if path.endswith(".vcf"):
+			return data.startswith(b"##fileformat=VCF") and data.endswith(b"\n");
+		if path.endswith(".fs"):
+			return data.count(b"\n") == 3 and data.endswith(b"\n");
+		if path.endswith(".obs"):
+			return data.startswith(b"1 observation") and data.endswith(b"\n\n");
+		return len(data) > 0;
+	except (OSError, ValueError, KeyError, tskit.FileFormatError, zipfile.BadZipFile):
+		return False;
+
+class SegmentWriter:
+	#Picklable write_segment for pubrhe_segments.simulate_segments: one output per segment, <prefix>.seg<index><ext>.
+	def __init__(self, prefix, fmt="vcf"):
+		self.prefix = prefix;
+		self.fmt = fmt;
+
+	def path(self, index):
+		return output_path(self.prefix + ".seg" + str(index), self.fmt);
+
+	def __call__(self, mutated_tree, index):
+		return write_output(mutated_tree, self.prefix + ".seg" + str(index), self.fmt);
+
+class BackgroundWriter:
+	#Thread running queued write calls in order. submit() returns at once (or waits while max_pending calls are queued);
+	#close() waits for all of them and raises the first error, if any.
+	def __init__(self, max_pending=2):
+		self.queue = queue.Queue(max_pending);
+		self.error = None;
+		self.results = [];
+		self.thread = threading.Thread(target=self._run, daemon=True);
+		self.thread.start();
+
+	def _run(self):
+		while True:
+			item = self.queue.get();
+			if item is None:
+				return;
+			func, args = item;
+			if self.error is None:
+				try:
+					self.results.append(func(*args));
+				except Exception as e:
+					self.error = e;
+
+	def submit(self, func, *args):
+		if self.error is not None:
+			raise self.error;
+		self.queue.put((func, args));
+
+	def close(self):
+		self.queue.put(None);
+		self.thread.join();
+		if self.error is not None:
+			raise self.error;
+		return self.results;
+
+	def __enter__(self):
+		return self;
+
+	def __exit__(self, *exc):
+		self.close();
+
+class QueuedSegmentWriter:
+	#write_segment for serial segments: hands every segment to a BackgroundWriter and returns its path at once.
+	def __init__(self, segment_writer, background):
+		self.segment_writer = segment_writer;
+		self.background = background;
+
+	def __call__(self, mutated_tree, index):
+		self.background.submit(self.segment_writer, mutated_tree, index);
+		return self.segment_writer.path(index);
+
+def segment_writer(prefix, fmt, processes, background):
+	#write_segment of the given format: run in the workers when the segments are on a pool, else queued on background.
+	writer = SegmentWriter(prefix, fmt);
+	return writer if processes > 1 else QueuedSegmentWriter(writer, background);
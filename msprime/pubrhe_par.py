@@ -0,0 +1,225 @@
+## Simulate the fastsimcoal2 best-parameter (.par) models with msprime: expected site frequency spectra (the FREQ
+## data type of fastsimcoal2) for every .par file, computed locally on a process pool without the fsc2 binary.
+##
+## Usage: python pubrhe_par.py [.par files or folders ...] [--reps N] [--processes P] [--seed S] [--out-dir DIR]
+##
+## With no files, all fastsimcoal2/*/best-parameters/*.par files are run. For every model, N independent replicates of
+## the model's linkage block (length, recombination and mutation rates of the .par file) are simulated; the branch
+## spectra times the mutation rate are averaged over the replicates and written as fastsimcoal2 files in DIR:
+## <model>_MAFpopX.obs for every sampled deme and <model>_jointMAFpopX_Y.obs for every pair of sampled demes.
+##
+## Translation of the .par syntax (sizes and samples are numbers of gene copies, simulated with ploidy 1):
+##  - deme sizes, sample sizes (and sample ages), growth rates (fsc rates are backwards in time: msprime rate = -rate);
+##  - migration matrices (backwards in time in both programs, so used as they are);
+##  - historical events "time source sink migrants size growth matrix [nomig] [absoluteResize]": a mass migration of
+##    a proportion of source lineages to sink, the new size of sink (relative to its size at that time unless
+##    absoluteResize), its new growth rate and the new migration matrix ("keep" keeps the current one). "nomig" stops
+##    all migration to and from the source deme; demes resized to 0 (the "kill" events) are treated the same way,
+##    since msprime does not allow empty demes.
+
+import os
+import glob
+import zlib
+import argparse
+import multiprocessing
+import numpy as np
+import msprime
+import pubrhe_sfs
+
+PAR_GLOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fastsimcoal2", "*", "best-parameters", "*.par");
+
+def _lines(path):
+	#Non-empty lines of a .par file without the // comments.
+	lines = [];
+	with open(path) as f:
+		for line in f:
+			line = line.split("//")[0].strip();
+			if line != "":
+				lines.append(line);
+	return lines;
+
+def _number(token, current=None):
+	#A number, or the current value for "keep".
+	if token == "keep":
+		return current;
+	return float(token);
+
+def parse_par(path):
+	#Dictionary of a .par file: sizes, samples (haploid), sample_times, growth, matrices, events and loci.
+	lines = _lines(path);
+	pos = 0;
+	def take(n=1):
+		nonlocal pos;
+		out = lines[pos:pos + n];
+		pos += n;
+		return out;
+	n_demes = int(take()[0].split()[0]);
+	sizes = [float(l.split()[0]) for l in take(n_demes)];
+	samples = [];
+	sample_times = [];
+	for l in take(n_demes):
+		fields = l.split();
+		samples.append(int(fields[0]));
+		sample_times.append(float(fields[1]) if len(fields) > 1 else 0.0);
+	growth = [float(l.split()[0]) for l in take(n_demes)];
+	n_matrices = int(take()[0].split()[0]);
+	matrices = [np.array([[float(x) for x in l.split()] for l in take(n_demes)]) for i in range(n_matrices)];
+	n_events = int(take()[0].split()[0]);
+	events = [];
+	for l in take(n_events):
+		fields = l.split();
+		events.append({"time": float(fields[0]), "source": int(fields[1]), "sink": int(fields[2]), "migrants": float(fields[3]),
+			"size": fields[4], "growth": fields[5], "matrix": fields[6], "nomig": "nomig" in fields[7:], "absolute": "absoluteResize" in fields[7:]});
+	n_chromosomes = int(take()[0].split()[0]);
+	n_blocks = int(take()[0].split()[0]);
+	if n_chromosomes != 1 or n_blocks != 1:
+		raise ValueError(path + ": only one chromosome with one linkage block is supported");
+	fields = take()[0].split();
+	loci = {"type": fields[0], "length": int(fields[1]), "recombination": float(fields[2]), "mutation": float(fields[3])};
+	return {"sizes": sizes, "samples": samples, "sample_times": sample_times, "growth": growth, "matrices": matrices, "events": events, "loci": loci};
+
+def par_demography(par):
+	#msprime.Demography of a parsed .par file (demes pop0, pop1, ...; sizes in gene copies, for ploidy 1).
+	n = len(par["sizes"]);
+	demog = msprime.Demography();
+	for i in range(n):
+		demog.add_population(name="pop" + str(i), initial_size=par["sizes"][i], growth_rate=-par["growth"][i]);
+	#current size, growth rate (fsc direction) and time of the last change of every deme, to resolve relative resizes
+	state = [[par["sizes"][i], par["growth"][i], 0.0] for i in range(n)];
+	matrix = par["matrices"][0] if len(par["matrices"]) > 0 else np.zeros((n, n));
+	closed = set();
+	rates = _open_rates(matrix, closed);
+	demog.migration_matrix = rates.copy();
+	for ev in sorted(par["events"], key=lambda e: e["time"]):
+		t = ev["time"];
+		source = ev["source"];
+		sink = ev["sink"];
+		if ev["migrants"] > 0 and source != sink:
+			demog.add_mass_migration(time=t, source="pop" + str(source), dest="pop" + str(sink), proportion=min(ev["migrants"], 1.0));
+		size0, rate, t0 = state[sink];
+		current = size0 * np.exp(rate * (t - t0));
+		if ev["size"] == "keep":
+			size = current;
+		elif ev["absolute"]:
+			size = float(ev["size"]);
+		else:
+			size = current * float(ev["size"]);
+		rate = _number(ev["growth"], rate);
+		if size <= 0:
+			closed.add(sink);
+		else:
+			closed.discard(sink);
+			demog.add_population_parameters_change(time=t, initial_size=size, growth_rate=-rate, population="pop" + str(sink));
+			state[sink] = [size, rate, t];
+		if ev["nomig"]:
+			closed.add(source);
+		if ev["matrix"] != "keep":
+			index = int(float(ev["matrix"]));
+			matrix = par["matrices"][index] if 0 <= index < len(par["matrices"]) else np.zeros((n, n));
+		new_rates = _open_rates(matrix, closed);
+		for j, k in zip(*np.nonzero(new_rates != rates)):
+			demog.add_migration_rate_change(time=t, rate=new_rates[j, k], source="pop" + str(j), dest="pop" + str(k));
+		rates = new_rates;
+	demog.sort_events();
+	return demog;
+
+def _open_rates(matrix, closed):
+	#Migration matrix with no migration to or from the closed demes.
+	rates = np.array(matrix, dtype=float);
+	np.fill_diagonal(rates, 0);
+	for i in closed:
+		rates[i, :] = 0;
+		rates[:, i] = 0;
+	return rates;
+
+def par_samples(par):
+	#msprime sample sets (haploid) of the sampled demes.
+	return [msprime.SampleSet(n, population="pop" + str(i), time=t, ploidy=1) for i, (n, t) in enumerate(zip(par["samples"], par["sample_times"])) if n > 0];
+
+def expected_spectra(ts, par):
+	#Branch spectra times the mutation rate: {(i,): 1-d spectrum of deme i, (i, j): joint spectrum, rows deme i > j}.
+	mu = par["loci"]["mutation"];
+	demes = [i for i, n in enumerate(par["samples"]) if n > 0];
+	sets = {i: ts.samples(population=i) for i in demes};
+	spectra = {};
+	for i in demes:
+		spectra[(i,)] = ts.allele_frequency_spectrum([sets[i]], mode="branch", polarised=True, span_normalise=False) * mu;
+	for a, i in enumerate(demes):
+		for j in demes[:a]:
+			spectra[(i, j)] = ts.allele_frequency_spectrum([sets[i], sets[j]], mode="branch", polarised=True, span_normalise=False) * mu;
+	return spectra;
+
+def simulate_replicate(task):
+	#Expected spectra of one replicate of one model.
+	name, par, seed = task;
+	loci = par["loci"];
+	length = loci["length"] if loci["type"] == "DNA" else 1;
+	ts = msprime.sim_ancestry(par_samples(par), demography=par_demography(par), ploidy=1, sequence_length=length,
+		recombination_rate=loci["recombination"], discrete_genome=loci["type"] == "DNA", random_seed=seed);
+	return name, expected_spectra(ts, par);
+
+def replicate_seeds(name, n_reps, seed=None):
+	#Ancestry seed of every replicate of a model, derived from the model name (and the run seed if given).
+	entropy = [zlib.crc32(name.encode())] + ([seed] if seed is not None else []);
+	return [int(s.generate_state(1)[0] % (2**32 - 1) + 1) for s in np.random.SeedSequence(entropy).spawn(n_reps)];
+
+def write_spectra(out_prefix, spectra, length):
+	#Folded expected spectra as fastsimcoal2 .obs files; the first entry is the length minus the polymorphic sites.
+	paths = [];
+	for pops, sfs in sorted(spectra.items()):
+		folded = pubrhe_sfs.fold(sfs);
+		n_monomorphic = length - (np.sum(folded) - folded.flat[0]);
+		if len(pops) == 1:
+			path = out_prefix + "_MAFpop" + str(pops[0]) + ".obs";
+			pubrhe_sfs.write_fsc_maf(path, folded, n_monomorphic);
+		else:
+			path = out_prefix + "_jointMAFpop" + str(pops[0]) + "_" + str(pops[1]) + ".obs";
+			pubrhe_sfs.write_fsc_joint_maf(path, folded, pops, n_monomorphic);
+		paths.append(path);
+	return paths;
+
+def simulate_par_files(par_files, n_reps=20, processes=1, seed=None, out_dir=".", DEBUG=False):
+	#Expected spectra of every .par file, all (model, replicate) pairs run on one pool; returns the written paths.
+	pars = {os.path.splitext(os.path.basename(p))[0]: parse_par(p) for p in par_files};
+	tasks = [(name, par, s) for name, par in pars.items() for s in replicate_seeds(name, n_reps, seed)];
+	if DEBUG: print("Simulating " + str(len(pars)) + " model(s) x " + str(n_reps) + " replicate(s) on " + str(processes) + " process(es)");
+	if processes <= 1:
+		results = [simulate_replicate(task) for task in tasks];
+	else:
+		#longest-running models (most demes) first; results kept in task order so sums do not depend on scheduling
+		order = sorted(range(len(tasks)), key=lambda i: -len(tasks[i][1]["sizes"]));
+		with multiprocessing.Pool(processes) as pool:
+			done = pool.map(simulate_replicate, [tasks[i] for i in order], chunksize=1);
+		results = [None] * len(tasks);
+		for i, res in zip(order, done):
+			results[i] = res;
+	os.makedirs(out_dir, exist_ok=True);
+	paths = [];
+	for name in pars:
+		reps = [spectra for n, spectra in results if n == name];
+		spectra = {key: sum(r[key] for r in reps) / n_reps for key in reps[0]};
+		length = pars[name]["loci"]["length"] if pars[name]["loci"]["type"] == "DNA" else 1;
+		paths += write_spectra(os.path.join(out_dir, name), spectra, length);
+		if DEBUG: print(name + ": " + str(len(spectra)) + " spectra");
+	return paths;
+
+def par_files_from(args):
+	#.par files of the command line (files or folders), or all best-parameter files.
+	if len(args) == 0:
+		return sorted(glob.glob(PAR_GLOB));
+	files = [];
+	for a in args:
+		files += sorted(glob.glob(os.path.join(a, "*.par"))) if os.path.isdir(a) else [a];
+	return files;
+
+parser = argparse.ArgumentParser(description="Expected SFS of fastsimcoal2 .par models simulated with msprime.");
+parser.add_argument("par", nargs="*", help=".par files or folders (default: all fastsimcoal2/*/best-parameters/*.par)");
+parser.add_argument("--reps", type=int, default=20, help="replicates per model");
+parser.add_argument("--processes", type=int, default=1, help="worker processes");
+parser.add_argument("--seed", type=int, default=None, help="run seed (default: derived from the model names only)");
+parser.add_argument("--out-dir", default=".", help="folder for the .obs files");
+
+if __name__ == "__main__":
+	args = parser.parse_args();
+	paths = simulate_par_files(par_files_from(args.par), args.reps, args.processes, args.seed, args.out_dir, DEBUG=True);
+	print("\n".join(paths));
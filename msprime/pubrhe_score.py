@@ -0,0 +1,148 @@
+## Score a simulated 3-deme or 5-deme tree sequence against the observed fastsimcoal2 pairwise joint spectra.
+##
+## Usage: python pubrhe_score.py <model> [--trees FILE] [--mode branch|site] [--length L] [--seed S] [--obs-dir DIR]
+##
+## The model is a Demes file of the "demes" folder (e.g. 5-deme_re-estimated or 3-deme_brvFirst); without --trees
+## it is simulated with msprime (with its fastsimcoal2 sample sizes) for L bp. The k-dimensional joint spectrum of all
+## sampled demes is computed in a single pass over the trees (one sample set per deme, in fastsimcoal2 deme order),
+## and every pairwise joint spectrum is a marginal of it, folded the way the _jointMAFpopX_Y.obs files are. The
+## composite log-likelihood is the sum over the pairwise files of the multinomial log-likelihood of the observed
+## polymorphic cells; the observed spectra are stored sparsely (only their non-empty cells, which excludes most of
+## the high-frequency half folded away) and all pairs are scored in one vectorized pass.
+##
+## The "mode" is the tskit statistic mode: "branch" (the expected spectrum, branch lengths; the default) or "site"
+## (the biallelic sites of a mutated tree sequence, as in pubrhe_sfs.site_sfs).
+
+import os
+import sys
+import argparse
+import numpy as np
+import msprime
+import tskit
+import pubrhe_demes
+import pubrhe_obs
+import pubrhe_sfs
+
+FSC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fastsimcoal2");
+
+#Deme of every fastsimcoal2 population index (order of the .tpl files), by number of demes.
+FSC_DEMES = {
+	3: ["brevicaudus", "tcheliensis", "mul_lit_las"],
+	5: ["tcheliensis", "littoralis", "brevicaudus", "lasiotis", "mulatta"],
+};
+
+def load_observed(obs_dir):
+	#{(i, j): observed joint spectrum} of the _jointMAFpopX_Y.obs files of a folder (memory-mapped, see pubrhe_obs).
+	return {pops: obs.data for pops, obs in pubrhe_obs.load_obs_dir(obs_dir).items() if len(pops) == 2};
+
+def deme_sample_sets(ts, demes_order):
+	#Sample nodes of every deme (by population name), in the given order.
+	ids = {pop.metadata.get("name") if isinstance(pop.metadata, dict) else None: pop.id for pop in ts.populations()};
+	missing = [name for name in demes_order if name not in ids];
+	if len(missing) > 0:
+		raise ValueError("No population named " + ", ".join(missing) + " in the tree sequence");
+	return [ts.samples(population=ids[name]) for name in demes_order];
+
+def joint_afs(ts, sample_sets, mode="branch"):
+	#Unfolded, polarised k-dimensional joint spectrum of the sample sets, in one pass over the trees. In site mode only
+	#the biallelic sites are counted, as in pubrhe_sfs.site_sfs.
+	if mode == "site":
+		keep = pubrhe_sfs.biallelic_sites(ts);
+		if not np.all(keep):
+			ts = ts.delete_sites(np.nonzero(~keep)[0]);
+	else:
+		ts = ts.trim();
+	return ts.allele_frequency_spectrum(sample_sets, mode=mode, polarised=True, span_normalise=False);
+
+def pairwise_spectra(afs, pairs):
+	#{(i, j): folded joint spectrum of axes i and j} (rows i), the marginals of the k-dimensional spectrum.
+	spectra = {};
+	for i, j in pairs:
+		others = tuple(a for a in range(afs.ndim) if a not in (i, j));
+		marginal = afs.sum(axis=others);
+		if i > j:
+			marginal = marginal.T;
+		spectra[(i, j)] = pubrhe_sfs.fold(marginal);
+	return spectra;
+
+class PairwiseScorer:
+	#Composite multinomial log-likelihood of expected pairwise spectra against a set of observed ones. Only the
+	#non-empty polymorphic cells of the observed spectra are kept (flat indices into the concatenated expected spectra,
+	#counts and pair of every cell), so scoring is a few vectorized operations whatever the number of pairs.
+	def __init__(self, observed, floor=1e-12):
+		self.pairs = sorted(observed);
+		self.shapes = [observed[p].shape for p in self.pairs];
+		sizes = [int(np.prod(s)) for s in self.shapes];
+		self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64);
+		index = [];
+		counts = [];
+		pair_of = [];
+		for k, p in enumerate(self.pairs):
+			obs = np.array(observed[p], dtype=float).ravel();
+			obs[0] = 0;
+			cells = np.flatnonzero(obs);
+			index.append(cells + self.offsets[k]);
+			counts.append(obs[cells]);
+			pair_of.append(np.full(len(cells), k));
+		self.index = np.concatenate(index);
+		self.counts = np.concatenate(counts);
+		self.pair_of = np.concatenate(pair_of);
+		self.floor = floor;
+		#the log-likelihood of the observed spectra themselves, the maximum any model can reach
+		totals = np.bincount(self.pair_of, weights=self.counts, minlength=len(self.pairs));
+		self.max_ll = np.bincount(self.pair_of, weights=self.counts * np.log(self.counts / totals[self.pair_of]), minlength=len(self.pairs));
+
+	def score(self, expected):
+		#{"ll": composite log-likelihood, "pairs": {pair: ll}, "delta": max_ll - ll}; expected = {pair: folded spectrum}.
+		flat = np.empty(self.offsets[-1]);
+		totals = np.empty(len(self.pairs));
+		for k, (p, shape) in enumerate(zip(self.pairs, self.shapes)):
+			exp = np.asarray(expected[p], dtype=float);
+			if exp.shape != shape:
+				raise ValueError("Expected spectrum " + str(p) + " has shape " + str(exp.shape) + ", observed " + str(shape));
+			exp = exp.ravel();
+			flat[self.offsets[k]:self.offsets[k + 1]] = exp;
+			totals[k] = np.sum(exp) - exp[0];
+		prob = np.maximum(flat[self.index] / totals[self.pair_of], self.floor);
+		pair_ll = np.bincount(self.pair_of, weights=self.counts * np.log(prob), minlength=len(self.pairs));
+		return {"ll": float(np.sum(pair_ll)), "pairs": dict(zip(self.pairs, pair_ll)), "delta": float(np.sum(self.max_ll - pair_ll))};
+
+def obs_dir_for(n_demes):
+	return os.path.join(FSC_DIR, str(n_demes) + "-deme", "sfs-files");
+
+def score_ts(ts, n_demes, mode="branch", obs_dir=None, scorer=None):
+	#Score a tree sequence with one deme per fastsimcoal2 index against the observed pairwise spectra.
+	if scorer is None:
+		scorer = PairwiseScorer(load_observed(obs_dir if obs_dir is not None else obs_dir_for(n_demes)));
+	afs = joint_afs(ts, deme_sample_sets(ts, FSC_DEMES[n_demes]), mode);
+	return scorer.score(pairwise_spectra(afs, scorer.pairs));
+
+def simulate(model, length, recomb_rate, mut_rate, seed, mode):
+	#Tree sequence of a Demes model with its fastsimcoal2 sample sizes (mutated in site mode).
+	_, compiled = pubrhe_demes.load_model(model, cache_dir=os.path.join(pubrhe_demes.DEMES_DIR, ".compiled"));
+	ts = msprime.sim_ancestry(compiled["samples"], demography=compiled["demography"], sequence_length=length, recombination_rate=recomb_rate, random_seed=seed);
+	if mode == "site":
+		ts = msprime.sim_mutations(ts, rate=mut_rate, random_seed=seed);
+	return ts;
+
+parser = argparse.ArgumentParser(description="Composite likelihood of a 3-/5-deme tree sequence against the fastsimcoal2 pairwise joint spectra.");
+parser.add_argument("model", help="Demes model (e.g. 5-deme_re-estimated, 3-deme_brvFirst)");
+parser.add_argument("--trees", default=None, help="score this .trees file instead of simulating");
+parser.add_argument("--mode", choices=["branch", "site"], default="branch", help="tskit statistic mode");
+parser.add_argument("--length", type=float, default=1e7, help="simulated sequence length (bp)");
+parser.add_argument("--recomb-rate", type=float, default=1e-8);
+parser.add_argument("--mut-rate", type=float, default=1.08e-8);
+parser.add_argument("--seed", type=int, default=1);
+parser.add_argument("--obs-dir", default=None, help="folder of the .obs files (default: fastsimcoal2/<k>-deme/sfs-files)");
+
+if __name__ == "__main__":
+	args = parser.parse_args();
+	name, _ = pubrhe_demes.resolve_model(args.model);
+	n_demes = int(name.split("-")[0]);
+	if n_demes not in FSC_DEMES:
+		sys.exit(name + ": only the 3-deme and 5-deme models have pairwise spectra");
+	ts = tskit.load(args.trees) if args.trees is not None else simulate(args.model, args.length, args.recomb_rate, args.mut_rate, args.seed, args.mode);
+	result = score_ts(ts, n_demes, args.mode, args.obs_dir);
+	for pair, ll in sorted(result["pairs"].items()):
+		print("jointMAFpop" + str(pair[0]) + "_" + str(pair[1]) + "\t" + str(ll));
+	print("composite\t" + str(result["ll"]) + "\t(" + str(result["delta"]) + " below the observed spectra)");
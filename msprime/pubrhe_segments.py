@@ -0,0 +1,107 @@
+## Helpers for pubrhe_msprimeSimulations: simulate one replicate as independent genome segments on a process pool.
+##
+## The genome is split into chromosome-sized (or user-specified) segments that are simulated independently with
+## the same demography, recombination rate and mutation rate, so the total sequence length and rates are unchanged
+## while the wall-clock time scales with the number of cores. Segments are unlinked from each other (as separate
+## chromosomes are). Every segment gets its own ancestry and mutation seeds derived from one replicate seed, so a
+## replicate is reproducible whatever the number of processes.
+
+import multiprocessing
+import zlib
+import numpy as np
+import msprime
+import pubrhe_trace
+
+def replicate_seed(model, rep, seed=None):
+	#Seed for one replicate: the given seed, or one derived from the model name and replicate number.
+	if seed is not None:
+		return seed;
+	return [zlib.crc32(model.encode()), rep];
+
+def split_genome(sequence_length, n_segments=1, segment_lengths=None):
+	#(start, end) of every segment; explicit lengths must add up to the sequence length.
+	if segment_lengths is not None:
+		if sum(segment_lengths) != sequence_length:
+			raise ValueError("Segment lengths add up to " + str(sum(segment_lengths)) + ", not " + str(sequence_length));
+		ends = np.cumsum(segment_lengths);
+	else:
+		ends = np.linspace(0, sequence_length, n_segments + 1)[1:].round();
+	starts = np.concatenate([[0], ends[:-1]]);
+	return [(int(s), int(e)) for s, e in zip(starts, ends)];
+
+def segment_seeds(seed, n_segments):
+	#(ancestry seed, mutation seed) for every segment, derived from the replicate seed.
+	seeds = [];
+	for child in np.random.SeedSequence(seed).spawn(n_segments):
+		anc, mut = child.generate_state(2) % (2**32 - 1) + 1;
+		seeds.append((int(anc), int(mut)));
+	return seeds;
+
+def simulate_segment(task):
+	#Simulate and mutate one segment. Returns its mutated tree sequence, or, if write_segment is given,
+	#writes the segment shifted to its genome position and returns what write_segment returns.
+	#If traced, returns (result, recorded steps) (see pubrhe_trace.py).
+	index, start, end, demog, samp, recombRate, mutRate, anc_seed, mut_seed, write_segment, traced = task;
+	trace = pubrhe_trace.Trace() if traced else None;
+	with pubrhe_trace.step(trace, "sim_ancestry", segment=index) as event:
+		tree = msprime.sim_ancestry(samp, demography=demog, recombination_rate=recombRate, sequence_length=end - start, random_seed=anc_seed);
+		event["num_trees"] = tree.num_trees;
+	with pubrhe_trace.step(trace, "sim_mutations", segment=index) as event:
+		mutated_tree = msprime.sim_mutations(tree, rate=mutRate, random_seed=mut_seed);
+		event["num_trees"] = mutated_tree.num_trees;
+		event["num_sites"] = mutated_tree.num_sites;
+	result = mutated_tree;
+	if write_segment is not None:
+		if start > 0:
+			mutated_tree = mutated_tree.shift(start);
+		with pubrhe_trace.step(trace, "write_segment", segment=index):
+			result = write_segment(mutated_tree, index);
+	return (result, trace.events) if traced else result;
+
+def merge_segments(segments):
+	#Join the segments, in genome order, into one tree sequence covering the whole genome.
+	if len(segments) == 1:
+		return segments[0];
+	return segments[0].concatenate(*segments[1:], add_populations=False);
+
+class SegmentVcfWriter:
+	#Picklable write_segment for simulate_segments: one VCF per segment, named <prefix>.seg<index>.SNPs.vcf.
+	def __init__(self, prefix):
+		self.prefix = prefix;
+
+	def __call__(self, mutated_tree, index):
+		path = self.prefix + ".seg" + str(index) + ".SNPs.vcf";
+		with open(path, "w") as out:
+			mutated_tree.write_vcf(out);
+		return path;
+
+def simulate_segments(demog, samp, sequence_length, recombRate, mutRate, seed, n_segments=1, segment_lengths=None, processes=1, write_segment=None, trace=None, DEBUG=False):
+	#Simulate all segments, in parallel when processes > 1.
+	#Returns the merged tree sequence, or the list of per-segment outputs if write_segment is given
+	#(a picklable function (tree sequence, segment index) -> output path, run in the workers).
+	#The steps of every segment (and the merge) are added to trace, a pubrhe_trace.Trace, if given.
+	bounds = split_genome(sequence_length, n_segments, segment_lengths);
+	seeds = segment_seeds(seed, len(bounds));
+	tasks = [(i, s, e, demog, samp, recombRate, mutRate, seeds[i][0], seeds[i][1], write_segment, trace is not None) for i, (s, e) in enumerate(bounds)];
+	if DEBUG: print("Simulating " + str(len(tasks)) + " segment(s) on " + str(processes) + " process(es)");
+	if processes <= 1 or len(tasks) == 1:
+		results = [simulate_segment(t) for t in tasks];
+	else:
+		#longest segments first, results kept in genome order
+		order = sorted(range(len(tasks)), key=lambda i: bounds[i][0] - bounds[i][1]);
+		with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+			done = pool.map(simulate_segment, [tasks[i] for i in order], chunksize=1);
+		results = [None] * len(tasks);
+		for i, res in zip(order, done):
+			results[i] = res;
+	if trace is not None:
+		for _, events in results:
+			trace.extend(events);
+		results = [res for res, _ in results];
+	if write_segment is not None:
+		return results;
+	with pubrhe_trace.step(trace, "merge_segments") as event:
+		merged = merge_segments(results);
+		event["num_trees"] = merged.num_trees;
+		event["num_sites"] = merged.num_sites;
+	return merged;
@@ -0,0 +1,153 @@
+## Helpers for pubrhe_msprimeSimulations: frequency spectra computed directly from the mutated tree sequence.
+##
+## The site spectrum is the one dadi_data_prep.py would build from the .SNPs.vcf (biallelic SNPs only, folded,
+## corners masked), written in dadi .fs format and as a fastsimcoal2 _MAFpop0.obs file, without writing or parsing
+## the VCF. The branch spectrum (expected site spectrum, branch lengths times the mutation rate) can be written too.
+## These are 1-population spectra: models with more than one sampled deme are rejected (their pairwise joint spectra
+## are computed by pubrhe_score.py).
+
+import numpy as np
+
+def biallelic_sites(ts):
+	#Boolean array: True for sites with exactly two alleles (ancestral state plus derived states), i.e. the sites
+	#written to the VCF with a single ALT allele.
+	tables = ts.tables;
+	n_sites = tables.sites.num_rows;
+	if n_sites == 0:
+		return np.zeros(0, dtype=bool);
+	anc_len = np.diff(tables.sites.ancestral_state_offset);
+	der_len = np.diff(tables.mutations.derived_state_offset);
+	if np.all(anc_len == 1) and np.all(der_len == 1):
+		#single-character states (e.g. the default ACGT model): count distinct states with bit masks
+		bits = np.left_shift(np.uint64(1), (tables.sites.ancestral_state.astype(np.uint64) % 64));
+		mut_bits = np.left_shift(np.uint64(1), (tables.mutations.derived_state.astype(np.uint64) % 64));
+		np.bitwise_or.at(bits, tables.mutations.site, mut_bits);
+		n_alleles = _popcount(bits);
+	else:
+		n_alleles = np.array([len({site.ancestral_state} | {m.derived_state for m in site.mutations}) for site in ts.sites()]);
+	return n_alleles == 2;
+
+def _popcount(bits):
+	count = np.zeros(len(bits), dtype=np.int64);
+	for shift in range(64):
+		count += ((bits >> np.uint64(shift)) & np.uint64(1)).astype(np.int64);
+	return count;
+
+def site_sfs(ts):
+	#Unfolded derived-allele site spectrum (length n+1) of the biallelic sites, and the number of other sites skipped.
+	#tskit leaves the corner bins empty; the sites where no sample or every sample carries the derived allele (after
+	#back or recurrent mutation) are counted in the first bin, as they are in the spectrum dadi builds from the VCF.
+	keep = biallelic_sites(ts);
+	skipped = int(np.sum(~keep));
+	if skipped > 0:
+		ts = ts.delete_sites(np.nonzero(~keep)[0]);
+	afs = np.rint(ts.allele_frequency_spectrum(mode="site", polarised=True, span_normalise=False)).astype(np.int64);
+	afs[0] = ts.num_sites - np.sum(afs[1:-1]);
+	afs[-1] = 0;
+	return afs, skipped;
+
+def branch_sfs(ts, mutRate):
+	#Expected unfolded site spectrum (length n+1): branch spectrum times the mutation rate.
+	#Empty flanks (e.g. the start of a segment shifted to its genome position) are trimmed first, since tskit
+	#would count every sample there as a singleton branch.
+	ts = ts.trim();
+	return ts.allele_frequency_spectrum(mode="branch", polarised=True, span_normalise=False) * mutRate;
+
+def fold(sfs):
+	#Fold an unfolded (1-d or joint) spectrum the way dadi does: entries with more than half of all samples carrying
+	#the derived allele are added to their mirror image, entries with exactly half are averaged with it, and the first
+	#entry (masked in dadi) holds the sites where all or none of the samples carry the derived allele.
+	sfs = np.asarray(sfs, dtype=float);
+	total = sum(np.ogrid[tuple(slice(0, n) for n in sfs.shape)]);
+	n = sum(sfs.shape) - sfs.ndim;
+	folded_out = total > n//2;
+	flipped = sfs[(slice(None, None, -1),) * sfs.ndim];
+	folded = sfs + np.where(folded_out[(slice(None, None, -1),) * sfs.ndim], flipped, 0);
+	folded[folded_out] = 0;
+	if n % 2 == 0:
+		ambiguous = total == n//2;
+		folded[ambiguous] = 0.5 * (sfs[ambiguous] + flipped[ambiguous]);
+	return folded;
+
+def write_dadi_fs(path, folded, pop_id="pop1"):
+	#Folded 1-population spectrum in dadi .fs format (same bytes as dadi's Spectrum.to_file).
+	n = len(folded) - 1;
+	mask = np.ones(n + 1, dtype=int);
+	mask[1:n//2 + 1] = 0;
+	with open(path, "w") as fid:
+		fid.write(str(n + 1) + " folded \"" + pop_id + "\"\n");
+		np.savetxt(fid, [np.asarray(folded, dtype=float)], delimiter=" ", fmt="%.16g");
+		np.savetxt(fid, [mask], delimiter=" ", fmt="%d");
+
+def write_fsc_maf(path, folded, n_monomorphic):
+	#Folded 1-population spectrum as a fastsimcoal2 _MAFpop0.obs file; the first bin holds the monomorphic sites.
+	n = len(folded) - 1;
+	values = np.asarray(folded, dtype=float).copy();
+	values[0] = n_monomorphic;
+	with open(path, "w") as fid:
+		fid.write("1 observation\n");
+		fid.write("\t".join("d0_" + str(i) for i in range(n + 1)) + "\n");
+		fid.write(" ".join(("%d" % v) if float(v).is_integer() else ("%.10g" % v) for v in values) + "\n\n");
+
+def write_fsc_joint_maf(path, folded, pops, n_monomorphic):
+	#Folded 2-population spectrum as a fastsimcoal2 _jointMAFpopX_Y.obs file (pops = (X, Y); rows are deme X).
+	values = np.asarray(folded, dtype=float).copy();
+	values[0, 0] = n_monomorphic;
+	with open(path, "w") as fid:
+		fid.write("1 observation\n");
+		fid.write("\t" + "\t".join("d" + str(pops[1]) + "_" + str(j) for j in range(values.shape[1])) + "\n");
+		for i, row in enumerate(values):
+			fid.write("d" + str(pops[0]) + "_" + str(i) + "\t" + " ".join(("%d" % v) if float(v).is_integer() else ("%.10g" % v) for v in row) + "\n");
+
+def check_single_deme(samples):
+	#Raise ValueError if samples ({deme: n} or a number of individuals) come from more than one deme.
+	sampled = [name for name, n in samples.items() if n > 0] if isinstance(samples, dict) else [];
+	if len(sampled) > 1:
+		raise ValueError("Spectrum output is for one sampled deme, the model samples " + ", ".join(sampled) + " (use --samples deme=n, or pubrhe_score.py for the joint spectra)");
+
+def segment_sfs(mutated_tree, mutRate=None):
+	#Spectra of one tree sequence: site spectrum, skipped sites and (if mutRate is given) branch spectrum.
+	#The samples must all be in one population (see check_single_deme).
+	if len(np.unique(mutated_tree.tables.nodes.population[mutated_tree.samples()])) > 1:
+		raise ValueError("Spectrum output is for one sampled deme, the tree sequence has samples in several");
+	sfs, skipped = site_sfs(mutated_tree);
+	result = {"site": sfs, "skipped": skipped};
+	if mutRate is not None:
+		result["branch"] = branch_sfs(mutated_tree, mutRate);
+	return result;
+
+def add_sfs(results):
+	#Sum the spectra of several segments.
+	total = dict(results[0]);
+	for res in results[1:]:
+		for key in total:
+			total[key] = total[key] + res[key];
+	return total;
+
+class SegmentSfs:
+	#Picklable write_segment for pubrhe_segments.simulate_segments: returns segment_sfs of every segment
+	#(segments shifted to their genome position, which the spectra ignore), optionally also writing its VCF.
+	def __init__(self, mutRate=None, vcf_writer=None):
+		self.mutRate = mutRate;
+		self.vcf_writer = vcf_writer;
+
+	def __call__(self, mutated_tree, index):
+		result = segment_sfs(mutated_tree, self.mutRate);
+		if self.vcf_writer is not None:
+			self.vcf_writer(mutated_tree, index);
+		return result;
+
+def write_sfs(outHeader, result, seqLength, pop_id="pop1"):
+	#Write <outHeader>.fs and <outHeader>_MAFpop0.obs (and the .branch versions if present); returns the paths.
+	#The monomorphic bin of the .obs files is the sequence length minus the polymorphic and skipped sites.
+	folded = fold(result["site"]);
+	n_monomorphic = int(seqLength) - int(np.sum(folded[1:])) - result["skipped"];
+	paths = [outHeader + ".fs", outHeader + "_MAFpop0.obs"];
+	write_dadi_fs(paths[0], folded, pop_id);
+	write_fsc_maf(paths[1], folded, n_monomorphic);
+	if "branch" in result:
+		folded = fold(result["branch"]);
+		paths += [outHeader + ".branch.fs", outHeader + ".branch_MAFpop0.obs"];
+		write_dadi_fs(paths[2], folded, pop_id);
+		write_fsc_maf(paths[3], folded, seqLength - np.sum(folded[1:]));
+	return paths;
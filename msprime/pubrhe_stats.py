@@ -0,0 +1,214 @@
+## Windowed summaries of a simulated replicate computed straight from the tree sequence: nucleotide diversity, Tajima's D,
+## the folded site frequency spectrum and LD decay in windows along the genome, so that the recombination runs can be compared
+## without writing and re-parsing the VCF.
+##
+## Usage: python pubrhe_stats.py FILE.stats.npz [FILE.stats.npz ...]   (genome-wide summary of each file, see summarize)
+##
+## Windows are window_size bp long and start at the start of every segment (pubrhe_segments.split_genome), so no window
+## spans two unlinked segments; the last window of a segment is shorter. Every statistic is computed for each deme with
+## samples, in "site" mode (from the mutations) and/or "branch" mode (expected values from the branch lengths, tskit's
+## branch statistics):
+##   diversity_<mode>     (windows, demes)      nucleotide diversity per bp (in branch mode, mean branch length between
+##                                              two samples; multiply by the mutation rate for the expected diversity)
+##   tajimas_d_<mode>     (windows, demes)      Tajima's D (nan in site mode where a window has no segregating site)
+##   sfs_<mode>.<deme>    (windows, n//2 + 1)   folded spectrum of the window (counts in site mode, branch length x bp
+##                                              in branch mode; multiply by the mutation rate for the expected counts)
+##   ld_r2_site           (windows, demes, bins) mean r^2 of the pairs of biallelic sites at distances in [ld_bins[k], ld_bins[k+1])
+##   ld_pairs_site        (windows, demes, bins) number of site pairs in each mean
+## LD decay is computed in site mode only: tskit's branch-mode r^2 is not normalised and costs a tree-by-tree traversal
+## for every pair of positions. The biallelic sites of a window are split into blocks of ld_sites consecutive sites, whose
+## pairs give the short distances, and an evenly spaced subset of ld_sites sites gives the long ones (see ld_decay).
+## The arrays are written, with the window "breaks", the "segment" of every window, the "demes" and the ld_bins,
+## to one compressed <prefix>.stats.npz file (read_stats reads it back into a dictionary).
+##
+## windowed_stats splits the windows into contiguous chunks computed on a process pool; the tree sequence is sent once
+## to every worker, which computes its chunk on the tree sequence restricted to the chunk (keep_intervals). For
+## segments simulated in workers (and never merged), SegmentStats computes the windows of each segment in its worker.
+
+import os
+import sys
+import multiprocessing
+import numpy as np
+import pubrhe_sfs
+
+MODES = ("site", "branch");
+LD_BINS = [0, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000];
+
+def stats_config(modes=MODES, ld_sites=100, ld_bins=LD_BINS):
+	#Options of windowed_stats as a (picklable) dictionary.
+	for mode in modes:
+		if mode not in MODES:
+			raise ValueError("Unknown statistics mode " + mode + " (site or branch)");
+	return {"modes": list(modes), "ld_sites": ld_sites, "ld_bins": list(ld_bins)};
+
+def window_breaks(bounds, window_size):
+	#Window breaks over the segments (start, end) of pubrhe_segments.split_genome, and the segment of every window.
+	breaks = [bounds[0][0]];
+	segment = [];
+	for i, (start, end) in enumerate(bounds):
+		edges = list(np.arange(start + window_size, end, window_size)) + [end];
+		breaks += edges;
+		segment += [i] * len(edges);
+	return np.array(breaks, dtype=float), np.array(segment, dtype=np.int32);
+
+def sample_sets(ts):
+	#(deme names, sample node lists) of the demes with samples.
+	names = [];
+	sets = [];
+	for pop in ts.populations():
+		samples = ts.samples(population=pop.id);
+		if len(samples) > 0:
+			names.append(pop.metadata.get("name", "pop" + str(pop.id)) if isinstance(pop.metadata, dict) else "pop" + str(pop.id));
+			sets.append(samples);
+	return names, sets;
+
+def _padded(ts, breaks):
+	#Windows covering the whole sequence (tskit requires it): breaks, plus the flanks before and after them.
+	#Returns the windows and the slice of the results that belongs to breaks.
+	windows = list(breaks);
+	first = 0;
+	if windows[0] > 0:
+		windows = [0] + windows;
+		first = 1;
+	if windows[-1] < ts.sequence_length:
+		windows = windows + [ts.sequence_length];
+	return windows, slice(first, first + len(breaks) - 1);
+
+def _ld_pairs(ts, sets, sites, positions, bins, pairs):
+	#r^2 of the site pairs (i, j) (indexes into sites) in every deme; returns (bin of every pair, r^2 of shape (demes, pairs)).
+	i, j = pairs;
+	bin_of = np.digitize(positions[sites[j]] - positions[sites[i]], bins) - 1;
+	return bin_of, ts.ld_matrix(sample_sets=sets, sites=[sites.tolist()])[:, i, j];
+
+def ld_decay(ts, breaks, sets, max_sites, bins):
+	#(mean r^2, number of pairs) of shape (windows, demes, bins) for the biallelic sites of every window. Short distances
+	#come from the pairs within consecutive blocks of max_sites sites, long ones from the pairs of an evenly spaced subset
+	#of max_sites sites that lie in different blocks (so that no pair is counted twice).
+	n_windows = len(breaks) - 1;
+	n_bins = len(bins) - 1;
+	total = np.zeros((n_windows, len(sets), n_bins));
+	count = np.zeros((n_windows, len(sets), n_bins), dtype=np.int64);
+	positions = ts.tables.sites.position;
+	ids = np.nonzero(pubrhe_sfs.biallelic_sites(ts))[0];
+	first = np.searchsorted(positions[ids], breaks);
+	for w in range(n_windows):
+		window = ids[first[w]:first[w + 1]];
+		groups = [(window[k:k + max_sites], np.triu_indices(len(window[k:k + max_sites]), 1)) for k in range(0, len(window), max_sites)];
+		if len(window) > max_sites:
+			spaced = np.linspace(0, len(window) - 1, max_sites).round().astype(int);
+			i, j = np.triu_indices(max_sites, 1);
+			other = spaced[i] // max_sites != spaced[j] // max_sites;
+			groups.append((window[spaced], (i[other], j[other])));
+		for sites, pairs in groups:
+			if len(pairs[0]) == 0:
+				continue;
+			bin_of, values = _ld_pairs(ts, sets, sites, positions, bins, pairs);
+			for d in range(len(sets)):
+				valid = np.isfinite(values[d]) & (bin_of >= 0) & (bin_of < n_bins);
+				count[w, d] += np.bincount(bin_of[valid], minlength=n_bins);
+				total[w, d] += np.bincount(bin_of[valid], weights=values[d][valid], minlength=n_bins);
+	with np.errstate(invalid="ignore", divide="ignore"):
+		return np.where(count > 0, total / count, np.nan), count;
+
+def window_stats(ts, breaks, config):
+	#Statistics of the windows between breaks (which must lie within the sequence of ts), as a dictionary of arrays.
+	windows, part = _padded(ts, breaks);
+	names, sets = sample_sets(ts);
+	result = {"demes": np.array(names)};
+	for mode in config["modes"]:
+		result["diversity_" + mode] = ts.diversity(sets, windows=windows, mode=mode)[part];
+		with np.errstate(invalid="ignore", divide="ignore"):
+			result["tajimas_d_" + mode] = ts.Tajimas_D(sets, windows=windows, mode=mode)[part];
+		for name, samples in zip(names, sets):
+			sfs = ts.allele_frequency_spectrum([samples], windows=windows, mode=mode, polarised=False, span_normalise=False)[part];
+			result["sfs_" + mode + "." + name] = sfs[:, :len(samples)//2 + 1];
+	if "site" in config["modes"]:
+		result["ld_r2_site"], result["ld_pairs_site"] = ld_decay(ts, breaks, sets, config["ld_sites"], config["ld_bins"]);
+	return result;
+
+def concatenate_stats(parts):
+	#Join the statistics of consecutive groups of windows.
+	return {key: parts[0][key] if key == "demes" else np.concatenate([p[key] for p in parts]) for key in parts[0]};
+
+def split_segment_stats(results):
+	#Results of simulate_segments with a SegmentStats write_segment: (results of the wrapped write_segment, statistics).
+	return [res for res, _ in results], concatenate_stats([stats for _, stats in results]);
+
+_worker_ts = None;
+
+def _init_worker(ts):
+	global _worker_ts;
+	_worker_ts = ts;
+
+def _chunk_stats(task):
+	#Statistics of one chunk of windows, on the tree sequence of the worker restricted to the chunk.
+	breaks, config = task;
+	ts = _worker_ts.keep_intervals([[breaks[0], breaks[-1]]], simplify=False);
+	return window_stats(ts, breaks, config);
+
+def windowed_stats(ts, breaks, config, processes=1, chunks_per_process=4):
+	#Statistics of every window of breaks (see window_breaks), the windows split into chunks over processes workers.
+	n_windows = len(breaks) - 1;
+	if processes <= 1 or n_windows == 1:
+		return window_stats(ts, breaks, config);
+	n_chunks = min(n_windows, processes * chunks_per_process);
+	edges = np.linspace(0, n_windows, n_chunks + 1).round().astype(int);
+	tasks = [(breaks[a:b + 1], config) for a, b in zip(edges[:-1], edges[1:])];
+	with multiprocessing.Pool(min(processes, n_chunks), initializer=_init_worker, initargs=(ts,)) as pool:
+		parts = pool.map(_chunk_stats, tasks, chunksize=1);
+	return concatenate_stats(parts);
+
+class SegmentStats:
+	#Picklable write_segment for pubrhe_segments.simulate_segments: statistics of the windows of the segment (shifted to
+	#its genome position), computed in the worker. Returns (result of the wrapped write_segment or None, statistics).
+	def __init__(self, bounds, window_size, config, write_segment=None):
+		self.bounds = bounds;
+		self.window_size = window_size;
+		self.config = config;
+		self.write_segment = write_segment;
+
+	def __call__(self, mutated_tree, index):
+		result = self.write_segment(mutated_tree, index) if self.write_segment is not None else None;
+		breaks, _ = window_breaks([self.bounds[index]], self.window_size);
+		return result, window_stats(mutated_tree, breaks, self.config);
+
+def write_stats(prefix, stats, breaks, segment, config):
+	#Write <prefix>.stats.npz (to a temporary name first, so an existing file is always complete); returns its path.
+	path = prefix + ".stats.npz";
+	with open(path + ".tmp", "wb") as out:
+		np.savez_compressed(out, breaks=breaks, segment=segment, ld_bins=np.array(config["ld_bins"], dtype=float), **stats);
+	os.replace(path + ".tmp", path);
+	return path;
+
+def read_stats(path):
+	with np.load(path) as data:
+		return {key: data[key] for key in data.files};
+
+def summarize(stats):
+	#Genome-wide values of a stats dictionary: span-weighted mean diversity and Tajima's D of every deme, and the mean
+	#r^2 of every distance bin over all windows (weighted by their numbers of pairs).
+	span = np.diff(stats["breaks"]);
+	summary = {};
+	for key in stats:
+		if key.startswith("diversity_") or key.startswith("tajimas_d_"):
+			values = stats[key];
+			valid = np.isfinite(values);
+			weights = np.where(valid, span[:, None], 0);
+			with np.errstate(invalid="ignore", divide="ignore"):
+				summary[key] = np.sum(np.where(valid, values, 0) * weights, axis=0) / np.sum(weights, axis=0);
+	if "ld_r2_site" in stats:
+		pairs = stats["ld_pairs_site"];
+		with np.errstate(invalid="ignore", divide="ignore"):
+			summary["ld_r2_site"] = np.sum(np.nan_to_num(stats["ld_r2_site"]) * pairs, axis=0) / np.sum(pairs, axis=0);
+	return summary;
+
+if __name__ == "__main__":
+	for path in sys.argv[1:]:
+		stats = read_stats(path);
+		print(path + ": " + str(len(stats["breaks"]) - 1) + " windows, demes " + ", ".join(stats["demes"]));
+		for key, values in summarize(stats).items():
+			if key == "ld_r2_site":
+				for d, deme in enumerate(stats["demes"]):
+					print("\tld_r2_site " + deme + "\t" + " ".join("%g-%g:%.4g" % (a, b, v) for a, b, v in zip(stats["ld_bins"][:-1], stats["ld_bins"][1:], values[d])));
+			else:
+				print("\t" + key + "\t" + " ".join(deme + "=%.6g" % v for deme, v in zip(stats["demes"], values)));
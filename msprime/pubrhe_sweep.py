@@ -0,0 +1,164 @@
+## Recombination x mutation rate sweep: simulate ancestry once per recombination rate and overlay many mutation
+## replicates (and mutation rates) on each tree sequence, with the grid cells run on a process pool.
+##
+## Usage: python pubrhe_sweep.py ModelName [--recomb-rates R1,R2,...] [--mut-rates M1,M2,...] [--ancestry-reps A]
+##                               [--mut-reps N] [--length L] [--processes P] [--seed S] [--out-dir DIR]
+##                               [--output sfs|vcf|both] [--format vcf|vcf.gz|geno|trees] [--branch-sfs] [--keep-trees]
+##                               [--samples deme=n,...]
+##
+## Every cell of the grid is one ancestry simulation (a recombination rate and an ancestry replicate); its worker
+## overlays N mutation replicates for every mutation rate on the same tree sequence (msprime.sim_mutations only adds
+## sites to the stored trees, which is far cheaper than simulating the ancestry again) and writes the spectrum files
+## of pubrhe_sfs.write_sfs (and/or the VCF) of every overlay, named
+## <out-dir>/<model>.r<recomb rate>.a<ancestry rep>.mu<mut rate>.m<mut rep>. The genotypes are written in the --format
+## of pubrhe_output.py on a background thread of the worker, while it simulates the next overlay.
+## With --keep-trees the ancestry is saved as <model>.r<rate>.a<rep>.trees and read back instead of simulated when the
+## sweep is run again (e.g. with more mutation rates or replicates). The file is written atomically and carries, in its
+## top-level metadata, the ancestry seed, sequence length, recombination rate and a hash of the demography and samples
+## it was simulated with; it is only reused when all of them match the current run, and simulated again otherwise. Seeds are derived from the run seed, the model,
+## the rates and the replicate numbers, so a cell gives the same output whatever the rest of the grid and the number
+## of processes. A table of all overlays (number of trees and sites, wall times, files) is written to
+## <out-dir>/<model>.sweep.tsv.
+
+import os
+import time
+import zlib
+import argparse
+import multiprocessing
+import numpy as np
+import msprime
+import tskit
+import pubrhe_demes
+import pubrhe_sfs
+import pubrhe_output
+
+def _rate_key(rate):
+	return zlib.crc32(repr(float(rate)).encode());
+
+def cell_seeds(model, recomb_rate, ancestry_rep, mut_rates, n_mut_reps, seed=None):
+	#(ancestry seed, {(mut rate, mut rep): mutation seed}) of one grid cell.
+	entropy = [zlib.crc32(model.encode()), _rate_key(recomb_rate), ancestry_rep] + ([seed] if seed is not None else []);
+	ss = np.random.SeedSequence(entropy);
+	anc_seed = int(ss.generate_state(1)[0] % (2**32 - 1) + 1);
+	mut_seeds = {};
+	for mu in mut_rates:
+		mu_ss = np.random.SeedSequence(entropy + [_rate_key(mu)]);
+		for m, child in enumerate(mu_ss.spawn(n_mut_reps)):
+			mut_seeds[(mu, m)] = int(child.generate_state(1)[0] % (2**32 - 1) + 1);
+	return anc_seed, mut_seeds;
+
+def cell_name(model, recomb_rate, ancestry_rep):
+	return model + ".r" + ("%g" % recomb_rate) + ".a" + str(ancestry_rep);
+
+def ancestry_record(demog, samp, length, recomb_rate, anc_seed):
+	#What the ancestry of a cell depends on; stored in its kept .trees file and checked before reusing it.
+	return {"seed": int(anc_seed), "sequence_length": float(length), "recomb_rate": float(recomb_rate),
+		"demography": pubrhe_demes.demography_hash(demog, samp)};
+
+def load_kept_ancestry(path, record):
+	#Tree sequence of a kept .trees file if it was simulated with the same record, else None.
+	if not os.path.isfile(path):
+		return None;
+	try:
+		ts = tskit.load(path);
+	except (OSError, tskit.FileFormatError):
+		return None;
+	metadata = ts.metadata;
+	if not isinstance(metadata, dict) or metadata.get("pubrhe_sweep") != record:
+		return None;
+	return ts;
+
+def with_record(ts, record):
+	tables = ts.dump_tables();
+	tables.metadata_schema = tskit.MetadataSchema.permissive_json();
+	tables.metadata = {"pubrhe_sweep": record};
+	return tables.tree_sequence();
+
+def run_cell(task):
+	#Ancestry of one (recombination rate, ancestry rep) cell, then every mutation overlay; returns one row per overlay.
+	model, demog, samp, length, recomb_rate, ancestry_rep, mut_rates, n_mut_reps, seed, out_dir, output, fmt, branch_sfs, keep_trees = task;
+	anc_seed, mut_seeds = cell_seeds(model, recomb_rate, ancestry_rep, mut_rates, n_mut_reps, seed);
+	prefix = os.path.join(out_dir, cell_name(model, recomb_rate, ancestry_rep));
+	t0 = time.time();
+	record = ancestry_record(demog, samp, length, recomb_rate, anc_seed);
+	ts = load_kept_ancestry(prefix + ".trees", record) if keep_trees else None;
+	if ts is None:
+		ts = msprime.sim_ancestry(samp, demography=demog, sequence_length=length, recombination_rate=recomb_rate, random_seed=anc_seed);
+		if keep_trees:
+			ts = with_record(ts, record);
+			pubrhe_output.write_output(ts, prefix, "trees");
+	anc_time = time.time() - t0;
+	rows = [];
+	background = pubrhe_output.BackgroundWriter();
+	for mu in mut_rates:
+		for m in range(n_mut_reps):
+			t0 = time.time();
+			mutated = msprime.sim_mutations(ts, rate=mu, random_seed=mut_seeds[(mu, m)]);
+			outHeader = prefix + ".mu" + ("%g" % mu) + ".m" + str(m);
+			paths = [];
+			if output in ("vcf", "both"):
+				background.submit(pubrhe_output.write_output, mutated, outHeader, fmt);
+				paths.append(pubrhe_output.output_path(outHeader, fmt));
+			if output in ("sfs", "both"):
+				paths += pubrhe_sfs.write_sfs(outHeader, pubrhe_sfs.segment_sfs(mutated, mu if branch_sfs else None), length);
+			rows.append({"recomb_rate": recomb_rate, "ancestry_rep": ancestry_rep, "mut_rate": mu, "mut_rep": m, "num_trees": ts.num_trees,
+				"num_sites": mutated.num_sites, "ancestry_time": anc_time, "mutation_time": time.time() - t0, "paths": paths});
+	background.close();
+	return rows;
+
+def sweep(model, demog, samp, length, recomb_rates, mut_rates, ancestry_reps=1, mut_reps=1, processes=1, seed=None, out_dir=".", output="sfs", branch_sfs=False, keep_trees=False, fmt="vcf", DEBUG=False):
+	#Run every (recombination rate, ancestry rep) cell, with all its mutation overlays; returns the rows of all overlays
+	#in grid order.
+	if output in ("sfs", "both"):
+		pubrhe_sfs.check_single_deme(samp);
+	os.makedirs(out_dir, exist_ok=True);
+	tasks = [(model, demog, samp, length, r, a, list(mut_rates), mut_reps, seed, out_dir, output, fmt, branch_sfs, keep_trees) for r in recomb_rates for a in range(ancestry_reps)];
+	if DEBUG: print("Sweeping " + str(len(tasks)) + " ancestry cell(s) x " + str(len(mut_rates) * mut_reps) + " mutation overlay(s) on " + str(processes) + " process(es)");
+	if processes <= 1 or len(tasks) == 1:
+		results = [run_cell(t) for t in tasks];
+	else:
+		#higher recombination rates (more trees) first; results kept in grid order
+		order = sorted(range(len(tasks)), key=lambda i: -tasks[i][4]);
+		with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+			done = pool.map(run_cell, [tasks[i] for i in order], chunksize=1);
+		results = [None] * len(tasks);
+		for i, res in zip(order, done):
+			results[i] = res;
+	return [row for rows in results for row in rows];
+
+def write_table(path, rows):
+	with open(path, "w") as out:
+		out.write("recomb_rate\tancestry_rep\tmut_rate\tmut_rep\tnum_trees\tnum_sites\tancestry_time\tmutation_time\tfiles\n");
+		for r in rows:
+			out.write("%g\t%d\t%g\t%d\t%d\t%d\t%.2f\t%.2f\t%s\n" % (r["recomb_rate"], r["ancestry_rep"], r["mut_rate"], r["mut_rep"], r["num_trees"], r["num_sites"], r["ancestry_time"], r["mutation_time"], ",".join(os.path.basename(p) for p in r["paths"])));
+
+def _rates(text):
+	return [float(x) for x in text.split(",")];
+
+parser = argparse.ArgumentParser(description="Recombination x mutation rate sweep with mutation overlays on shared ancestry.");
+parser.add_argument("model", help="fsc2-3, fsc2-4, or a Demes YAML file (a path, or a file name in demes/)");
+parser.add_argument("--recomb-rates", type=_rates, default=[1e-8], help="comma-separated recombination rates");
+parser.add_argument("--mut-rates", type=_rates, default=[1.08e-8], help="comma-separated mutation rates");
+parser.add_argument("--ancestry-reps", type=int, default=1, help="ancestry replicates per recombination rate");
+parser.add_argument("--mut-reps", type=int, default=1, help="mutation replicates per ancestry and mutation rate");
+parser.add_argument("--length", type=int, default=223000000, help="sequence length (bp)");
+parser.add_argument("--processes", type=int, default=1, help="worker processes (one ancestry cell each)");
+parser.add_argument("--seed", type=int, default=None, help="run seed (default: derived from the model, rates and replicate numbers only)");
+parser.add_argument("--out-dir", default=".", help="output folder");
+parser.add_argument("--output", choices=["vcf", "sfs", "both"], default="sfs", help="write the VCFs, the spectrum files, or both");
+parser.add_argument("--format", choices=pubrhe_output.FORMATS, default="vcf", help="genotype output with --output vcf/both (see pubrhe_output.py)");
+parser.add_argument("--branch-sfs", action="store_true", help="also write the branch (expected) spectrum with the site spectrum");
+parser.add_argument("--keep-trees", action="store_true", help="save the ancestry of every cell and reuse it on later runs");
+parser.add_argument("--samples", default=None, help="comma-separated deme=diploids (default: the fastsimcoal2 sample sizes)");
+parser.add_argument("--size-scale", type=float, default=0.5, help="factor applied to the Demes sizes (default 0.5: gene copies to diploids)");
+parser.add_argument("--cache-dir", default=os.path.join(pubrhe_demes.DEMES_DIR, ".compiled"), help="compiled-model cache folder (\"none\" to disable)");
+
+if __name__ == "__main__":
+	args = parser.parse_args();
+	samples = pubrhe_demes.parse_samples(args.samples) if args.samples is not None else None;
+	model, compiled = pubrhe_demes.load_model(args.model, args.size_scale, samples, None if args.cache_dir == "none" else args.cache_dir, DEBUG=True);
+	rows = sweep(model, compiled["demography"], compiled["samples"], args.length, args.recomb_rates, args.mut_rates, args.ancestry_reps, args.mut_reps,
+		args.processes, args.seed, args.out_dir, args.output, args.branch_sfs, args.keep_trees, args.format, DEBUG=True);
+	table = os.path.join(args.out_dir, model + ".sweep.tsv");
+	write_table(table, rows);
+	print(table);
@@ -0,0 +1,97 @@
+## Instrumentation for the simulation scripts: wall time, peak memory and tree/site counts of every step of a run
+## (sim_ancestry and sim_mutations of every segment, the output writers, the spectra), written as <prefix>.trace.json
+## and <prefix>.trace.csv, and an optional cProfile hook.
+##
+## A step is recorded with its name, wall time, the process id and the peak resident set size of the process at its end
+## (resource.getrusage; the high-water mark since the process started, so a step reports the most the process has held
+## so far, not what the step alone allocated), plus any fields set by the caller (segment index, num_trees, num_sites).
+## Steps run in pool workers are recorded there and returned with the results (see pubrhe_segments.simulate_segments).
+
+import os
+import csv
+import json
+import time
+import cProfile
+import resource
+import contextlib
+
+def peak_rss_mb():
+	#High-water mark of the resident set size of this process, in MB (ru_maxrss is in kB on Linux).
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0;
+
+class Trace:
+	#List of recorded steps (dictionaries), in the order they finished.
+	def __init__(self):
+		self.events = [];
+
+	def add(self, step, wall_time, **fields):
+		event = {"step": step, "wall_time": wall_time, "peak_rss_mb": peak_rss_mb(), "pid": os.getpid()};
+		event.update(fields);
+		self.events.append(event);
+		return event;
+
+	@contextlib.contextmanager
+	def step(self, step, **fields):
+		#Time the body of a with block; the yielded dictionary can be filled with counts (e.g. num_trees) inside it.
+		t0 = time.time();
+		extra = dict(fields);
+		yield extra;
+		self.add(step, time.time() - t0, **extra);
+
+	def call(self, step, func, *args, **fields):
+		#func(*args), recorded as a step.
+		with self.step(step, **fields):
+			return func(*args);
+
+	def extend(self, events):
+		self.events += events;
+
+	def totals(self):
+		#{step: {"count", "wall_time"}}, and the largest peak RSS of any process.
+		steps = {};
+		for e in self.events:
+			total = steps.setdefault(e["step"], {"count": 0, "wall_time": 0.0});
+			total["count"] += 1;
+			total["wall_time"] += e["wall_time"];
+		return {"steps": steps, "peak_rss_mb": max([e["peak_rss_mb"] for e in self.events], default=peak_rss_mb())};
+
+	def write(self, prefix, run=None):
+		#Write <prefix>.trace.json (run information, totals and steps) and <prefix>.trace.csv (one row per step).
+		with open(prefix + ".trace.json", "w") as out:
+			json.dump({"run": run or {}, "totals": self.totals(), "steps": self.events}, out, indent=1, default=str);
+		fields = ["step", "wall_time", "peak_rss_mb", "pid"];
+		fields += sorted(set(k for e in self.events for k in e) - set(fields));
+		with open(prefix + ".trace.csv", "w", newline="") as out:
+			writer = csv.DictWriter(out, fields);
+			writer.writeheader();
+			writer.writerows(self.events);
+		return [prefix + ".trace.json", prefix + ".trace.csv"];
+
+def step(trace, name, **fields):
+	#trace.step(name, **fields), or a no-op block (yielding a throwaway dictionary) when trace is None.
+	if trace is None:
+		return contextlib.nullcontext({});
+	return trace.step(name, **fields);
+
+def start_profile(path):
+	#cProfile.Profile already collecting, or None if path is None.
+	if path is None:
+		return None;
+	profiler = cProfile.Profile();
+	profiler.enable();
+	return profiler;
+
+def stop_profile(profiler, path):
+	#Stop a profiler of start_profile and save its statistics to path (read them with python -m pstats path).
+	if profiler is not None:
+		profiler.disable();
+		profiler.dump_stats(path);
+
+@contextlib.contextmanager
+def profiled(path):
+	#Run the body of a with block under cProfile, saving its statistics to path; no-op if path is None.
+	profiler = start_profile(path);
+	try:
+		yield;
+	finally:
+		stop_profile(profiler, path);
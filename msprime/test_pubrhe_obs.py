@@ -0,0 +1,50 @@
+## Round trips of the fastsimcoal2 .obs spectra through pubrhe_obs: writing and parsing them back, and the memory-mapped
+## binary cache of load_obs.
+
+import os
+import glob
+import shutil
+import numpy as np
+import pytest
+import pubrhe_obs
+
+OBS_FILES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fastsimcoal2", "*", "sfs-files", "*.obs")));
+
+@pytest.mark.parametrize("path", OBS_FILES, ids=os.path.basename)
+def test_repository_files(path, tmp_path):
+	#every .obs file of the repository is parsed, written and parsed back unchanged
+	obs = pubrhe_obs.parse_obs(path);
+	pops = pubrhe_obs.NAME_RE.search(path).groups()[1:];
+	assert obs.pops == tuple(int(p) for p in pops if p is not None);
+	copy = str(tmp_path / os.path.basename(path));
+	obs.to_file(copy);
+	again = pubrhe_obs.parse_obs(copy);
+	assert again.pops == obs.pops;
+	np.testing.assert_array_equal(again.data, obs.data);
+
+@pytest.mark.parametrize("shape, pops", [((11,), (0,)), ((7, 5), (2, 0))])
+def test_write_read(shape, pops, tmp_path):
+	data = np.random.default_rng(1).poisson(20, shape).astype(float);
+	data.flat[1] = 0.25;
+	path = str(tmp_path / "x.obs");
+	pubrhe_obs.ObsSpectrum(data, pops).to_file(path);
+	obs = pubrhe_obs.parse_obs(path);
+	assert obs.pops == pops;
+	assert obs.sample_sizes == [n - 1 for n in shape];
+	np.testing.assert_array_equal(obs.data, data);
+
+def test_load_obs_cache(tmp_path):
+	path = str(tmp_path / "pop_jointMAFpop1_0.obs");
+	shutil.copy(OBS_FILES[[os.path.basename(p) for p in OBS_FILES].index("3-deme_XXXFirst_jointMAFpop1_0.obs")], path);
+	first = pubrhe_obs.load_obs(path);
+	assert isinstance(first.data, np.memmap);
+	np.testing.assert_array_equal(first.data, pubrhe_obs.parse_obs(path).data);
+	#served from the cache, also when the file is only touched
+	os.utime(path, ns=(0, 0));
+	assert pubrhe_obs.load_obs(path).pops == first.pops;
+	#rebuilt when the file changes
+	changed = pubrhe_obs.parse_obs(path);
+	changed.data[0, 1] += 1;
+	changed.to_file(path);
+	np.testing.assert_array_equal(pubrhe_obs.load_obs(path).data, changed.data);
+	assert list(pubrhe_obs.load_obs_dir(str(tmp_path))) == [(1, 0)];